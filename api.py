@@ -2,12 +2,24 @@
 exposing the resources and define the endpoints to use it."""
 import endpoints
 from protorpc import remote, messages
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
-from utils import get_by_urlsafe
+from google.appengine.ext import ndb
+from utils import (
+    get_by_urlsafe,
+    key_from_urlsafe,
+    fetch_page,
+    fetch_list_page,
+)
+from dictionary import get_dictionary
+from difficulty import LEVELS
+from instrumentation import instrumented
+import coalescer
+import feed
+import game_cache
+import stats
 
 from models.user_class import (
     User,
+    UserResultShard,
     UserForms,
     StringMessage,
 )
@@ -16,26 +28,86 @@ from models.game_class import (
     NewGameForm,
     GameForm,
     GameForms,
+    DashboardForm,
+    HintForm,
     MakeMoveForm,
+    MakeMovesForm,
+    MoveResultForm,
+    MoveResultForms,
+    IllegalMove,
+    LIST_PROJECTION,
+)
+from models.leaderboard_class import (
+    Leaderboard,
+    RankForm,
+    RankForms,
+    rank_form,
+    TOP_SIZE,
+)
+from models.high_score_class import (
+    HighScoreTable,
+    Window,
+    TABLE_SIZE,
+)
+from models.move_class import (
+    Move,
+    MoveForms,
+    GameChangesForm,
 )
+from models.summary_class import UserSummary
 from models.score_class import (
     Score,
     ScoreForms,
 )
+from models.stats_class import (
+    StatShard,
+    CategoryStatsForms,
+    HistogramForm,
+    cancel_game_deltas,
+)
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUESTS = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),)
+GAME_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    if_none_match=messages.StringField(2))
+GAME_PAGE_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    page_size=messages.IntegerField(2),
+    page_token=messages.StringField(3),
+    if_none_match=messages.StringField(4))
+GAME_CHANGES_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    after=messages.IntegerField(2, default=0),
+    timeout=messages.IntegerField(3))
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1),
     email=messages.StringField(2))
-HIGH_SC_REQUEST = endpoints.ResourceContainer(
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    page_size=messages.IntegerField(2),
+    page_token=messages.StringField(3))
+PAGE_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1),
+    page_token=messages.StringField(2))
+LEADERBOARD_REQUEST = endpoints.ResourceContainer(
     max_results_to_show=messages.IntegerField(1),)
+RANK_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),)
+HIGH_SC_REQUEST = endpoints.ResourceContainer(
+    max_results_to_show=messages.IntegerField(1),
+    category=messages.StringField(2),
+    window=messages.EnumField(Window, 3, default=Window.ALL))
 
-MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+MAX_BATCH_MOVES = 100
+# The seconds get_game_changes waits for a move by default and at most
+DEFAULT_CHANGES_TIMEOUT = 25
+MAX_CHANGES_TIMEOUT = 50
+MAX_CHANGES = 100
 
 
 @endpoints.api(name='hangman', version='v1')
@@ -46,6 +118,7 @@ class Hangman(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
     def create_user(self, request):
         """Creates a User.
         Args:
@@ -55,13 +128,13 @@ class Hangman(remote.Service):
             StringMessage: A message that is sent to the client, saying that
             the user has been created.
         Raises:
+            endpoints.BadRequestException: If the name is missing.
             endpoints.ConflictException: If the user already exists."""
-        if User.query(User.name == request.user_name).get():
+        if not request.user_name:
+            raise endpoints.BadRequestException('A user name is required!')
+        if not User.create(request.user_name, request.email):
             raise endpoints.ConflictException(
                 'A User with that name already exists!')
-        user = User(name=request.user_name,
-                    email=request.email)
-        user.put()
         return StringMessage(message='User {} created!'.format(
             request.user_name))
 
@@ -70,36 +143,46 @@ class Hangman(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
     def new_game(self, request):
         """Creates a new game.
         Args:
             request: The NEW_GAME_REQUEST object, which includes a
-            NewgameForm requiring the user name and the desired category
+            NewgameForm requiring the user name and the desired category,
+            given by name or id in category or by id in
+            cat_1_animals_2_food_3_jobs, and optionally a difficulty: easy,
+            medium or hard
         Returns:
             a GameForm with the attempts remainming, the cancelled and
             game_over flags, the urlsafe key of the game the user name,
             the chosen category and a messagge that tells how many
             letters the scret word has.
         Raises:
-            endpoints.NotFoundException: If that user doesn't exists.
-            endpoints.BadRequestException: If the category is not
-            1, 2 or 3."""
-        user = User.query(User.name == request.user_name).get()
-        if request.cat_1_animals_2_food_3_jobs < 1 or request.cat_1_animals_2_food_3_jobs > 3:
+            endpoints.NotFoundException: If that user or that category
+            doesn't exists.
+            endpoints.BadRequestException: If the category has no words
+            or the difficulty does not exist."""
+        user = User.get_by_name(request.user_name)
+        dictionary = get_dictionary()
+        category = dictionary.category(
+            request.category or request.cat_1_animals_2_food_3_jobs)
+        if not category:
             raise endpoints.NotFoundException(
-                'You should choose a category 1=animals, 2=food, 3=jobs')
+                'You should choose a category ' + ', '.join(
+                    '{}={}'.format(c.id, c.name)
+                    for c in dictionary.categories))
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
+        if request.difficulty and request.difficulty not in LEVELS:
+            raise endpoints.BadRequestException(
+                'The difficulty should be one of ' + ', '.join(LEVELS))
         try:
-            game = Game.new_game(
-                user.key, request.cat_1_animals_2_food_3_jobs)
+            game = Game.new_game(user, category.id,
+                                 request.difficulty or None)
         except ValueError:
             raise endpoints.BadRequestException('bad category')
 
-        # Use a task queue to update the average attempts remaining.
-        taskqueue.add(url='/tasks/cache_average_attempts')
-
         return game.to_form('Good luck playing Hangman! You have 10 attempts '
                             'to guess the secret word of your chosen '
                             'category; it has ' +
@@ -110,6 +193,7 @@ class Hangman(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @instrumented
     def make_move(self, request):
         """Makes a move (guess).
         Args:
@@ -120,87 +204,107 @@ class Hangman(remote.Service):
             of missed letters and the correct letters in the right order,
             or telling if the user won guessing the word or lost by making
             too much wrong attepts.
+            The moves made concurrently in a game are written in order
+            with a compare-and-set on the version of the game.
         Raises:
+            endpoints.NotFoundException: If the game doesn't exist.
             endpoints.ForbiddenException: If that game is already over 
-            or it has been cancelled."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game.game_over:
-            raise endpoints.ForbiddenException(
-                'Illegal action: Game is already over.')
-        if game.game_cancelled:
-            raise endpoints.ForbiddenException(
-                'Illegal action: Game has been cancelled.')
-        # Check if the player enters a single letter not already guessed
-        game.alreadyGuessed = game.missedLetters + game.correctLetters
-        letter = request.guess
-        letter = letter.lower()
-        if letter.isalpha():
-            if letter == game.secretWord:
-                game.end_game(True)
-                user = game.user.get()
-                user.victories += 1
-                user.ratio = float(user.victories) / float(
-                    user.victories + user.losses)
-                user.put()
-                msg = 'Yes, the secret word is: ' + game.secretWord + \
-                      '! You win after ' + str(len(game.missedLetters)) + \
-                      ' missed guesses'
-                game.add_history(letter, msg)
-                return game.to_form(msg)
-            else:
-                if len(letter) != 1:
-                    msg = 'Enter a single letter or try to guess the whole word'
-                    return game.to_form(msg)
-                else:
-                    if letter in game.alreadyGuessed:
-                        msg = 'Letter already guessed. Choose again!'
-                        return game.to_form(msg)
-                    else:
-                        request.guess = letter
-        else:
-            raise endpoints.ForbiddenException(
-                'Illegal guess: you have to insert a proper single letter!')
-        # If the letter is in the secret word add it the correct
-        # letters list, otherwise add it to the wrong letter list
-        if request.guess in game.secretWord:
-            game.correctLetters = game.correctLetters + request.guess
-            mess = 'Yes, the letter ' + letter.upper() + ' is correct! *** '
-        else:
-            game.missedLetters = game.missedLetters + request.guess
-            mess = 'No, the letter ' + letter.upper() + ' is not correct! *** '
-        # Print the missed letters and replace blanks with guessed letters
-        game.attempts_remaining = game.attempts_allowed - len(game.missedLetters)
-        blanks = '-' * (len(game.secretWord))
-        for i in range(len(game.secretWord)):
-            if game.secretWord[i] in game.correctLetters:
-                blanks = blanks[:i] + game.secretWord[i] + blanks[i + 1:]
-        msg = mess + 'Missed Letters: ' + game.missedLetters +\
-            ' *** Guessed letters: ' + blanks + ' *** You have ' +\
-            str(game.attempts_remaining) + ' attempts left.'
-        # Check if player has guessed too many times and lost
-        if len(game.missedLetters) == game.attempts_allowed:
-            msg = 'You are an Hangman! You have run out of guesses after ' + \
-                str(len(game.missedLetters)) + ' missed guesses and ' + \
-                str(len(game.correctLetters)) + ' correct guesses, '\
-                'the secret word was: ' + game.secretWord + '! '
-            user = game.user.get()
-            user.losses += 1
-            user.ratio = float(user.victories) / float(
-                user.victories + user.losses)
-            user.put()
-            game.add_history(letter, msg)
-            game.end_game(False)
-            return game.to_form(msg + 'Game over!')
-        else:
-            game.put()
-            game.add_history(letter, msg)
-            return game.to_form(msg)
+            or it has been cancelled.
+            endpoints.ConflictException: If the move could not be written
+            because of the other moves of the game."""
+        key = key_from_urlsafe(request.urlsafe_game_key, Game)
+        if not key:
+            # Let get_by_urlsafe raise the error of the malformed key
+            get_by_urlsafe(request.urlsafe_game_key, Game)
+            raise endpoints.NotFoundException('Game not found!')
+        try:
+            form = coalescer.make_move(key, request.guess)
+        except coalescer.GameNotFound, e:
+            raise endpoints.NotFoundException(str(e))
+        except IllegalMove, e:
+            raise endpoints.ForbiddenException(str(e))
+        except coalescer.GameBusy, e:
+            raise endpoints.ConflictException(str(e))
+        game_cache.bump([key.urlsafe()])
+        return form
+
+    @endpoints.method(request_message=MakeMovesForm,
+                      response_message=MoveResultForms,
+                      path='games/moves',
+                      name='make_moves',
+                      http_method='POST')
+    @instrumented
+    def make_moves(self, request):
+        """Makes many moves, in one or more games, with one call. The moves
+        of a game are played in request order; the games are read with one
+        batched get and each game is written with the compare-and-set
+        transaction of make_move, all of them concurrently. The moves of a
+        game written meanwhile by another request are played again on the
+        current game, like make_move does. The moves of a game whose write
+        failed otherwise get an error, while the other games are written.
+        Args:
+            request: The MakeMovesForm, with at most MAX_BATCH_MOVES moves,
+            each with the game urlsafe key and the guess
+        Returns:
+            MoveResultForms: for every move, in request order, the GameForm
+            after the move, as make_move returns it, or the error that
+            rejected the move, such as a conflict with the other moves of
+            the game.
+        Raises:
+            endpoints.BadRequestException: If there are too many moves."""
+        if len(request.moves) > MAX_BATCH_MOVES:
+            raise endpoints.BadRequestException(
+                'At most {} moves per batch'.format(MAX_BATCH_MOVES))
+        keys = [key_from_urlsafe(move.urlsafe_game_key, Game)
+                for move in request.moves]
+        unique = list(set(key for key in keys if key))
+        games = dict(zip(unique, ndb.get_multi(unique)))
+        results = {}
+        # The guesses and items of each game, to play again if the game
+        # was written meanwhile
+        played = {}
+        items = []
+        for move, key in zip(request.moves, keys):
+            item = MoveResultForm(urlsafe_game_key=move.urlsafe_game_key)
+            items.append(item)
+            game = games.get(key)
+            if not game:
+                item.error = 'Game not found!'
+                continue
+            played.setdefault(key, []).append((move.guess, item))
+            try:
+                result = game.play(move.guess)
+            except IllegalMove, e:
+                item.error = str(e)
+                continue
+            if result.letter:
+                results.setdefault(key, []).append(result)
+            item.game = game.to_form(result.message)
+        if results:
+            stale, failed = Game.add_histories(
+                [games[key] for key in results], results)
+            for key in failed:
+                for _, item in played[key]:
+                    if not item.error:
+                        item.game = None
+                        item.error = 'The move could not be written, ' \
+                                     'read the game and try again'
+            for key in stale:
+                moves = [coalescer.PendingMove(guess)
+                         for guess, _ in played[key]]
+                coalescer.write(key, moves)
+                for (_, item), move in zip(played[key], moves):
+                    item.game = move.form
+                    item.error = str(move.error) if move.error else None
+            game_cache.bump([key.urlsafe() for key in results])
+        return MoveResultForms(items=items)
 
     @endpoints.method(request_message=GET_GAME_REQUESTS,
                       response_message=StringMessage,
                       path='game_canc/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='PUT')
+    @instrumented
     def cancel_game(self, request):
         """Cancel a game.
         Args:
@@ -209,234 +313,533 @@ class Hangman(remote.Service):
         Returns:
             StringMessage: telling that the Game has been cancelled
         Raises:
+            endpoints.NotFoundException: If that game doesn't exists.
             endpoints.ForbiddenException: If that game is already over."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game.game_over:
-            raise endpoints.ForbiddenException(
-                'Illegal action: Game is already over, you cannot cancel it.')
-        else:
-            game.game_cancelled = True
-            game.put()
-            return StringMessage(message='Game {} canceled!'.format(
-                request.urlsafe_game_key))
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        try:
+            cancelled = game.cancel()
+        except IllegalMove, e:
+            raise endpoints.ForbiddenException(str(e))
+        if cancelled:
+            game_cache.bump([game.key.urlsafe()])
+            UserSummary.update(
+                game.user, lambda summary: summary.record_cancel(game.key))
+            StatShard.increment_multi(cancel_game_deltas(cancelled))
+        return StringMessage(message='Game {} canceled!'.format(
+            request.urlsafe_game_key))
 
-    @endpoints.method(request_message=GET_GAME_REQUESTS,
+    def if_none_match(self, request):
+        """Returns the ETag a request is conditional on, from its
+        if_none_match parameter or its If-None-Match header"""
+        if request.if_none_match:
+            return request.if_none_match
+        etag = self.request_state.headers.get('If-None-Match')
+        return etag.strip('"') if etag else None
+
+    def cached_response(self, request, entry_key, message_type, render):
+        """Returns a response of the game of a request through the
+        game_cache, with its ETag. If the client has the current response,
+        returns an empty one flagged unchanged: Cloud Endpoints only sends
+        its own errors, so it cannot answer 304 Not Modified"""
+        key = key_from_urlsafe(request.urlsafe_game_key, Game)
+        if not key:
+            # Let render raise the error of the malformed key
+            return render()
+        response, etag = game_cache.cached(
+            key.urlsafe(), entry_key(key.urlsafe()), message_type, render,
+            self.if_none_match(request))
+        if response is None:
+            response = message_type(unchanged=True)
+            if hasattr(message_type, 'urlsafe_key'):
+                response.urlsafe_key = key.urlsafe()
+        response.etag = etag
+        return response
+
+    @endpoints.method(request_message=GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
     def get_game(self, request):
-        """Retrieve a game.
+        """Retrieve a game. The response is cached until the next move or
+        the cancellation of the game, and its etag can be sent back as
+        if_none_match (or If-None-Match) to poll the game.
+        Args:
+            request: The GAME_REQUEST object, which require the
+            urlsafe_game_key and accepts the if_none_match etag
+        Returns:
+            GameForm: telling if the Game is cancelled, already completed
+            or still waiting for a new move, or only flagged unchanged if
+            the game has not changed since the response tagged
+            if_none_match
+        Raises:
+            endpoints.NotFoundException: If that game doesn't exists."""
+        def render():
+            game = get_by_urlsafe(request.urlsafe_game_key, Game)
+            if game:
+                if game.game_over:
+                    return game.to_form('Game already completed!')
+                else:
+                    if game.game_cancelled:
+                        return game.to_form('Game cancelled!')
+                    else:
+                        return game.to_form('Time to make a move!')
+            else:
+                raise endpoints.NotFoundException('Game not found!')
+        return self.cached_response(request, game_cache.form_key, GameForm,
+                                    render)
+
+    @endpoints.method(request_message=GET_GAME_REQUESTS,
+                      response_message=HintForm,
+                      path='game/{urlsafe_game_key}/hint',
+                      name='get_hint',
+                      http_method='GET')
+    @instrumented
+    def get_hint(self, request):
+        """Suggests the next letter to guess: of the letters not guessed
+        yet, the one in the most words of the category that match the
+        revealed letters and the missed letters.
         Args:
             request: The GET_GAME_REQUESTS object, which require the
             urlsafe_game_key
         Returns:
-            StringMessage: telling if the Game is cancelled, already
-            completed or still waiting for a new move
+            HintForm: the letter, the number of matching words and the
+            chance that the letter is in the secret word
         Raises:
-            endpoints.NotFoundException: If that game doesn't exists."""
+            endpoints.NotFoundException: If that game doesn't exists.
+            endpoints.ForbiddenException: If that game is already over,
+            it has been cancelled or it has used all its hints."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            if game.game_over:
-                return game.to_form('Game already completed!')
-            else:
-                if game.game_cancelled:
-                    return game.to_form('Game cancelled!')
-                else:
-                    return game.to_form('Time to make a move!')
-        else:
+        if not game:
             raise endpoints.NotFoundException('Game not found!')
+        if game.game_over or game.game_cancelled:
+            raise endpoints.ForbiddenException(
+                'Illegal action: Game is already over or cancelled.')
+        # Imported here, with NumPy, to keep them out of the cold start
+        import hints
+        try:
+            return hints.hint_form(game)
+        except hints.NoHintsLeft, e:
+            raise endpoints.ForbiddenException(str(e))
 
     @endpoints.method(request_message=USER_REQUEST,
+                      response_message=DashboardForm,
+                      path='dashboard/user/{user_name}',
+                      name='get_user_dashboard',
+                      http_method='GET')
+    @instrumented
+    def get_user_dashboard(self, request):
+        """Retrieve the summary of the games of a user: the number of
+        active, cancelled, won and lost games, the winning streaks, the
+        best score and the most recently created active games. Reads the
+        UserSummary with one get and the games with one batched get; the
+        won and lost games include the results not rolled up yet.
+        Args:
+            request: The USER_REQUEST object, which includes a users
+            chosen name
+        Returns:
+            DashboardForm: the summary of the games of the user
+        Raises:
+            endpoints.NotFoundException: If that user doesn't exists."""
+        user = User.get_by_name(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        summary = UserSummary.get_or_new(user.key)
+        won, lost, _ = UserResultShard.totals([user])[0]
+        games = [game for game in ndb.get_multi(summary.recent_active)
+                 if game and not (game.game_over or game.game_cancelled)]
+        return DashboardForm(
+            user_name=user.name,
+            active=summary.active,
+            cancelled=summary.cancelled,
+            won=won,
+            lost=lost,
+            current_streak=summary.current_streak,
+            best_streak=summary.best_streak,
+            best_guesses=summary.best_guesses,
+            recent_active_games=[game.to_form('Time to make a move!',
+                                              user.name)
+                                 for game in games])
+
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=GameForms,
                       path='active_games/user/{user_name}',
                       name='get_user_active_games',
                       http_method='GET')
+    @instrumented
     def get_user_active_games(self, request):
         """Retrieve active games created by user.
         Args:
-            request: The USER_REQUEST object, which includes a users
-            chosen name and an optional email.
+            request: The USER_PAGE_REQUEST object, which includes a users
+            chosen name, an optional page size and the optional page token
+            returned with the previous page.
         Returns:
-            StringMessage: telling to maj=ke a move in the active games
+            GameForms: telling to make a move in the active games, with
+            the token of the next page
         Raises:
             endpoints.NotFoundException: If that user doesn't exists."""
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        games = Game.query(
-            Game.user == user.key).filter(
-                Game.game_over == False).filter(Game.game_cancelled == False)
-        return GameForms(
-            items=[game.to_form('Time to make a move!') for game in games])
+        games, next_page_token = fetch_page(
+            Game.query(Game.user == user.key,
+                       Game.game_over == False,
+                       Game.game_cancelled == False).order(Game.key),
+            request.page_size, request.page_token,
+            projection=LIST_PROJECTION)
+        return Game.to_forms(games, 'Time to make a move!',
+                             {'game_over': False, 'game_cancelled': False},
+                             next_page_token)
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=GameForms,
                       path='cancelled_games/user/{user_name}',
                       name='get_user_cancelled_games',
                       http_method='GET')
+    @instrumented
     def get_user_cancelled_games(self, request):
         """Retrieve all the games created by the user that cannot be played
         because they have been cancelled.
         Args:
-            request: The USER_REQUEST object, which includes a users
-            chosen name and an optional email.
+            request: The USER_PAGE_REQUEST object, which includes a users
+            chosen name, an optional page size and the optional page token
+            returned with the previous page.
         Returns:
-            StringMessage: telling that the Game is cancelled
+            GameForms: telling that the Games are cancelled, with the token
+            of the next page
         Raises:
             endpoints.NotFoundException: If that user doesn't exists."""
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        games = Game.query(
-            Game.user == user.key).filter(Game.game_cancelled == True)
-        return GameForms(
-            items=[game.to_form('game cancelled!') for game in games])
+        # A cancelled game cannot be played, so it is never over
+        games, next_page_token = fetch_page(
+            Game.query(Game.user == user.key,
+                       Game.game_cancelled == True).order(Game.key),
+            request.page_size, request.page_token,
+            projection=LIST_PROJECTION)
+        return Game.to_forms(games, 'game cancelled!',
+                             {'game_over': False, 'game_cancelled': True},
+                             next_page_token)
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=GameForms,
                       path='completed_games/user/{user_name}',
                       name='get_user_completed_games',
                       http_method='GET')
+    @instrumented
     def get_user_completed_games(self, request):
         """Retrieve all the games created by the user that cannot be played
         because they have been completed.
         Args:
-            request: The USER_REQUEST object, which includes a users
-            chosen name and an optional email.
+            request: The USER_PAGE_REQUEST object, which includes a users
+            chosen name, an optional page size and the optional page token
+            returned with the previous page.
         Returns:
-            StringMessage: telling if the Game is cancelled, already
-            completed or still waiting for a new move
+            GameForms: telling that the Games are completed, with the token
+            of the next page
         Raises:
             endpoints.NotFoundException: If that user doesn't exists."""
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        games = Game.query(
-            Game.user == user.key).filter(Game.game_over == True)
-        return GameForms(
-            items=[game.to_form('game completed!') for game in games])
+        # A completed game cannot be cancelled
+        games, next_page_token = fetch_page(
+            Game.query(Game.user == user.key,
+                       Game.game_over == True).order(Game.key),
+            request.page_size, request.page_token,
+            projection=LIST_PROJECTION)
+        return Game.to_forms(games, 'game completed!',
+                             {'game_over': True, 'game_cancelled': False},
+                             next_page_token)
 
-    @endpoints.method(request_message=GET_GAME_REQUESTS,
-                      response_message=StringMessage,
+    @endpoints.method(request_message=GAME_PAGE_REQUEST,
+                      response_message=MoveForms,
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented
     def get_game_history(self, request):
-        """Return the chosen game guesses and answers history
+        """Return the chosen game guesses and answers history, one page
+        at a time. Pages are cached like get_game.
         Args:
-            request: The GET_GAME_REQUESTS object, which require the
-            urlsafe_game_key
+            request: The GAME_PAGE_REQUEST object, which require the
+            urlsafe_game_key, an optional page size, the optional page
+            token returned with the previous page and the optional
+            if_none_match etag
         Returns:
-            StringMessage: telling with the game guesses and answers history
+            MoveForms: with the sequence number, the guess and the answer
+            of each move in order, and the token of the next page, or only
+            flagged unchanged if the game has not changed since the page
+            tagged if_none_match
         Raises:
             endpoints.NotFoundException: If that game doesn't exist."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            return StringMessage(message=str(game.game_history))
-        else:
+        def render():
+            game = get_by_urlsafe(request.urlsafe_game_key, Game)
+            if game:
+                # The history of an old Game is converted to Moves by its
+                # next move, not by a read
+                legacy = game.legacy_moves()
+                if legacy:
+                    moves, next_page_token = fetch_list_page(
+                        legacy, request.page_size, request.page_token)
+                else:
+                    moves, next_page_token = fetch_page(
+                        Move.query_game(game.key),
+                        request.page_size, request.page_token)
+                return MoveForms(items=[move.to_form() for move in moves],
+                                 next_page_token=next_page_token)
+            else:
+                raise endpoints.NotFoundException('Game not found!')
+        return self.cached_response(
+            request, lambda key: game_cache.history_key(
+                key, request.page_size, request.page_token),
+            MoveForms, render)
+
+    @endpoints.method(request_message=GAME_CHANGES_REQUEST,
+                      response_message=GameChangesForm,
+                      path='game/{urlsafe_game_key}/changes',
+                      name='get_game_changes',
+                      http_method='GET')
+    @instrumented
+    def get_game_changes(self, request):
+        """Return the moves of a game after a sequence number, waiting for
+        one to be made if there is none yet, so watchers of a game do not
+        poll get_game_history. While it waits, the request reads the state
+        of the game from memcache only.
+        Args:
+            request: The GAME_CHANGES_REQUEST object, which require the
+            urlsafe_game_key, the sequence number of the last move the
+            client has in after (0 for none) and the optional seconds to
+            wait in timeout (25 by default, at most 50)
+        Returns:
+            GameChangesForm: the next moves, at most 100, the sequence
+            number to send as after with the next request and whether the
+            game is finished. There are no moves if none was made before
+            the timeout.
+        Raises:
+            endpoints.NotFoundException: If that game doesn't exist."""
+        key = key_from_urlsafe(request.urlsafe_game_key, Game)
+        if not key:
+            # Let get_by_urlsafe raise the error of the malformed key
+            get_by_urlsafe(request.urlsafe_game_key, Game)
+            raise endpoints.NotFoundException('Game not found!')
+        after = max(request.after or 0, 0)
+        timeout = request.timeout
+        if timeout is None:
+            timeout = DEFAULT_CHANGES_TIMEOUT
+        timeout = min(max(timeout, 0), MAX_CHANGES_TIMEOUT)
+
+        def load():
+            game = key.get()
+            if game is None:
+                return None
+            # The history of an old Game is converted to Moves by its next
+            # move, not by a read
+            sequence, finished = feed.state(game)
+            return sequence + len(game.legacy_moves()), finished
+
+        state = feed.wait(key.urlsafe(), after, timeout, load)
+        if state is None:
             raise endpoints.NotFoundException('Game not found!')
+        sequence, finished = state
+        last = min(sequence, after + MAX_CHANGES)
+        moves = ndb.get_multi([Move.key_for(key, position)
+                               for position in range(after + 1, last + 1)])
+        if not all(moves):
+            game = key.get()
+            legacy = game.legacy_moves() if game else []
+            if legacy:
+                moves = legacy[after:last]
+        return GameChangesForm(
+            items=[move.to_form() for move in moves if move],
+            sequence=last,
+            finished=finished and last == sequence)
 
     @endpoints.method(response_message=StringMessage,
                       path='games/average_attempts',
                       name='get_average_attempts_remaining',
                       http_method='GET')
+    @instrumented
     def get_average_attempts(self, request):
-        """Get the cached average moves remaining
+        """Get the average moves remaining of the active games
         Args:
             None
         Returns:
             StringMessage: telling the number of average moves remaining"""
-        return StringMessage(message=memcache.get(
-            MEMCACHE_MOVES_REMAINING) or '')
-
-    @staticmethod
-    def _cache_average_attempts():
-        """Populates memcache with the average moves remaining of Games"""
-        games = Game.query(Game.game_over is False).fetch()
-        if games:
-            count = len(games)
-            total_attempts_remaining = sum([game.attempts_remaining
-                                            for game in games])
-            average = float(total_attempts_remaining) / count
-            memcache.set(MEMCACHE_MOVES_REMAINING,
-                         'The average moves remaining is {:.2f}'.format(
-                             average))
-
-    @endpoints.method(response_message=ScoreForms,
+        return StringMessage(message=stats.average_attempts_message())
+
+    @endpoints.method(response_message=CategoryStatsForms,
+                      path='games/category_stats',
+                      name='get_category_stats',
+                      http_method='GET')
+    @instrumented
+    def get_category_stats(self, request):
+        """Get the games won and lost in each category
+        Args:
+            None
+        Returns:
+            CategoryStatsForms with the category, the games won and lost
+            and the win rate"""
+        return stats.category_stats_forms()
+
+    @endpoints.method(response_message=HistogramForm,
+                      path='games/guesses_histogram',
+                      name='get_guesses_histogram',
+                      http_method='GET')
+    @instrumented
+    def get_guesses_histogram(self, request):
+        """Get the number of games won with each number of guesses
+        Args:
+            None
+        Returns:
+            HistogramForm with a bucket for every number of guesses"""
+        return stats.histogram_form()
+
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented
     def get_scores(self, request):
-        """Get all users scores
+        """Get all users scores, one page at a time
         Args:
-            None
+            request: The PAGE_REQUEST object, which includes an optional
+            page size and the optional page token returned with the
+            previous page.
         Returns:
             ScoreForms with the user name, the date, the won flag and
-            the number of guesses"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+            the number of guesses, and the token of the next page"""
+        scores, next_page_token = fetch_page(
+            Score.query().order(Score.key),
+            request.page_size, request.page_token)
+        return Score.to_forms(scores, next_page_token)
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores
+        """Returns all of an individual User's scores, one page at a time
         Args:
-            request: The USER_REQUEST object, which includes a users
-            chosen name and an optional email.
+            request: The USER_PAGE_REQUEST object, which includes a users
+            chosen name, an optional page size and the optional page token
+            returned with the previous page.
         Returns:
             ScoreForms with the user name, the date, the won flag and
-            the number of guesses
+            the number of guesses, and the token of the next page
         Raises:
             endpoints.NotFoundException: If that user doesn't exist."""
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        scores, next_page_token = fetch_page(
+            Score.query(Score.user == user.key).order(Score.key),
+            request.page_size, request.page_token)
+        return Score.to_forms(scores, next_page_token)
 
     @endpoints.method(request_message=HIGH_SC_REQUEST,
                       response_message=ScoreForms,
                       path='high_scores',
                       name='get_high_scores',
                       http_method='GET')
+    @instrumented
     def get_high_scores(self, request):
-        """Returns the players total scores ordered with the best first
-        (the player with the lowest number of attemps to guess)
+        """Returns the players winning scores ordered with the best first
+        (the player with the lowest number of attemps to guess), from the
+        pre-aggregated high score tables
         Args:
             request: The HIGH_SC_REQUEST object, which require the
-            optional max number of results to show
+            optional max number of results to show (at most 100), the
+            optional category name or id and the optional time window:
+            ALL (all-time, the default), WEEK (this week) or DAY (today)
         Returns:
             ScoreForms with the user name, the date, the won flag and
-            the number of guesses."""
-        if request.max_results_to_show:
-            scores = Score.query(Score.won is True).order(
-                Score.guesses).fetch(request.max_results_to_show)
-        else:
-            scores = Score.query(Score.won is True).order(
-                Score.guesses).fetch()
-        return ScoreForms(items=[score.to_form() for score in scores])
-
-    @endpoints.method(response_message=UserForms,
+            the number of guesses.
+        Raises:
+            endpoints.NotFoundException: If that category doesn't exist."""
+        category = None
+        if request.category:
+            category = get_dictionary().category(request.category)
+            if not category:
+                raise endpoints.NotFoundException('Category not found!')
+            category = category.id
+        return HighScoreTable.to_forms(
+            request.window, category,
+            min(request.max_results_to_show or TABLE_SIZE, TABLE_SIZE))
+
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=UserForms,
                       path='user_ranking',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented
     def get_user_rankings(self, request):
         """Return the players ordered by victories/losses ratio with ties
         broken by the number of victories
         Args:
-            request: None
+            request: The PAGE_REQUEST object, which includes an optional
+            page size and the optional page token returned with the
+            previous page.
         Returns:
             UserForms: with the user name, mail, win ratio, victories
-            and losses."""
-        users = User.query().order(-User.ratio, User.victories)
-        return UserForms(items=[user.to_form() for user in users])
+            and losses, and the token of the next page."""
+        users, next_page_token = fetch_page(
+            User.query().order(-User.ratio, User.victories, User.key),
+            request.page_size, request.page_token)
+        return UserForms(items=[user.to_form() for user in users],
+                         next_page_token=next_page_token)
+
+    @endpoints.method(request_message=LEADERBOARD_REQUEST,
+                      response_message=RankForms,
+                      path='leaderboard',
+                      name='get_leaderboard',
+                      http_method='GET')
+    @instrumented
+    def get_leaderboard(self, request):
+        """Return the best players of the materialized ranking
+        Args:
+            request: The LEADERBOARD_REQUEST object, which require the
+            optional max number of results to show (10 by default, at
+            most 100)
+        Returns:
+            RankForms: with the rank, user name, win ratio, victories
+            and losses of the best players."""
+        count = min(request.max_results_to_show or 10, TOP_SIZE)
+        return Leaderboard.top(count)
+
+    @endpoints.method(request_message=RANK_REQUEST,
+                      response_message=RankForm,
+                      path='leaderboard/user/{user_name}',
+                      name='get_user_rank',
+                      http_method='GET')
+    @instrumented
+    def get_user_rank(self, request):
+        """Return the position of a player in the materialized ranking
+        Args:
+            request: The RANK_REQUEST object, which require the user name
+        Returns:
+            RankForm: with the rank, user name, win ratio, victories and
+            losses of the player.
+        Raises:
+            endpoints.NotFoundException: If that user has not completed a
+            game yet."""
+        found = Leaderboard.load().rank(request.user_name)
+        if not found:
+            raise endpoints.NotFoundException(
+                'A User with that name has not completed a game yet!')
+        return rank_form(*found)
 
 
 api = endpoints.api_server([Hangman])
@@ -0,0 +1,9 @@
+"""appengine_config.py - Imported by the App Engine runtime before the app.
+Adds the libraries vendored in the lib folder to the path; they are
+installed there with:
+    pip install -t lib -r requirements-vendor.txt"""
+import os
+
+from google.appengine.ext import vendor
+
+vendor.add(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib'))
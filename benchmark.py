@@ -0,0 +1,488 @@
+"""benchmark.py - Load test and latency benchmark of the Hangman API.
+Runs the real endpoint methods against the datastore, memcache and
+taskqueue stubs of the App Engine testbed, on a synthetic population, and
+reports for each endpoint the throughput, the p50/p95/p99 latencies and the
+RPCs made per call. Usage:
+    python benchmark.py --sdk PATH_TO_APPENGINE_SDK [--users 200]
+        [--games 3] [--calls 200] [--concurrency 4]
+        [--baseline benchmark_baseline.json] [--save-baseline]
+Compares the results with the baseline file, if any, and exits with status
+1 if an endpoint regressed.
+With --contention WRITERS, instead makes WRITERS threads guess the letters
+of the same game at once, for --contention-games games, and reports the
+moves written per second, their latencies and the outcomes of the guesses;
+exits with status 1 if a written move is missing from its game. With
+--contention-batch MOVES, every other thread sends its guesses to
+make_moves, MOVES per call, and with --contention-legacy the games start
+with a pickled history, as the Games created before the Moves."""
+import argparse
+import itertools
+import json
+import os
+import random
+import string
+import sys
+import threading
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmark_baseline.json')
+# An endpoint regresses when a latency percentile grows by more than this
+# fraction of the baseline, or when it makes more RPCs per call
+LATENCY_TOLERANCE = 0.5
+
+
+def setup_sdk(sdk_path):
+    """Puts the App Engine SDK, its bundled libraries and the libraries
+    vendored in lib on the path, as the runtime does"""
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+    # Adds the vendored libraries
+    import appengine_config
+
+
+class RpcCounter(object):
+    """Counts the RPCs made by the current thread, by service and call,
+    through an apiproxy pre-call hook"""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def hook(self, service, call, request, response):
+        counts = getattr(self._local, 'counts', None)
+        if counts is not None:
+            counts['{}.{}'.format(service, call)] += 1
+
+    def start(self):
+        self._local.counts = defaultdict(int)
+
+    def stop(self):
+        counts, self._local.counts = self._local.counts, None
+        return counts
+
+
+def percentile(values, fraction):
+    """Returns a percentile of sorted values"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class Benchmark(object):
+    """Runs the endpoints on a testbed and collects their measures"""
+
+    def __init__(self, users, games, calls, concurrency):
+        self.users = users
+        self.games = games
+        self.calls = calls
+        self.concurrency = concurrency
+        self.counter = RpcCounter()
+        self.names = []
+        self.game_keys = []
+
+    def activate(self):
+        """Activates the testbed stubs and the RPC counter"""
+        from google.appengine.api import apiproxy_stub_map
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # endpoints.api_server reads the app revision after the dot
+        self.testbed.setup_env(current_version_id='testbed.1',
+                               overwrite=True)
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.
+            PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_urlfetch_stub()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'benchmark', self.counter.hook)
+        import api
+        from protorpc import remote
+        self.api = api
+        self.service = api.Hangman()
+        self.service.initialize_request_state(remote.HttpRequestState(
+            http_method='GET', headers={}))
+
+    def deactivate(self):
+        self.testbed.deactivate()
+
+    def request(self, container, **fields):
+        """Returns the request message of an endpoint"""
+        return container.combined_message_class(**fields)
+
+    def populate(self):
+        """Creates the users and their games, and plays some of the games
+        to the end so the scores and rankings are not empty"""
+        api = self.api
+        for index in range(self.users):
+            name = 'player{}'.format(index)
+            self.service.create_user(self.request(
+                api.USER_REQUEST, user_name=name,
+                email='{}@example.com'.format(name)))
+            self.names.append(name)
+            for _ in range(self.games):
+                form = self.service.new_game(self.request(
+                    api.NEW_GAME_REQUEST, user_name=name,
+                    category=random.choice(['1', '2', '3'])))
+                self.game_keys.append(form.urlsafe_key)
+        for key in self.game_keys[::2]:
+            for letter in random.sample(string.ascii_lowercase, 26):
+                form = self.call_quietly(self.service.make_move, self.request(
+                    api.MAKE_MOVE_REQUEST, urlsafe_game_key=key,
+                    guess=letter))
+                if form is None or form.game_over:
+                    break
+        self.run_crons()
+
+    def run_crons(self):
+        """Applies the queued updates of the materialized views"""
+        from models.high_score_class import HighScoreTable
+        from models.leaderboard_class import Leaderboard
+        from models.stats_class import StatShard
+        Leaderboard.update_from_queue()
+        HighScoreTable.update_from_queue()
+        StatShard.update_from_queue()
+
+    def call_quietly(self, method, request):
+        """Calls an endpoint, returning None if it raises an endpoints
+        error"""
+        import endpoints
+        try:
+            return method(request)
+        except endpoints.ServiceException:
+            return None
+
+    def scenarios(self):
+        """Returns the (name, function making the next call) pairs of the
+        benchmarked endpoints"""
+        from protorpc import message_types
+        from models.game_class import BatchMoveForm, MakeMovesForm
+        api = self.api
+        service = self.service
+        sequence = itertools.count()
+
+        def create_user():
+            name = 'new{}'.format(next(sequence))
+            service.create_user(self.request(api.USER_REQUEST,
+                                             user_name=name))
+
+        def new_game():
+            service.new_game(self.request(
+                api.NEW_GAME_REQUEST, user_name=random.choice(self.names),
+                category=random.choice(['1', '2', '3'])))
+
+        def make_move():
+            self.call_quietly(service.make_move, self.request(
+                api.MAKE_MOVE_REQUEST,
+                urlsafe_game_key=random.choice(self.game_keys),
+                guess=random.choice(string.ascii_lowercase)))
+
+        def make_moves():
+            keys = random.sample(self.game_keys, min(10, len(self.game_keys)))
+            service.make_moves(MakeMovesForm(moves=[
+                BatchMoveForm(urlsafe_game_key=key,
+                              guess=random.choice(string.ascii_lowercase))
+                for key in keys]))
+
+        def user_request(container):
+            return self.request(container,
+                                user_name=random.choice(self.names))
+
+        return [
+            ('create_user', create_user),
+            ('new_game', new_game),
+            ('make_move', make_move),
+            ('make_moves', make_moves),
+            ('get_game', lambda: service.get_game(self.request(
+                api.GAME_REQUEST,
+                urlsafe_game_key=random.choice(self.game_keys)))),
+            ('get_game_history', lambda: service.get_game_history(
+                self.request(api.GAME_PAGE_REQUEST,
+                             urlsafe_game_key=random.choice(
+                                 self.game_keys)))),
+            ('get_game_changes', lambda: service.get_game_changes(
+                self.request(api.GAME_CHANGES_REQUEST,
+                             urlsafe_game_key=random.choice(self.game_keys),
+                             after=1000, timeout=0))),
+            ('get_user_active_games', lambda: service.get_user_active_games(
+                user_request(api.USER_PAGE_REQUEST))),
+            ('get_user_dashboard', lambda: service.get_user_dashboard(
+                user_request(api.USER_REQUEST))),
+            ('get_user_scores', lambda: service.get_user_scores(
+                user_request(api.USER_PAGE_REQUEST))),
+            ('get_scores', lambda: service.get_scores(
+                self.request(api.PAGE_REQUEST))),
+            ('get_high_scores', lambda: service.get_high_scores(
+                self.request(api.HIGH_SC_REQUEST))),
+            ('get_user_rankings', lambda: service.get_user_rankings(
+                self.request(api.PAGE_REQUEST))),
+            ('get_leaderboard', lambda: service.get_leaderboard(
+                self.request(api.LEADERBOARD_REQUEST))),
+            ('get_user_rank', lambda: self.call_quietly(
+                service.get_user_rank, user_request(api.RANK_REQUEST))),
+            ('get_average_attempts', lambda: service.get_average_attempts(
+                message_types.VoidMessage())),
+        ]
+
+    def measure(self, call):
+        """Makes self.calls calls from self.concurrency threads.
+        Returns:
+            the measures of the endpoint"""
+        latencies = []
+        rpcs = defaultdict(int)
+        lock = threading.Lock()
+        remaining = [self.calls]
+
+        def worker():
+            while True:
+                with lock:
+                    if not remaining[0]:
+                        return
+                    remaining[0] -= 1
+                self.counter.start()
+                start = time.time()
+                call()
+                elapsed = time.time() - start
+                counts = self.counter.stop()
+                with lock:
+                    latencies.append(elapsed * 1000)
+                    for name, count in counts.items():
+                        rpcs[name] += count
+
+        start = time.time()
+        threads = [threading.Thread(target=worker)
+                   for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.time() - start
+        latencies.sort()
+        return {
+            'throughput': len(latencies) / wall if wall else 0.0,
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'rpcs_per_call': dict((name, float(count) / len(latencies))
+                                  for name, count in rpcs.items()),
+        }
+
+    def contend(self, writers, games, batch=0, legacy=False):
+        """Makes writers threads guess the letters of the same game
+        concurrently, for a number of games, then checks that every move
+        answered as written is in its game and its history.
+        Args:
+            writers: the number of threads per game
+            games: the number of games
+            batch: if not 0, every other thread sends its guesses to
+            make_moves, batch guesses per call
+            legacy: True to start the games with a pickled history of one
+            move, which their first write converts to Moves
+        Returns:
+            the measures and the outcome counts"""
+        import cPickle as pickle
+        import endpoints
+        from google.appengine.ext import ndb
+        from models.game_class import BatchMoveForm, MakeMovesForm
+        from models.move_class import Move
+        import rules
+        api = self.api
+        self.service.create_user(self.request(api.USER_REQUEST,
+                                              user_name='contender'))
+        counts = defaultdict(int)
+        latencies = []
+        lock = threading.Lock()
+
+        def record(start, outcomes, written):
+            with lock:
+                elapsed = (time.time() - start) * 1000
+                for letter, outcome in outcomes:
+                    latencies.append(elapsed)
+                    counts[outcome] += 1
+                    if outcome == 'written':
+                        written.append(letter)
+
+        def batch_worker(key, letters, written):
+            for index in range(0, len(letters), batch):
+                guesses = letters[index:index + batch]
+                start = time.time()
+                response = self.service.make_moves(MakeMovesForm(
+                    moves=[BatchMoveForm(urlsafe_game_key=key, guess=letter)
+                           for letter in guesses]))
+                record(start, [(letter, 'written' if not item.error else
+                                'conflict' if 'busy' in item.error else
+                                'rejected')
+                               for letter, item in zip(guesses,
+                                                       response.items)],
+                       written)
+
+        def worker(key, letters, written):
+            for letter in letters:
+                start = time.time()
+                try:
+                    self.service.make_move(self.request(
+                        api.MAKE_MOVE_REQUEST, urlsafe_game_key=key,
+                        guess=letter))
+                    outcome = 'written'
+                except endpoints.ForbiddenException:
+                    outcome = 'rejected'
+                except endpoints.ConflictException:
+                    outcome = 'conflict'
+                record(start, [(letter, outcome)], written)
+
+        start = time.time()
+        for _ in range(games):
+            key = self.service.new_game(self.request(
+                api.NEW_GAME_REQUEST, user_name='contender',
+                category=random.choice(['1', '2', '3']))).urlsafe_key
+            letters = random.sample(string.ascii_lowercase, 26)
+            written = []
+            if legacy:
+                game = ndb.Key(urlsafe=key).get()
+                letter = letters.pop()
+                result = game.play(letter)
+                game.game_history = pickle.dumps(
+                    [{'guess': letter, 'answer': result.message}])
+                game.put()
+                written.append(letter)
+            threads = [threading.Thread(
+                target=batch_worker if batch and index % 2 else worker,
+                args=(key, letters[index::writers], written))
+                for index in range(writers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            game = ndb.Key(urlsafe=key).get(use_cache=False,
+                                            use_memcache=False)
+            guessed = game.missed_mask | game.correct_mask
+            counts['lost_updates'] += rules.count_letters(
+                rules.letters_mask(written) & ~guessed)
+            if not (len(written) == game.moves ==
+                    Move.query_game(game.key).count()):
+                counts['history_mismatches'] += 1
+        wall = time.time() - start
+        latencies.sort()
+        return {
+            'moves_per_second': counts['written'] / wall if wall else 0.0,
+            'p50_ms': percentile(latencies, 0.50),
+            'p99_ms': percentile(latencies, 0.99),
+            'counts': dict(counts),
+        }
+
+    def run_contention(self, writers, games, batch=0, legacy=False):
+        """Returns the measures of the contention benchmark"""
+        self.activate()
+        try:
+            return self.contend(writers, games, batch, legacy)
+        finally:
+            self.deactivate()
+
+    def run(self):
+        """Returns the measures of every endpoint, by endpoint name"""
+        self.activate()
+        try:
+            self.populate()
+            return dict((name, self.measure(call))
+                        for name, call in self.scenarios())
+        finally:
+            self.deactivate()
+
+
+def regressions(results, baseline):
+    """Returns the descriptions of the regressions from a baseline"""
+    found = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if result[key] > base[key] * (1 + LATENCY_TOLERANCE):
+                found.append('{} {}: {:.2f} > {:.2f}'.format(
+                    name, key, result[key], base[key]))
+        for rpc, count in sorted(result['rpcs_per_call'].items()):
+            if count > base['rpcs_per_call'].get(rpc, 0.0) + 1e-9:
+                found.append('{} {} per call: {:.2f} > {:.2f}'.format(
+                    name, rpc, count, base['rpcs_per_call'].get(rpc, 0.0)))
+    return found
+
+
+def report(results):
+    """Prints the measures of every endpoint"""
+    print '{:<24} {:>9} {:>9} {:>9} {:>9}  {}'.format(
+        'endpoint', 'calls/s', 'p50 ms', 'p95 ms', 'p99 ms', 'rpcs/call')
+    for name, result in sorted(results.items()):
+        print '{:<24} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f}  {}'.format(
+            name, result['throughput'], result['p50_ms'], result['p95_ms'],
+            result['p99_ms'], ', '.join(
+                '{}={:.2f}'.format(rpc, count) for rpc, count
+                in sorted(result['rpcs_per_call'].items())))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', required=True,
+                        help='path of the App Engine python SDK')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--games', type=int, default=3,
+                        help='games created per user')
+    parser.add_argument('--calls', type=int, default=200,
+                        help='calls per endpoint')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--contention', type=int, metavar='WRITERS',
+                        help='run the contention benchmark instead')
+    parser.add_argument('--contention-games', type=int, default=20)
+    parser.add_argument('--contention-batch', type=int, default=0,
+                        metavar='MOVES',
+                        help='guesses per make_moves call of every other '
+                             'contention thread, 0 for make_move only')
+    parser.add_argument('--contention-legacy', action='store_true',
+                        help='start the contention games with a pickled '
+                             'history')
+    args = parser.parse_args(argv)
+
+    setup_sdk(args.sdk)
+    random.seed(args.seed)
+    if args.contention:
+        result = Benchmark(args.users, args.games, args.calls,
+                           args.concurrency).run_contention(
+            args.contention, args.contention_games, args.contention_batch,
+            args.contention_legacy)
+        print '{} writers, {} games: {:.1f} moves/s, p50 {:.2f} ms, ' \
+              'p99 {:.2f} ms'.format(args.contention, args.contention_games,
+                                     result['moves_per_second'],
+                                     result['p50_ms'], result['p99_ms'])
+        print ', '.join('{}={}'.format(outcome, count) for outcome, count
+                        in sorted(result['counts'].items()))
+        return 1 if (result['counts'].get('lost_updates') or
+                     result['counts'].get('history_mismatches')) else 0
+    results = Benchmark(args.users, args.games, args.calls,
+                        args.concurrency).run()
+    report(results)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print 'Saved the baseline to {}'.format(args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as baseline_file:
+        found = regressions(results, json.load(baseline_file))
+    for regression in found:
+        print 'REGRESSION', regression
+    return 1 if found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,150 @@
+"""coalescer.py - Contention tolerant writes of the moves of a game.
+The moves are written with a compare-and-set on the version of the Game,
+and played again on a fresh copy of the Game, after a jittered backoff,
+when another write got there first. The concurrent moves of a game on an
+instance are coalesced: the first request writes, and the moves that
+arrive meanwhile are played together, in arrival order, and written in a
+single transaction by the next write."""
+import random
+import threading
+import time
+
+from google.appengine.api import datastore_errors
+
+from models.game_class import IllegalMove, StaleGame
+
+MAX_ATTEMPTS = 5
+# The first backoff; each attempt doubles it
+BACKOFF_SECONDS = 0.02
+# The longest a move waits for the request writing it, under the request
+# deadline
+RESULT_TIMEOUT_SECONDS = 50
+
+
+class GameNotFound(Exception):
+    """Raised when the Game of a move does not exist"""
+
+
+class GameBusy(Exception):
+    """Raised when the moves of a Game could not be written in
+    MAX_ATTEMPTS attempts"""
+
+
+class PendingMove(object):
+    """A move waiting to be written, and its outcome once it is: the
+    GameForm after the move or the error that rejected it"""
+
+    def __init__(self, guess):
+        self.guess = guess
+        self.form = None
+        self.error = None
+        self.done = threading.Event()
+
+    def result(self):
+        """Waits for the move to be written and returns its GameForm"""
+        if not self.done.wait(RESULT_TIMEOUT_SECONDS):
+            raise GameBusy('The game is busy, try again')
+        if self.error is not None:
+            raise self.error
+        return self.form
+
+
+_lock = threading.Lock()
+# The moves waiting for the current write of each game, by game key
+_pending = {}
+
+
+def backoff(attempt):
+    """Returns the seconds to wait before an attempt, with full jitter"""
+    return random.uniform(0, BACKOFF_SECONDS * 2 ** attempt)
+
+
+def fail(moves, error):
+    """Sets an error as the outcome of some moves"""
+    for move in moves:
+        move.form, move.error = None, error
+        move.done.set()
+
+
+def write(game_key, moves):
+    """Plays some moves on a fresh copy of a Game and writes them, trying
+    again on contention. Sets the outcome of every move"""
+    try:
+        for attempt in range(MAX_ATTEMPTS):
+            if attempt:
+                time.sleep(backoff(attempt))
+            game = game_key.get(use_cache=False, use_memcache=not attempt)
+            if game is None:
+                for move in moves:
+                    move.error = GameNotFound('Game not found!')
+                return
+            results = []
+            for move in moves:
+                move.form, move.error = None, None
+                try:
+                    result = game.play(move.guess)
+                except IllegalMove, e:
+                    move.error = e
+                    continue
+                move.form = game.to_form(result.message)
+                if result.letter:
+                    results.append(result)
+            if not results:
+                return
+            try:
+                game.add_moves(results)
+                return
+            except (StaleGame, datastore_errors.TransactionFailedError):
+                continue
+        for move in moves:
+            move.form, move.error = None, GameBusy(
+                'The game is busy, try again')
+    except Exception, e:
+        fail(moves, e)
+    except BaseException:
+        # DeadlineExceededError is not an Exception: the moves are failed
+        # and it still ends the request
+        fail(moves, GameBusy('The game is busy, try again'))
+        raise
+    finally:
+        for move in moves:
+            move.done.set()
+
+
+def make_move(game_key, guess):
+    """Plays a guess in a Game and writes it, coalesced with the other
+    moves of the Game made concurrently on this instance.
+    Returns:
+        the GameForm after the move
+    Raises:
+        IllegalMove: If the game does not accept the guess.
+        GameNotFound: If the Game does not exist.
+        GameBusy: If the move could not be written because of contention."""
+    move = PendingMove(guess)
+    with _lock:
+        queued = _pending.get(game_key)
+        if queued is not None:
+            queued.append(move)
+        else:
+            _pending[game_key] = [move]
+    if queued is None:
+        # This request writes, until no move of the game is waiting
+        finished = False
+        try:
+            while True:
+                with _lock:
+                    moves = _pending[game_key]
+                    if not moves:
+                        del _pending[game_key]
+                        finished = True
+                        break
+                    _pending[game_key] = []
+                write(game_key, moves)
+        finally:
+            if not finished:
+                # The request is ending, so the moves still waiting are
+                # failed and the next move of the game writes again
+                with _lock:
+                    moves = _pending.pop(game_key, [])
+                fail(moves, GameBusy('The game is busy, try again'))
+    return move.result()
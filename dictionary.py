@@ -0,0 +1,222 @@
+"""dictionary.py - The word dictionary: the categories of secret words,
+loaded from the data files in the words folder into a compact store
+indexed by category and word length.
+Each category is a file named <id>_<name>.txt with one word per line.
+Run this file before deploying to precompile the store:
+    python dictionary.py"""
+import json
+import os
+import random
+import re
+import struct
+from array import array
+
+try:
+    import mmap
+except ImportError:
+    # Not every runtime allows memory-mapped files; the store is then read
+    # into memory
+    mmap = None
+
+WORDS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'words')
+STORE_PATH = os.path.join(WORDS_DIR, 'dictionary.bin')
+STORE_MAGIC = 'HMD1'
+WORD_FILE = re.compile(r'^(\d+)_([a-z]+)\.txt$')
+VALID_WORD = re.compile(r'^[a-z]+$')
+
+
+class Category(object):
+    """A word category: its id and name, the range of its words in the
+    store and, for each word length, the range of the words that long"""
+
+    def __init__(self, id, name, start, end, lengths):
+        self.id = id
+        self.name = name
+        self.start = start
+        self.end = end
+        self.lengths = lengths
+
+    def __len__(self):
+        return self.end - self.start
+
+
+def read_word_files(words_dir=WORDS_DIR):
+    """Reads the category data files.
+    Args:
+        words_dir: the folder of the data files
+    Returns:
+        A list of (id, name, words) tuples sorted by id
+    Raises:
+        ValueError: If two files have the same id or a word is not made
+        of lowercase letters only."""
+    categories = {}
+    for filename in sorted(os.listdir(words_dir)):
+        match = WORD_FILE.match(filename)
+        if not match:
+            continue
+        category_id = int(match.group(1))
+        if category_id in categories:
+            raise ValueError('Duplicate category id {}'.format(category_id))
+        words = set()
+        with open(os.path.join(words_dir, filename)) as word_file:
+            for line in word_file:
+                word = line.strip().lower()
+                if not word:
+                    continue
+                if not VALID_WORD.match(word):
+                    raise ValueError('Invalid word {!r} in {}'.format(
+                        word, filename))
+                words.add(word)
+        categories[category_id] = (category_id, match.group(2), words)
+    return [categories[category_id] for category_id in sorted(categories)]
+
+
+def build_store(categories):
+    """Compiles the categories into the store format: the magic string,
+    the length of a JSON header describing the categories, the header,
+    an array of word offsets and the concatenated words. The words of a
+    category are contiguous and sorted by length, so every (category,
+    length) pair is a range of word indexes.
+    Args:
+        categories: a list of (id, name, words) tuples
+    Returns:
+        The store as a byte string"""
+    offsets = array('I', [0])
+    blob = []
+    header = {'categories': []}
+    for category_id, name, words in categories:
+        start = len(offsets) - 1
+        lengths = {}
+        for word in sorted(words, key=lambda w: (len(w), w)):
+            index = len(offsets) - 1
+            first, _ = lengths.get(len(word), (index, index))
+            lengths[len(word)] = (first, index + 1)
+            blob.append(word)
+            offsets.append(offsets[-1] + len(word))
+        header['categories'].append({
+            'id': category_id,
+            'name': name,
+            'start': start,
+            'end': len(offsets) - 1,
+            'lengths': dict((str(length), span)
+                            for length, span in lengths.items())})
+    header['count'] = len(offsets) - 1
+    header = json.dumps(header, sort_keys=True)
+    return (STORE_MAGIC + struct.pack('<I', len(header)) + header +
+            offsets.tostring() + ''.join(blob))
+
+
+class Dictionary(object):
+    """Read-only view over a compiled store. Words are sliced out of the
+    store on demand, so a memory-mapped store is never fully loaded."""
+
+    def __init__(self, data):
+        if data[:4] != STORE_MAGIC:
+            raise ValueError('Not a dictionary store')
+        header_length = struct.unpack_from('<I', data, 4)[0]
+        header = json.loads(data[8:8 + header_length])
+        self._data = data
+        self._count = header['count']
+        self._offsets = 8 + header_length
+        self._words = self._offsets + 4 * (self._count + 1)
+        self.categories = [
+            Category(category['id'], str(category['name']),
+                     category['start'], category['end'],
+                     dict((int(length), tuple(span)) for length, span
+                          in category['lengths'].items()))
+            for category in header['categories']]
+        self._by_id = dict((category.id, category)
+                           for category in self.categories)
+        self._by_name = dict((category.name, category)
+                             for category in self.categories)
+
+    def __len__(self):
+        return self._count
+
+    def word(self, index):
+        """Returns the word at an index of the store"""
+        start, end = struct.unpack_from('<II', self._data,
+                                        self._offsets + 4 * index)
+        return self._data[self._words + start:self._words + end]
+
+    def word_block(self, start, end):
+        """Returns the words from index start to index end concatenated,
+        as a single slice of the store"""
+        first = struct.unpack_from('<I', self._data, self._offsets + 4 * start)
+        last = struct.unpack_from('<I', self._data, self._offsets + 4 * end)
+        return self._data[self._words + first[0]:self._words + last[0]]
+
+    def category(self, key):
+        """Returns the Category with that id or name, or None.
+        Args:
+            key: an integer id, a string of digits or a category name"""
+        if isinstance(key, basestring):
+            key = key.strip().lower()
+            if not key.isdigit():
+                return self._by_name.get(key)
+        try:
+            return self._by_id.get(int(key))
+        except (TypeError, ValueError):
+            return None
+
+    def words(self, category):
+        """Returns all the words of a category"""
+        category = self._get_category(category)
+        return [self.word(index)
+                for index in range(category.start, category.end)]
+
+    def random_word(self, category, length=None):
+        """Returns a random word of a category, optionally of a given
+        length, in constant time.
+        Raises:
+            ValueError: If the category does not exist or has no words of
+            that length."""
+        category = self._get_category(category)
+        if length is None:
+            start, end = category.start, category.end
+        else:
+            start, end = category.lengths.get(length, (0, 0))
+        if start == end:
+            raise ValueError('No words to choose from')
+        return self.word(random.randrange(start, end))
+
+    def _get_category(self, key):
+        category = self.category(key)
+        if category is None:
+            raise ValueError('Unknown category {!r}'.format(key))
+        return category
+
+
+def load(path=STORE_PATH):
+    """Returns the Dictionary of the precompiled store, memory-mapped if
+    possible, or compiles one from the data files if there is no store"""
+    if not os.path.exists(path):
+        return Dictionary(build_store(read_word_files()))
+    with open(path, 'rb') as store:
+        if mmap is not None:
+            try:
+                return Dictionary(mmap.mmap(store.fileno(), 0,
+                                            access=mmap.ACCESS_READ))
+            except (EnvironmentError, ValueError):
+                store.seek(0)
+        return Dictionary(store.read())
+
+
+_dictionary = None
+
+
+def get_dictionary():
+    """Returns the Dictionary shared by the instance, loading it on first
+    use"""
+    global _dictionary
+    if _dictionary is None:
+        _dictionary = load()
+    return _dictionary
+
+
+if __name__ == '__main__':
+    store = build_store(read_word_files())
+    with open(STORE_PATH, 'wb') as store_file:
+        store_file.write(store)
+    print 'Wrote {} words to {}'.format(len(Dictionary(store)), STORE_PATH)
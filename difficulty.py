@@ -0,0 +1,242 @@
+"""difficulty.py - The difficulty of the words of the dictionary, and the
+sampling of the secret words by difficulty level.
+Each word gets a difficulty score within its category, from the number of
+its distinct letters (the fewer letters to find, the fewer guesses hit),
+the rarity of its letters in the dictionary and its solve rate in
+simulated games. The scores are computed offline and saved to a file;
+words added since are scored on their letters only. Each instance builds,
+once per category, a Vose alias table per level, weighting the words by
+how close their difficulty rank is to the level, so a word is drawn in
+constant time. Run this file before deploying to score the words:
+    python difficulty.py [--strategy random] [--games-per-word 50]
+        [--attempts 10] [--processes N] [--seed 0]"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+from collections import OrderedDict, defaultdict
+
+import rules
+from dictionary import get_dictionary, WORDS_DIR
+
+SCORES_PATH = os.path.join(WORDS_DIR, 'difficulty.json')
+# The difficulty rank each level favors, from 0 (easiest) to 1 (hardest)
+LEVELS = OrderedDict([('easy', 0.0), ('medium', 0.5), ('hard', 1.0)])
+# How far from the rank of its level a word is still likely to be drawn
+LEVEL_WIDTH = 0.25
+# The weights of the features in the score of a word
+LETTER_WEIGHTS = {'few_letters': 0.5, 'rarity': 0.5}
+SIMULATED_WEIGHTS = {'few_letters': 0.25, 'rarity': 0.25, 'unsolved': 0.5}
+# The draws choose_word makes to avoid the recent words of a player
+MAX_DRAWS = 8
+
+
+def ranks(values):
+    """Returns the percentile rank of each value among the values, from 0
+    to 1, ties getting the mean of their ranks"""
+    if len(values) < 2:
+        return [0.5] * len(values)
+    order = sorted(range(len(values)), key=lambda index: values[index])
+    result = [0.0] * len(values)
+    start = 0
+    while start < len(order):
+        end = start
+        while (end + 1 < len(order) and
+               values[order[end + 1]] == values[order[start]]):
+            end += 1
+        for position in range(start, end + 1):
+            result[order[position]] = (start + end) / 2.0 / (len(values) - 1)
+        start = end + 1
+    return result
+
+
+def letter_frequencies(words):
+    """Returns the frequency of each letter in some words"""
+    counts = defaultdict(int)
+    for word in words:
+        for letter in word:
+            counts[letter] += 1
+    total = float(sum(counts.values()))
+    return dict((letter, count / total) for letter, count in counts.items())
+
+
+def letter_rarity(word, frequencies):
+    """Returns the mean information content of the distinct letters of a
+    word: the rarer its letters, the higher"""
+    letters = rules.mask_letters(rules.letters_mask(word))
+    return sum(-math.log(frequencies[letter])
+               for letter in letters) / len(letters)
+
+
+def score_words(words, frequencies, solve_rates=None):
+    """Returns the difficulty scores of the words of a category, from 0
+    (easiest) to 1 (hardest).
+    Args:
+        words: the words of the category
+        frequencies: the letter frequencies of the dictionary
+        solve_rates: the simulated solve rate of each word, if any"""
+    features = {
+        'few_letters': ranks([-rules.count_letters(rules.letters_mask(word))
+                              for word in words]),
+        'rarity': ranks([letter_rarity(word, frequencies)
+                         for word in words]),
+    }
+    weights = LETTER_WEIGHTS
+    if solve_rates is not None:
+        features['unsolved'] = ranks([-solve_rates[word] for word in words])
+        weights = SIMULATED_WEIGHTS
+    return [sum(weights[name] * features[name][index] for name in weights)
+            for index in range(len(words))]
+
+
+class AliasTable(object):
+    """Draws an index with a probability proportional to its weight in
+    constant time, with Vose's alias method: every slot holds the
+    probability of keeping its own index and the index it gives the rest
+    of its chance to"""
+
+    def __init__(self, weights):
+        count = len(weights)
+        total = float(sum(weights))
+        scaled = [weight * count / total for weight in weights]
+        self.keep = [1.0] * count
+        self.alias = range(count)
+        small = [index for index, p in enumerate(scaled) if p < 1.0]
+        large = [index for index, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.keep[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+
+    def draw(self, rng=random):
+        index = rng.randrange(len(self.keep))
+        return index if rng.random() < self.keep[index] else self.alias[index]
+
+
+class CategoryIndex(object):
+    """The words of a category with an AliasTable per difficulty level"""
+
+    def __init__(self, category, scores):
+        dictionary = get_dictionary()
+        self.start = category.start
+        words = [dictionary.word(index)
+                 for index in range(category.start, category.end)]
+        stored = scores.get(str(category.id), {})
+        if all(word in stored for word in words):
+            difficulty = [stored[word] for word in words]
+        else:
+            # Score the words missing from the file on their letters,
+            # ranked with the others
+            letters = score_words(words, letter_frequencies(
+                dictionary.word(index) for index in range(len(dictionary))))
+            difficulty = [stored.get(word, letters[index])
+                          for index, word in enumerate(words)]
+        rank = ranks(difficulty)
+        self.tables = dict(
+            (level, AliasTable([math.exp(-((r - target) / LEVEL_WIDTH) ** 2)
+                                for r in rank]))
+            for level, target in LEVELS.items())
+
+    def draw(self, level):
+        """Returns the store index of a word drawn for a level"""
+        return self.start + self.tables[level].draw()
+
+
+def load_scores(path=SCORES_PATH):
+    """Returns the scores of the words by category id, empty if the words
+    were never scored"""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as scores_file:
+        return json.load(scores_file)['categories']
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def category_index(category):
+    """Returns the CategoryIndex of a category, built once per instance"""
+    if category.id not in _indexes:
+        index = CategoryIndex(category, load_scores())
+        with _indexes_lock:
+            _indexes.setdefault(category.id, index)
+    return _indexes[category.id]
+
+
+def choose_word(category_id, level=None, avoid=()):
+    """Draws the secret word of a new game, of a difficulty level or
+    uniformly, drawing again, a few times at most, the words to avoid.
+    Args:
+        category_id: the id of the category
+        level: one of LEVELS, or None for any difficulty
+        avoid: the words recently played, as a set
+    Raises:
+        ValueError: If the category or the level does not exist."""
+    dictionary = get_dictionary()
+    category = dictionary.category(category_id)
+    if category is None:
+        raise ValueError('Unknown category {!r}'.format(category_id))
+    if level is not None and level not in LEVELS:
+        raise ValueError('Unknown difficulty {!r}'.format(level))
+    index = category_index(category) if level is not None else None
+    for _ in range(MAX_DRAWS):
+        if index is None:
+            word = dictionary.random_word(category.id)
+        else:
+            word = dictionary.word(index.draw(level))
+        if word not in avoid:
+            break
+    return word
+
+
+def main(argv):
+    # Only the offline scoring plays games
+    import simulate
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--strategy', choices=sorted(simulate.STRATEGIES),
+                        default='random')
+    parser.add_argument('--games-per-word', type=int, default=50)
+    parser.add_argument('--attempts', type=int, default=10,
+                        help='attempts allowed in the simulated games')
+    parser.add_argument('--processes', type=int,
+                        default=simulate.multiprocessing.cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    results = simulate.simulate(args.strategy, args.games_per_word,
+                                args.seed, args.processes)
+    solve_rates = dict(((category_id, word),
+                        simulate.win_rate(missed, args.attempts))
+                       for category_id, word, missed in results)
+    dictionary = get_dictionary()
+    frequencies = letter_frequencies(
+        dictionary.word(index) for index in range(len(dictionary)))
+    categories = {}
+    for category in dictionary.categories:
+        words = dictionary.words(category.id)
+        scores = score_words(words, frequencies, dict(
+            (word, solve_rates[(category.id, word)]) for word in words))
+        categories[str(category.id)] = dict(zip(words, scores))
+        ordered = sorted(words, key=dict(zip(words, scores)).get)
+        print '{}: easiest {}, hardest {}'.format(
+            category.name, ', '.join(ordered[:3]),
+            ', '.join(reversed(ordered[-3:])))
+    with open(SCORES_PATH, 'w') as scores_file:
+        json.dump({'strategy': args.strategy,
+                   'games_per_word': args.games_per_word,
+                   'attempts': args.attempts,
+                   'categories': categories}, scores_file, indent=1,
+                  sort_keys=True)
+    print 'Wrote the scores of {} words to {}'.format(len(dictionary),
+                                                     SCORES_PATH)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,65 @@
+"""export_cli.py - Local export of the Games, Scores and Users.
+Runs the parts of an analytics export of exports.py one after the other in
+this process, against the datastore stub loaded from the datastore file of
+the development server, and writes the files to a local folder. Usage:
+    python export_cli.py --sdk PATH_TO_APPENGINE_SDK --datastore PATH
+        [--sqlite] [--app-id dev~hangman-1346] [--out exports_out]
+        [--kinds Game Score User] [--full]
+The checkpoints and watermarks of the runs are written to the datastore
+stub, so a run without --full exports the entities updated since the last
+run that completed."""
+import argparse
+import os
+import sys
+
+from benchmark import setup_sdk, ROOT
+
+DEFAULT_APP_ID = 'dev~hangman-1346'
+DEFAULT_OUT = os.path.join(ROOT, 'exports_out')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', required=True,
+                        help='path of the App Engine python SDK')
+    parser.add_argument('--datastore', required=True,
+                        help='datastore file of the development server')
+    parser.add_argument('--sqlite', action='store_true',
+                        help='the datastore file is a sqlite datastore')
+    parser.add_argument('--app-id', default=DEFAULT_APP_ID)
+    parser.add_argument('--out', default=DEFAULT_OUT,
+                        help='folder of the exported files')
+    parser.add_argument('--kinds', nargs='+',
+                        help='kinds to export, all of them by default')
+    parser.add_argument('--full', action='store_true',
+                        help='export every entity, not only the updated ones')
+    args = parser.parse_args(argv)
+
+    setup_sdk(args.sdk)
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id=args.app_id, overwrite=True)
+    bed.init_datastore_v3_stub(datastore_file=args.datastore,
+                               use_sqlite=args.sqlite)
+    bed.init_memcache_stub()
+    try:
+        import exports
+        try:
+            run, checkpoints = exports.export_now(
+                exports.LocalStorage(args.out), args.kinds, args.full)
+        except ValueError, e:
+            print e
+            return 1
+        for kind in [checkpoint.status() for checkpoint in checkpoints]:
+            print '{kind}: {rows} rows in {parts} parts, updated after ' \
+                  '{since} until {until}'.format(**kind)
+        print 'Written to', os.path.join(args.out, exports.EXPORTS_FOLDER,
+                                         run)
+    finally:
+        bed.deactivate()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,447 @@
+"""exports.py - Streaming bulk export of the Games, Scores and Users for
+analytics. An export walks the entities of each kind with cursor queries,
+in batches of bounded size, and streams them into parts: a gzipped NDJSON
+file with one entity per line, and one binary file per column holding the
+column of the part as a little endian array that numpy.fromfile reads.
+Each part is written by one task of the exports queue, which checkpoints
+the cursor after it and queues the next part in the same transaction, so
+the memory used does not depend on the number of entities, a failed task
+is retried from its part and a stopped run is resumed with resume. When a
+kind is done, its manifest.json lists its parts and the types of its
+columns. An incremental export only walks the entities updated since the
+last completed export of the kind; the rows of the runs are upserts by
+key. The local CLI, export_cli.py, runs the same parts against the
+datastore stub."""
+import gzip
+import json
+import os
+import struct
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from google.appengine.api import app_identity
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models.export_class import ExportCheckpoint, ExportWatermark
+from models.game_class import Game
+from models.score_class import Score
+from models.user_class import User
+
+EXPORTS_QUEUE = 'exports'
+EXPORT_PART_URL = '/tasks/export_part'
+EXPORTS_FOLDER = 'exports'
+BATCH_SIZE = 500
+# The batches streamed into each part, by a single task
+PART_BATCHES = 20
+# The entities updated less than this before an export starts are left to
+# the next export, so the writes still committing are not skipped
+UPDATE_LAG = timedelta(minutes=1)
+EPOCH = datetime(1970, 1, 1)
+
+
+def microseconds(value):
+    """Returns the microseconds from the epoch to a datetime"""
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + \
+        delta.microseconds
+
+
+def days(value):
+    """Returns the days from the epoch to a date"""
+    return (value - EPOCH.date()).days
+
+
+class ColumnType(object):
+    """The type of a column: the struct format and the numpy dtype of its
+    binary file, the number stored for None and the conversions of its
+    values to numbers and to JSON. Strings have no struct format: they are
+    stored as a UTF-8 file and an int64 file of the end offset of every
+    value in it"""
+
+    def __init__(self, name, struct_format, dtype, null, number=None,
+                 to_json=None, unit=None):
+        self.name = name
+        self.struct_format = struct_format
+        self.dtype = dtype
+        self.null = null
+        self.number = number or (lambda value: value)
+        self.to_json = to_json or (lambda value: value)
+        self.unit = unit
+
+
+INT = ColumnType('int', 'q', '<i8', -1)
+FLOAT = ColumnType('float', 'd', '<f8', float('nan'))
+BOOL = ColumnType('bool', 'b', '|i1', -1, number=int)
+TIMESTAMP = ColumnType('timestamp', 'q', '<i8', -1, number=microseconds,
+                       to_json=lambda value: value.isoformat(),
+                       unit='microseconds since 1970-01-01')
+DATE = ColumnType('date', 'q', '<i8', -1, number=days,
+                  to_json=lambda value: value.isoformat(),
+                  unit='days since 1970-01-01')
+STRING = ColumnType('string', None, '<i8', '')
+
+
+class Column(object):
+    """A column of an exported kind: its name, its type and the function
+    reading its value from an entity"""
+
+    def __init__(self, name, column_type, value):
+        self.name = name
+        self.type = column_type
+        self.value = value
+
+    def files(self, part):
+        """Returns the paths of the files of the column in a part"""
+        if self.type is STRING:
+            return ['{}/{}.offsets.bin'.format(part, self.name),
+                    '{}/{}.utf8'.format(part, self.name)]
+        return ['{}/{}.bin'.format(part, self.name)]
+
+    def describe(self):
+        """Returns the description of the column in the manifest"""
+        description = {'name': self.name,
+                       'type': self.type.name,
+                       'dtype': self.type.dtype,
+                       'files': self.files('{part}')}
+        if self.type is STRING:
+            description['offsets'] = 'end offset of each value'
+        else:
+            description['null'] = self.type.null
+        if self.type.unit:
+            description['unit'] = self.type.unit
+        return description
+
+
+def urlsafe(key):
+    """Returns the urlsafe string of a key, or None"""
+    return key.urlsafe() if key else None
+
+
+# The exported kinds: the model and the columns of each one
+KINDS = OrderedDict([
+    ('Game', (Game, [
+        Column('key', STRING, lambda game: game.key.urlsafe()),
+        Column('user', STRING, lambda game: urlsafe(game.user)),
+        Column('user_name', STRING, lambda game: game.user_name),
+        Column('word_category', INT, lambda game: game.word_category),
+        Column('word', STRING, lambda game: game.secretWord),
+        Column('difficulty', STRING, lambda game: game.difficulty),
+        Column('attempts_allowed', INT, lambda game: game.attempts_allowed),
+        Column('attempts_remaining', INT,
+               lambda game: game.attempts_remaining),
+        Column('game_over', BOOL, lambda game: game.game_over),
+        Column('game_cancelled', BOOL, lambda game: game.game_cancelled),
+        Column('moves', INT, lambda game: game.moves),
+        Column('hints_used', INT, lambda game: game.hints_used),
+        Column('updated', TIMESTAMP, lambda game: game.updated),
+    ])),
+    ('Score', (Score, [
+        Column('key', STRING, lambda score: score.key.urlsafe()),
+        Column('game', STRING, lambda score: urlsafe(score.key.parent())),
+        Column('user', STRING, lambda score: urlsafe(score.user)),
+        Column('user_name', STRING, lambda score: score.user_name),
+        Column('date', DATE, lambda score: score.date),
+        Column('won', BOOL, lambda score: score.won),
+        Column('guesses', INT, lambda score: score.guesses),
+        Column('word_category', INT, lambda score: score.word_category),
+        Column('updated', TIMESTAMP, lambda score: score.updated),
+    ])),
+    ('User', (User, [
+        Column('key', STRING, lambda user: user.key.urlsafe()),
+        Column('name', STRING, lambda user: user.name),
+        Column('victories', INT, lambda user: user.victories),
+        Column('losses', INT, lambda user: user.losses),
+        Column('ratio', FLOAT, lambda user: user.ratio),
+        Column('updated', TIMESTAMP, lambda user: user.updated),
+    ])),
+])
+
+
+class CloudStorage(object):
+    """Writes the export files to a Cloud Storage bucket, the EXPORT_BUCKET
+    of app.yaml or the default bucket of the app, with the
+    GoogleAppEngineCloudStorageClient library vendored in lib. A file is
+    created only when it is closed"""
+
+    def __init__(self, bucket=None):
+        self.bucket = (bucket or os.environ.get('EXPORT_BUCKET') or
+                       app_identity.get_default_gcs_bucket_name())
+
+    def open(self, path):
+        import cloudstorage
+        return cloudstorage.open('/{}/{}'.format(self.bucket, path), 'w')
+
+
+class LocalStorage(object):
+    """Writes the export files to a local folder"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def open(self, path):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        return open(path, 'wb')
+
+
+class PartWriter(object):
+    """Streams batches of entities into the NDJSON file and the column
+    files of a part"""
+
+    def __init__(self, storage, part, columns):
+        self.columns = columns
+        self.ndjson_file = storage.open(part + '.ndjson.gz')
+        self.ndjson = gzip.GzipFile(filename='', mode='wb',
+                                    fileobj=self.ndjson_file)
+        self.files = [[storage.open(path) for path in column.files(part)]
+                      for column in columns]
+        # The end offset of the last string written, by column
+        self.offsets = [0] * len(columns)
+
+    def write(self, entities):
+        """Appends a batch of entities"""
+        values = [[column.value(entity) for entity in entities]
+                  for column in self.columns]
+        for row in zip(*values):
+            self.ndjson.write(json.dumps(OrderedDict(
+                (column.name, None if value is None else
+                 column.type.to_json(value))
+                for column, value in zip(self.columns, row)),
+                separators=(',', ':')) + '\n')
+        for index, (column, files) in enumerate(zip(self.columns,
+                                                    self.files)):
+            if column.type is STRING:
+                data = [(value or u'').encode('utf-8')
+                        for value in values[index]]
+                ends = []
+                for value in data:
+                    self.offsets[index] += len(value)
+                    ends.append(self.offsets[index])
+                files[0].write(self.pack('q', ends))
+                files[1].write(''.join(data))
+            else:
+                files[0].write(self.pack(column.type.struct_format, [
+                    column.type.null if value is None else
+                    column.type.number(value) for value in values[index]]))
+
+    @staticmethod
+    def pack(struct_format, numbers):
+        """Returns the bytes of a little endian array of numbers"""
+        return struct.pack('<{}{}'.format(len(numbers), struct_format),
+                           *numbers)
+
+    def close(self):
+        self.ndjson.close()
+        self.ndjson_file.close()
+        for files in self.files:
+            for column_file in files:
+                column_file.close()
+
+
+def kind_folder(checkpoint):
+    """Returns the path of the folder of the files of a kind in a run"""
+    return '{}/{}/{}'.format(EXPORTS_FOLDER, checkpoint.run, checkpoint.kind)
+
+
+def part_name(part):
+    """Returns the name of the files of a part"""
+    return 'part-{:05d}'.format(part)
+
+
+def export_query(model, checkpoint):
+    """Returns the query of the entities of an export: all of them by key
+    for a full export, the ones updated in its time range by update time
+    for an incremental one"""
+    if checkpoint.since is None:
+        return model.query().order(model.key)
+    return model.query(model.updated > checkpoint.since,
+                       model.updated <= checkpoint.until).order(
+        model.updated)
+
+
+def write_part(checkpoint, storage):
+    """Streams the next part of the export of a kind into its files,
+    without caching the entities read.
+    Returns:
+        the cursor after the part, True if there are more entities and the
+        number of rows written"""
+    model, columns = KINDS[checkpoint.kind]
+    query = export_query(model, checkpoint)
+    cursor = Cursor(urlsafe=checkpoint.cursor) if checkpoint.cursor else None
+    writer = PartWriter(storage, '{}/{}'.format(
+        kind_folder(checkpoint), part_name(checkpoint.parts)), columns)
+    rows = 0
+    more = True
+    for _ in range(PART_BATCHES):
+        entities, next_cursor, more = query.fetch_page(
+            BATCH_SIZE, start_cursor=cursor, use_cache=False,
+            use_memcache=False)
+        writer.write(entities)
+        rows += len(entities)
+        cursor = next_cursor or cursor
+        if not (more and next_cursor):
+            more = False
+            break
+    # A part left unclosed by a failure is never created, and is written
+    # again when the task is retried
+    writer.close()
+    return cursor, more, rows
+
+
+def write_manifest(storage, checkpoint, part_rows):
+    """Writes the manifest of the export of a kind"""
+    columns = KINDS[checkpoint.kind][1]
+    manifest = {
+        'run': checkpoint.run,
+        'kind': checkpoint.kind,
+        'since': checkpoint.since.isoformat() if checkpoint.since else None,
+        'until': checkpoint.until.isoformat(),
+        'rows': sum(part_rows),
+        'parts': [{'name': part_name(part), 'rows': rows}
+                  for part, rows in enumerate(part_rows)],
+        'ndjson': '{part}.ndjson.gz',
+        'columns': [column.describe() for column in columns],
+    }
+    manifest_file = storage.open(kind_folder(checkpoint) + '/manifest.json')
+    manifest_file.write(json.dumps(manifest, indent=2, sort_keys=True))
+    manifest_file.close()
+
+
+def queue_part(checkpoint, transactional=False):
+    """Queues the task of the next part of the export of a kind"""
+    taskqueue.add(url=EXPORT_PART_URL,
+                  params={'checkpoint': checkpoint.key.id(),
+                          'generation': checkpoint.generation,
+                          'part': checkpoint.parts},
+                  queue_name=EXPORTS_QUEUE,
+                  transactional=transactional)
+
+
+def create(kinds=None, full=False):
+    """Creates the checkpoints of a new export run.
+    Args:
+        kinds: the names of the kinds to export, all of them by default
+        full: True to export every entity, instead of the ones updated
+        since the last export of each kind
+    Returns:
+        the id of the run and its checkpoints
+    Raises:
+        ValueError: If a kind cannot be exported."""
+    kinds = kinds or list(KINDS)
+    for kind in kinds:
+        if kind not in KINDS:
+            raise ValueError('Unknown kind {!r}'.format(kind))
+    run = 'export-{}'.format(int(time.time()))
+    until = datetime.utcnow() - UPDATE_LAG
+    checkpoints = [ExportCheckpoint(
+        key=ExportCheckpoint.key_for(run, kind),
+        run=run,
+        kind=kind,
+        since=None if full else ExportWatermark.get_since(kind),
+        until=until) for kind in kinds]
+    ndb.put_multi(checkpoints)
+    return run, checkpoints
+
+
+def start(kinds=None, full=False):
+    """Starts an export run, exporting the kinds in parallel.
+    Returns:
+        the id of the run
+    Raises:
+        ValueError: If a kind cannot be exported."""
+    run, checkpoints = create(kinds, full)
+    for checkpoint in checkpoints:
+        queue_part(checkpoint)
+    return run
+
+
+def export_part(checkpoint_id, generation, part, storage, chain=True):
+    """Writes the next part of the export of a kind and moves the
+    checkpoint, in the same transaction as the task of the following part
+    is queued, or as the watermark of the kind is moved when the kind is
+    done. The task of a part already written, or of an older generation
+    of the checkpoint, does nothing.
+    Args:
+        chain: False not to queue the task of the following part
+    Returns:
+        the checkpoint, or None if the part was already written"""
+    key = ndb.Key(ExportCheckpoint, checkpoint_id)
+    checkpoint = key.get()
+    if (checkpoint is None or checkpoint.done or
+            checkpoint.generation != generation or checkpoint.parts != part):
+        return None
+    cursor, more, rows = write_part(checkpoint, storage)
+    if not more:
+        write_manifest(storage, checkpoint, checkpoint.part_rows + [rows])
+
+    @ndb.transactional(xg=True)
+    def save():
+        current = key.get()
+        if current.generation != generation or current.parts != part:
+            return None
+        current.cursor = cursor.urlsafe() if cursor else None
+        current.part_rows.append(rows)
+        current.done = not more
+        current.put()
+        if current.done:
+            watermark = ExportWatermark.get_by_id(current.kind)
+            if watermark is None or watermark.until < current.until:
+                ExportWatermark(id=current.kind, until=current.until,
+                                run=current.run).put()
+        elif chain:
+            queue_part(current, transactional=True)
+        return current
+
+    return save()
+
+
+def run_part(checkpoint_id, generation, part):
+    """Writes a part of an export run to Cloud Storage, from its task"""
+    export_part(checkpoint_id, generation, part, CloudStorage())
+
+
+def export_now(storage, kinds=None, full=False):
+    """Runs a whole export in this process, part after part.
+    Returns:
+        the id of the run and its completed checkpoints"""
+    run, checkpoints = create(kinds, full)
+    done = []
+    for checkpoint in checkpoints:
+        while not checkpoint.done:
+            checkpoint = export_part(
+                checkpoint.key.id(), checkpoint.generation, checkpoint.parts,
+                storage, chain=False) or checkpoint.key.get()
+        done.append(checkpoint)
+    return run, done
+
+
+def resume(run):
+    """Queues again the unfinished kinds of a run from their checkpoints,
+    after their task chain stopped. The tasks still queued for them are
+    then ignored.
+    Returns:
+        the number of kinds resumed"""
+    resumed = 0
+    for checkpoint in ExportCheckpoint.query(ExportCheckpoint.run == run):
+        if checkpoint.done:
+            continue
+
+        @ndb.transactional
+        def restart():
+            current = checkpoint.key.get()
+            current.generation += 1
+            current.put()
+            queue_part(current, transactional=True)
+        restart()
+        resumed += 1
+    return resumed
+
+
+def status(run):
+    """Returns the progress of the kinds of a run"""
+    return [checkpoint.status() for checkpoint in
+            ExportCheckpoint.query(ExportCheckpoint.run == run)]
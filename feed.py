@@ -0,0 +1,77 @@
+"""feed.py - Change notification of the games, for the long polls of
+get_game_changes.
+The state of a Game, the sequence number of its last Move and whether it
+is finished (over or cancelled), is kept in memcache and moved forward
+after every write of its moves, with a compare-and-set so a late write
+never moves it back. A watcher polls the state in memcache until the Game
+has moves it has not seen, is finished, or its timeout passes, so a
+waiting watcher costs memcache reads only; the Game is read from the
+datastore only when its state is missing from memcache."""
+import time
+
+from google.appengine.api import memcache
+
+MEMCACHE_GAME_STATE_PREFIX = 'GAME_STATE:'
+# The first interval between two polls of a watcher; each poll makes the
+# next interval longer, up to MAX_POLL_SECONDS
+POLL_SECONDS = 0.1
+MAX_POLL_SECONDS = 1.0
+NOTIFY_ATTEMPTS = 5
+
+
+def state(game):
+    """Returns the (sequence, finished) state of a Game"""
+    return game.moves, bool(game.game_over or game.game_cancelled)
+
+
+def notify(games):
+    """Moves the states of Games forward. Call it after the Games are
+    written. A state is only replaced by a later one: more moves, or the
+    same moves and finished.
+    Args:
+        games: the written Games"""
+    client = memcache.Client()
+    pending = dict((MEMCACHE_GAME_STATE_PREFIX + game.key.urlsafe(),
+                    state(game)) for game in games)
+    for _ in range(NOTIFY_ATTEMPTS):
+        current = client.get_multi(pending.keys(), for_cas=True)
+        missing = dict((key, value) for key, value in pending.items()
+                       if key not in current)
+        later = dict((key, value) for key, value in pending.items()
+                     if key in current and value > current[key])
+        failed = client.add_multi(missing) if missing else []
+        if later:
+            failed.extend(client.cas_multi(later))
+        pending = dict((key, pending[key]) for key in failed)
+        if not pending:
+            return
+
+
+def wait(urlsafe_key, after, timeout, load):
+    """Waits until a Game has moves after a sequence number or is
+    finished, for at most timeout seconds.
+    Args:
+        urlsafe_key: the urlsafe key of the Game
+        after: the sequence number of the last Move the watcher has
+        timeout: the seconds to wait at most
+        load: a function returning the state of the Game read from the
+        datastore, or None if the Game does not exist
+    Returns:
+        the (sequence, finished) state of the Game, or None if the Game
+        does not exist"""
+    key = MEMCACHE_GAME_STATE_PREFIX + urlsafe_key
+    deadline = time.time() + timeout
+    interval = POLL_SECONDS
+    current = memcache.get(key)
+    while True:
+        if current is None:
+            current = load()
+            if current is None:
+                return None
+            memcache.add(key, current)
+        remaining = deadline - time.time()
+        if current[0] > after or current[1] or remaining <= 0:
+            return current
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 1.5, MAX_POLL_SECONDS)
+        current = memcache.get(key)
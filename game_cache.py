@@ -0,0 +1,78 @@
+"""game_cache.py - Read-through memcache cache of the rendered responses
+of a game: its GameForm and the pages of its history.
+Every entry is tagged with the version of its Game, a memcache counter
+bumped after each write to the Game, and is read in the same get_multi as
+the counter, so a read costs one memcache call and a stale entry is never
+served. The version is also the ETag of the responses, so a client that
+already has the current one is answered from the counter alone."""
+import time
+
+from google.appengine.api import memcache
+from protorpc import protojson
+
+MEMCACHE_GAME_VERSION_PREFIX = 'GAME_VERSION:'
+MEMCACHE_GAME_FORM_PREFIX = 'GAME_FORM:'
+MEMCACHE_GAME_HISTORY_PREFIX = 'GAME_HISTORY:'
+
+
+def initial_version():
+    """Returns the version of a counter missing from memcache. It is above
+    every version the counter had before it was evicted, so the entries
+    tagged with those versions are never served again"""
+    return int(time.time() * 1000)
+
+
+def bump(urlsafe_keys):
+    """Invalidates the cached responses of Games. Call it after the Games
+    are written.
+    Args:
+        urlsafe_keys: the urlsafe keys of the Games"""
+    memcache.offset_multi(dict((key, 1) for key in urlsafe_keys),
+                          key_prefix=MEMCACHE_GAME_VERSION_PREFIX,
+                          initial_value=initial_version())
+
+
+def form_key(urlsafe_key):
+    """Returns the cache key of the GameForm of a Game"""
+    return MEMCACHE_GAME_FORM_PREFIX + urlsafe_key
+
+
+def history_key(urlsafe_key, page_size, page_token):
+    """Returns the cache key of a page of the history of a Game"""
+    return '{}{}:{}:{}'.format(MEMCACHE_GAME_HISTORY_PREFIX, urlsafe_key,
+                               page_size or '', page_token or '')
+
+
+def cached(urlsafe_key, entry_key, message_type, render,
+           if_none_match=None):
+    """Returns a response of a Game from the cache, or renders and caches
+    it if the cached one is missing or stale.
+    Args:
+        urlsafe_key: the urlsafe key of the Game
+        entry_key: the cache key of the response
+        message_type: the protorpc message class of the response
+        render: a function returning the response, reading the datastore
+        if_none_match: the ETag of the response the client has, if any
+    Returns:
+        a (message, etag) tuple, with None as message if the client has
+        the current response"""
+    version_key = MEMCACHE_GAME_VERSION_PREFIX + urlsafe_key
+    values = memcache.get_multi([version_key, entry_key])
+    version = values.get(version_key)
+    if version is not None:
+        if if_none_match == str(version):
+            return None, str(version)
+        entry = values.get(entry_key)
+        if entry is not None and entry[0] == version:
+            return protojson.decode_message(message_type, entry[1]), \
+                str(version)
+    else:
+        # The version must be read before the datastore, so a write made
+        # while rendering bumps it past the one the entry is tagged with
+        version = memcache.incr(version_key,
+                                initial_value=initial_version())
+    message = render()
+    if version is None:
+        return message, None
+    memcache.set(entry_key, (version, protojson.encode_message(message)))
+    return message, str(version)
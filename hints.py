@@ -0,0 +1,143 @@
+"""hints.py - The hint engine: suggests the letter a player should guess
+next, the one found in the most words that still match the game.
+The words of every category and length are precomputed into NumPy
+matrices, so the matching words are filtered with a few vectorized
+operations instead of a loop over the words. A Game gets at most
+HINTS_PER_GAME hints computed; the hint of a game state is cached, so asking
+again before the next move is free. The API imports this module on the
+first hint."""
+import threading
+
+from google.appengine.api import memcache
+
+from dictionary import get_dictionary
+from models.game_class import HintForm, HINTS_PER_GAME
+from rules import letter_bit
+
+ALPHABET = 26
+MEMCACHE_HINT_PREFIX = 'HINT:'
+HINT_CACHE_SECONDS = 3600
+
+
+class NoHintsLeft(Exception):
+    """Raised when a Game has used all its hints"""
+
+
+class WordIndex(object):
+    """The words of a category that have the same length. letters holds
+    the letter of every position of every word, 0 for a to 25 for z, and
+    counts the number of times every letter occurs in every word"""
+
+    def __init__(self, block, length):
+        # NumPy is imported on the first hint, not by the cold start of
+        # the API
+        import numpy
+        self.letters = (numpy.frombuffer(block, dtype=numpy.uint8) -
+                        ord('a')).reshape(-1, length)
+        rows = numpy.arange(len(self.letters))
+        self.counts = numpy.zeros((len(self.letters), ALPHABET),
+                                  dtype=numpy.uint8)
+        for position in range(length):
+            self.counts[rows, self.letters[:, position]] += 1
+
+    def candidates(self, pattern, missed):
+        """Returns the counts of the words that match what a player knows.
+        Args:
+            pattern: the letter of every revealed position of the secret
+            word, None for the hidden ones
+            missed: the missed letters"""
+        import numpy
+        keep = numpy.ones(len(self.letters), dtype=bool)
+        revealed = [i for i, letter in enumerate(pattern)
+                    if letter is not None]
+        hidden = [i for i, letter in enumerate(pattern) if letter is None]
+        if revealed:
+            keep &= (self.letters[:, revealed] ==
+                     numpy.array([pattern[i] for i in revealed],
+                                 dtype=numpy.uint8)).all(axis=1)
+        if hidden and revealed:
+            # A correct letter is revealed at all its positions, so it can
+            # not be at a hidden one
+            known = numpy.zeros(ALPHABET, dtype=bool)
+            known[[pattern[i] for i in revealed]] = True
+            keep &= ~known[self.letters[:, hidden]].any(axis=1)
+        if missed:
+            keep &= (self.counts[:, missed] == 0).all(axis=1)
+        return self.counts[keep]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def word_index(category_id, length):
+    """Returns the WordIndex of the words of a category that have a
+    length, built once per instance, or None if there are none"""
+    key = (category_id, length)
+    if key not in _indexes:
+        dictionary = get_dictionary()
+        category = dictionary.category(category_id)
+        start, end = (category.lengths.get(length, (0, 0))
+                      if category else (0, 0))
+        index = None
+        if start != end:
+            index = WordIndex(dictionary.word_block(start, end), length)
+        with _indexes_lock:
+            _indexes.setdefault(key, index)
+    return _indexes[key]
+
+
+def suggest(game):
+    """Finds the letter not guessed yet that is in the most words matching
+    a Game.
+    Returns:
+        a (letter, candidates, hits) tuple: the letter, None if no word
+        matches, the number of matching words and the number of those
+        containing the letter"""
+    letters = [chr(ord('a') + i) for i in range(ALPHABET)]
+    pattern = [ord(c) - ord('a') if game.correct_mask & letter_bit(c)
+               else None for c in game.secretWord]
+    missed = [i for i, c in enumerate(letters)
+              if game.missed_mask & letter_bit(c)]
+    index = word_index(game.word_category, len(game.secretWord))
+    if index is None:
+        return None, 0, 0
+    counts = index.candidates(pattern, missed)
+    hits = (counts > 0).sum(axis=0)
+    for i, c in enumerate(letters):
+        if (game.missed_mask | game.correct_mask) & letter_bit(c):
+            hits[i] = 0
+    best = int(hits.argmax())
+    if not hits[best]:
+        return None, len(counts), 0
+    return letters[best], len(counts), int(hits[best])
+
+
+def hint_form(game):
+    """Returns the HintForm of the current state of a Game, computing the
+    hint only if it is not cached.
+    Raises:
+        NoHintsLeft: If the hint has to be computed and the Game has used
+        all its hints."""
+    game.upgrade_letters()
+    key = '{}{}:{}:{}'.format(MEMCACHE_HINT_PREFIX, game.key.urlsafe(),
+                              game.correct_mask, game.missed_mask)
+    hint = memcache.get(key)
+    if hint is None:
+        if not game.use_hint():
+            raise NoHintsLeft('No hints left for this game')
+        hint = suggest(game)
+        memcache.set(key, hint, time=HINT_CACHE_SECONDS)
+    letter, candidates, hits = hint
+    if letter is None:
+        message = 'No word of the dictionary matches this game'
+    else:
+        message = 'Try the letter {}: it is in {} of the {} words that ' \
+                  'still match'.format(letter.upper(), hits, candidates)
+    return HintForm(urlsafe_key=game.key.urlsafe(),
+                    letter=letter,
+                    candidates=candidates,
+                    probability=float(hits) / candidates if candidates
+                    else 0.0,
+                    hints_remaining=HINTS_PER_GAME - game.hints_used,
+                    message=message)
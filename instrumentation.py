@@ -0,0 +1,169 @@
+"""instrumentation.py - Per-request RPC and timing instrumentation of the
+API endpoints and of the task and cron handlers.
+A sampled request records its wall time, its RPCs by service, the time
+spent in the datastore and memcache, and the entities it read and wrote.
+The record is logged as a structured line and added to histograms kept in
+memcache. Requests are sampled with the INSTRUMENTATION_SAMPLE_RATE
+environment variable (0 turns the instrumentation off)."""
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+SAMPLE_RATE = float(os.environ.get('INSTRUMENTATION_SAMPLE_RATE', '0'))
+MEMCACHE_INSTRUMENTATION_PREFIX = 'INSTRUMENTATION:'
+SERVICES = ['datastore_v3', 'memcache', 'taskqueue', 'mail']
+TIMED_SERVICES = ['datastore_v3', 'memcache']
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+COUNTERS = (['calls', 'errors', 'wall_ms', 'entities_read',
+             'entities_written'] + SERVICES +
+            [service + '_ms' for service in TIMED_SERVICES] +
+            ['latency_le_{}'.format(bound) for bound in LATENCY_BUCKETS_MS] +
+            ['latency_gt_{}'.format(LATENCY_BUCKETS_MS[-1])])
+
+# The record of the request of the current thread, if it is sampled
+_local = threading.local()
+# The names of the instrumented endpoints and handlers
+_names = set()
+_hooks_lock = threading.Lock()
+_hooks_installed = []
+
+
+def _pre_call(service, call, request, response):
+    record = getattr(_local, 'record', None)
+    if record is None or service not in SERVICES:
+        return
+    record[service] += 1
+    _local.started[id(request)] = time.time()
+    if service == 'datastore_v3':
+        if call == 'Get':
+            record['entities_read'] += request.key_size()
+        elif call == 'Put':
+            record['entities_written'] += request.entity_size()
+        elif call == 'Delete':
+            record['entities_written'] += request.key_size()
+
+
+def _post_call(service, call, request, response):
+    record = getattr(_local, 'record', None)
+    if record is None or service not in SERVICES:
+        return
+    started = _local.started.pop(id(request), None)
+    if started is not None and service in TIMED_SERVICES:
+        record[service + '_ms'] += (time.time() - started) * 1000
+    if service == 'datastore_v3' and call in ('RunQuery', 'Next'):
+        record['entities_read'] += response.result_size()
+
+
+def _install_hooks():
+    """Installs the RPC hooks, once per instance and only when a request
+    is first sampled"""
+    with _hooks_lock:
+        if _hooks_installed:
+            return
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'instrumentation', _pre_call)
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'instrumentation', _post_call)
+        _hooks_installed.append(True)
+
+
+def latency_bucket(wall_ms):
+    """Returns the histogram counter of a latency"""
+    for bound in LATENCY_BUCKETS_MS:
+        if wall_ms <= bound:
+            return 'latency_le_{}'.format(bound)
+    return 'latency_gt_{}'.format(LATENCY_BUCKETS_MS[-1])
+
+
+class Recording(object):
+    """Records the RPCs and the timing of the request of the current
+    thread between enter and exit, then logs and aggregates them"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        _install_hooks()
+        _local.record = defaultdict(float)
+        _local.started = {}
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_ms = (time.time() - self.start) * 1000
+        record, _local.record = _local.record, None
+        record['calls'] = 1
+        record['wall_ms'] = wall_ms
+        if exc_type is not None:
+            record['errors'] = 1
+        record[latency_bucket(wall_ms)] = 1
+        logging.info('instrumentation %s', json.dumps(
+            dict(record, endpoint=self.name), sort_keys=True))
+        memcache.offset_multi(
+            dict((counter, int(round(value)))
+                 for counter, value in record.items() if value),
+            key_prefix='{}{}:'.format(MEMCACHE_INSTRUMENTATION_PREFIX,
+                                      self.name),
+            initial_value=0)
+        return False
+
+
+def sampled():
+    """Tells if the current request should be recorded"""
+    return SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE
+
+
+def instrumented(method):
+    """Decorates an API method to record its sampled calls. Place it below
+    the endpoints.method decorator"""
+    _names.add(method.__name__)
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if not sampled():
+            return method(*args, **kwargs)
+        with Recording(method.__name__):
+            return method(*args, **kwargs)
+    return wrapper
+
+
+class InstrumentedApplication(object):
+    """WSGI middleware recording the sampled requests of the handlers of
+    a webapp2 application, named by their path"""
+
+    def __init__(self, app):
+        self.app = app
+        for route in app.router.match_routes:
+            _names.add(route.template)
+
+    def __call__(self, environ, start_response):
+        if not sampled():
+            return self.app(environ, start_response)
+        with Recording(environ.get('PATH_INFO', '')):
+            return self.app(environ, start_response)
+
+
+def aggregates():
+    """Returns the aggregated counters and latency histogram of every
+    instrumented endpoint and handler that was sampled, by name"""
+    names = sorted(_names)
+    keys = ['{}:{}'.format(name, counter)
+            for name in names for counter in COUNTERS]
+    values = memcache.get_multi(keys,
+                                key_prefix=MEMCACHE_INSTRUMENTATION_PREFIX)
+    result = {}
+    for name in names:
+        counters = dict((counter, values.get('{}:{}'.format(name, counter),
+                                             0))
+                        for counter in COUNTERS)
+        if counters['calls']:
+            result[name] = counters
+    return result
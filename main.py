@@ -1,40 +1,286 @@
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import json
 import webapp2
+from datetime import datetime
+from google.appengine.ext import ndb
 from google.appengine.api import mail, app_identity
-from api import Hangman
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+import stats
+import instrumentation
+from dictionary import get_dictionary
 from models.user_class import User
 from models.game_class import Game
+from models.leaderboard_class import Leaderboard
+from models.high_score_class import HighScoreTable
+from models.stats_class import StatShard
+from models.reminder_class import Reminder
+
+REMINDERS_QUEUE = 'reminders'
+REMINDER_BATCH_SIZE = 50
+# The number of batches each planning task queues before handing over
+REMINDER_PLAN_BATCHES = 20
+
+
+def players_query():
+    """Returns the query of the distinct Users with active games"""
+    return Game.query(Game.game_over == False,
+                      Game.game_cancelled == False,
+                      projection=[Game.user], distinct=True)
+
+
+def add_reminder_task(name, url, params):
+    """Queues a named task of a reminder run, unless it was already
+    queued, so a retried task does not queue its follow-ups twice"""
+    try:
+        taskqueue.add(name=name, url=url, params=params,
+                      queue_name=REMINDERS_QUEUE)
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
-        """Send a reminder email to each User with an email
-        who has incompleted games. Called every 6 hours
-        using a cron job"""
+        """Start a run of the reminder pipeline, that sends a reminder
+        email to each User with an email who has incompleted games.
+        Called every day using a cron job"""
+        run = datetime.now().strftime('%Y%m%d%H%M')
+        add_reminder_task('reminders-{}-plan-0'.format(run),
+                          '/tasks/plan_reminders', {'run': run})
+        self.response.set_status(204)
+
+
+class PlanReminders(webapp2.RequestHandler):
+    def post(self):
+        """Split the Users with active games into batches delimited by the
+        query cursors and queue a task for each one; the tasks send the
+        emails concurrently. Queues the next planning task after
+        REMINDER_PLAN_BATCHES batches, so a run of any size resumes from
+        its last checkpoint"""
+        run = self.request.get('run')
+        chunk = int(self.request.get('chunk', 0))
+        cursor = self.request.get('cursor')
+        query = players_query()
+        for _ in range(REMINDER_PLAN_BATCHES):
+            _, next_cursor, more = query.fetch_page(
+                REMINDER_BATCH_SIZE,
+                start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+            add_reminder_task('reminders-{}-{}'.format(run, chunk),
+                              '/tasks/send_reminders', {'cursor': cursor})
+            chunk += 1
+            if not (more and next_cursor):
+                break
+            cursor = next_cursor.urlsafe()
+        else:
+            add_reminder_task('reminders-{}-plan-{}'.format(run, chunk),
+                              '/tasks/plan_reminders',
+                              {'run': run, 'chunk': chunk,
+                               'cursor': cursor})
+        self.response.set_status(204)
+
+
+class SendReminders(webapp2.RequestHandler):
+    def post(self):
+        """Send a reminder email to the Users with an email of one batch,
+        skipping the ones already reminded in the dedupe window"""
+        cursor = self.request.get('cursor')
+        games = players_query().fetch(
+            REMINDER_BATCH_SIZE,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        users = dict((user.key, user) for user in
+                     ndb.get_multi([game.user for game in games])
+                     if user and user.email)
         app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
-        for user in users:
-            games = Game.query().filter(
-                Game.user == user.key and Game.game_over == False)
-            if games:
-                subject = 'This is a reminder for Hangman game!'
-                body = 'Hi {}, complete your Hangman game!'.format(user.name)
-                # the arguments to send_mail are: from, to, subject, body
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               user.email,
-                               subject,
-                               body)
+        for key in Reminder.claim(users.keys()):
+            user = users[key]
+            subject = 'This is a reminder for Hangman game!'
+            body = 'Hi {}, complete your Hangman game!'.format(user.name)
+            # the arguments to send_mail are: from, to, subject, body
+            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                           user.email,
+                           subject,
+                           body)
+        self.response.set_status(204)
+
+
+class ReconcileStats(webapp2.RequestHandler):
+    def get(self):
+        """Start the batched runs that recompute the live game statistics
+        from the stored Games and Scores to correct any drift of the
+        counters. Called every day using a cron job"""
+        stats.reconcile()
+        self.response.set_status(204)
+
+
+class UpdateLeaderboard(webapp2.RequestHandler):
+    def get(self):
+        """Roll up the results of the players whose results changed onto
+        their Users and move them to their new positions in the
+        Leaderboard, building it from all the Users the first time.
+        Called every minute using a cron job"""
+        if not Leaderboard.exists():
+            Leaderboard.rebuild(User.query().iter(batch_size=500))
+        Leaderboard.update_from_queue()
+        self.response.set_status(204)
+
+
+class UpdateStats(webapp2.RequestHandler):
+    def get(self):
+        """Add the counter deltas queued by the moves since the last run to
+        the live game statistics. Called every minute using a cron job"""
+        StatShard.update_from_queue()
+        self.response.set_status(204)
+
+
+class UpdateHighScores(webapp2.RequestHandler):
+    def get(self):
+        """Merge the Scores won since the last run into the high score
+        tables. Called every minute using a cron job"""
+        HighScoreTable.update_from_queue()
+        self.response.set_status(204)
 
 
-class UpdateAverageMovesRemaining(webapp2.RequestHandler):
+class StartMigration(webapp2.RequestHandler):
     def post(self):
-        """Update game listing announcement in memcache."""
-        Hangman._cache_average_attempts()
+        """Start a run of a registered migration, split in the requested
+        number of shards, and return the id of the run"""
+        import migrations
+        try:
+            run = migrations.start(self.request.get('name'),
+                                   int(self.request.get('shards', 1)))
+        except ValueError, e:
+            self.abort(400, str(e))
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps({'run': run}))
+
+
+class RunMigrationBatch(webapp2.RequestHandler):
+    def post(self):
+        """Migrate the next batch of a shard of a migration run"""
+        import migrations
+        migrations.run_batch(self.request.get('shard'),
+                             int(self.request.get('generation')),
+                             int(self.request.get('batch')))
+        self.response.set_status(204)
+
+
+class ResumeMigration(webapp2.RequestHandler):
+    def post(self):
+        """Restart the unfinished shards of a migration run from their
+        checkpoints"""
+        import migrations
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(
+            {'resumed': migrations.resume(self.request.get('run'))}))
+
+
+class MigrationStatus(webapp2.RequestHandler):
+    def get(self):
+        """Return the progress of the shards of a migration run as JSON,
+        or the names of the migrations without a run. Restricted to
+        admins"""
+        import migrations
+        run = self.request.get('run')
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(
+            migrations.status(run) if run else migrations.names(),
+            sort_keys=True))
+
+
+class StartExport(webapp2.RequestHandler):
+    def post(self):
+        """Start an export run of the requested kinds, all of them by
+        default, of the entities updated since the last export, or of all
+        of them with full=1, and return the id of the run"""
+        import exports
+        try:
+            run = exports.start(self.request.get_all('kind'),
+                                bool(self.request.get('full')))
+        except ValueError, e:
+            self.abort(400, str(e))
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps({'run': run}))
+
+
+class RunExportPart(webapp2.RequestHandler):
+    def post(self):
+        """Export the next part of a kind of an export run"""
+        import exports
+        exports.run_part(self.request.get('checkpoint'),
+                         int(self.request.get('generation')),
+                         int(self.request.get('part')))
         self.response.set_status(204)
 
 
-app = webapp2.WSGIApplication([
+class ResumeExport(webapp2.RequestHandler):
+    def post(self):
+        """Restart the unfinished kinds of an export run from their
+        checkpoints"""
+        import exports
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(
+            {'resumed': exports.resume(self.request.get('run'))}))
+
+
+class ExportStatus(webapp2.RequestHandler):
+    def get(self):
+        """Return the progress of the kinds of an export run as JSON.
+        Restricted to admins"""
+        import exports
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(
+            exports.status(self.request.get('run')), sort_keys=True))
+
+
+class DailyExport(webapp2.RequestHandler):
+    def get(self):
+        """Export the entities updated since the last export. Called
+        every day using a cron job"""
+        import exports
+        exports.start()
+        self.response.set_status(204)
+
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """Load the API and the word dictionary when App Engine starts the
+        instance, before it serves requests"""
+        import api
+        get_dictionary()
+        self.response.set_status(204)
+
+
+class EndpointStats(webapp2.RequestHandler):
+    def get(self):
+        """Return the aggregated RPC counts, timings and latency
+        histograms of the instrumented endpoints and handlers as JSON.
+        Restricted to admins"""
+        # Importing the API registers the names of its endpoints
+        import api
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(instrumentation.aggregates(),
+                                       sort_keys=True))
+
+
+app = instrumentation.InstrumentedApplication(webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
-    ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
-], debug=True)
+    ('/tasks/plan_reminders', PlanReminders),
+    ('/tasks/send_reminders', SendReminders),
+    ('/crons/reconcile_stats', ReconcileStats),
+    ('/crons/update_leaderboard', UpdateLeaderboard),
+    ('/crons/update_high_scores', UpdateHighScores),
+    ('/crons/update_stats', UpdateStats),
+    ('/tasks/start_migration', StartMigration),
+    ('/tasks/migration_batch', RunMigrationBatch),
+    ('/tasks/resume_migration', ResumeMigration),
+    ('/admin/migrations', MigrationStatus),
+    ('/crons/export', DailyExport),
+    ('/tasks/start_export', StartExport),
+    ('/tasks/export_part', RunExportPart),
+    ('/tasks/resume_export', ResumeExport),
+    ('/admin/exports', ExportStatus),
+    ('/admin/endpoint_stats', EndpointStats),
+    ('/_ah/warmup', Warmup),
+], debug=True))
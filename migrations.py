@@ -0,0 +1,497 @@
+"""migrations.py - Resumable batched migrations of the stored entities.
+A migration walks every entity of a kind with keys-only cursor queries,
+in batches of bounded size, and writes the entities its transform changes
+with a single put_multi per batch. A run splits the kind into key range
+shards, sampled with the __scatter__ property, that are migrated in
+parallel by the tasks of the migrations queue, whose rate keeps them from
+competing with live traffic. Each shard checkpoints its cursor after every
+batch, so a failed task is retried from its last batch and a stopped run
+is resumed with resume. An aggregation walks a kind the same way to count
+its entities, adding the counts of each batch to the checkpoint of its
+shard, and hands the totals of the run to its finish function once every
+shard is done."""
+import time
+from datetime import datetime
+
+from google.appengine.api import datastore
+from google.appengine.api import datastore_errors
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import stats
+from models.game_class import Game
+from models.high_score_class import HighScoreTable
+from models.migration_class import MigrationShard
+from models.reminder_class import Reminder
+from models.score_class import Score
+from models.stats_class import (
+    ACTIVE_GAMES,
+    ACTIVE_ATTEMPTS,
+    won_counter,
+    lost_counter,
+    guesses_counter,
+)
+from models.summary_class import UserSummary, RECENT_GAMES, RECENT_WORDS
+from models.user_class import User, UserResultShard
+
+MIGRATIONS_QUEUE = 'migrations'
+MIGRATION_BATCH_URL = '/tasks/migration_batch'
+DEFAULT_BATCH_SIZE = 100
+# The keys sampled per shard to choose the shard boundaries
+SCATTER_OVERSAMPLING = 32
+MAX_SHARDS = 64
+USER_MIGRATION_BATCH_SIZE = 50
+# The times a UserSummary is rebuilt when it changes during the rebuild
+SUMMARY_REBUILD_ATTEMPTS = 3
+
+
+class Migration(object):
+    """A registered migration: the model it walks and the transform it
+    applies to each batch of entities"""
+
+    def __init__(self, name, model, transform, batch_size, transactional,
+                 countdown):
+        self.name = name
+        self.model = model
+        self.transform = transform
+        self.batch_size = batch_size
+        self.transactional = transactional
+        self.countdown = countdown
+
+    # Called with the totals of a run once all its shards are done
+    finish = None
+
+    def apply(self, keys):
+        """Applies the transform to the entities of some keys.
+        Returns:
+            the number of entities read, the number written and the counts
+            to add to the checkpoint of the shard"""
+        if self.transactional:
+            written = 0
+            for key in keys:
+                written += ndb.transaction(lambda: self.apply_batch([key])[1])
+            return len(keys), written, {}
+        return self.apply_batch(keys) + ({},)
+
+    def apply_batch(self, keys):
+        entities = [entity for entity in ndb.get_multi(keys) if entity]
+        changed = self.transform(entities) or []
+        ndb.put_multi(changed)
+        return len(entities), len(changed)
+
+
+class Aggregation(Migration):
+    """A registered aggregation: the model it walks, the function counting
+    each batch of entities and the function given the totals of a run"""
+
+    def __init__(self, name, model, count, finish, batch_size, countdown):
+        super(Aggregation, self).__init__(name, model, None, batch_size,
+                                          False, countdown)
+        self.count = count
+        self.finish = finish
+
+    def apply(self, keys):
+        entities = [entity for entity in ndb.get_multi(keys) if entity]
+        return len(entities), 0, self.count(entities)
+
+
+_migrations = {}
+
+
+def migration(name, model, batch_size=DEFAULT_BATCH_SIZE,
+              transactional=False, countdown=0):
+    """Registers a function as the transform of a migration of the
+    entities of a model. The transform gets a batch of entities and returns
+    the ones to write. It must be idempotent, since a batch is applied again
+    when its task is retried.
+    Args:
+        name: the name the migration is started with
+        model: the ndb.Model class of the entities
+        batch_size: the number of entities of a batch
+        transactional: True to transform each entity in its own
+        transaction, for the entities written by live traffic
+        countdown: the seconds to wait between the batches of a shard"""
+    def register(transform):
+        _migrations[name] = Migration(name, model, transform, batch_size,
+                                      transactional, countdown)
+        return transform
+    return register
+
+
+def aggregation(name, model, finish, batch_size=DEFAULT_BATCH_SIZE,
+                countdown=0):
+    """Registers a function as the counting function of an aggregation of
+    the entities of a model, started and followed as a migration. The
+    function gets a batch of entities and returns a dict of counts, which
+    are added up over the run.
+    Args:
+        name: the name the aggregation is started with
+        model: the ndb.Model class of the entities
+        finish: the function called with the dict of the totals of a run
+        once all its shards are done. It can be called again by a retried
+        task, so it must be idempotent
+        batch_size: the number of entities of a batch
+        countdown: the seconds to wait between the batches of a shard"""
+    def register(count):
+        _migrations[name] = Aggregation(name, model, count, finish,
+                                        batch_size, countdown)
+        return count
+    return register
+
+
+def names():
+    """Returns the names of the registered migrations"""
+    return sorted(_migrations)
+
+
+def split_keys(model, shards):
+    """Returns the keys that split the entities of a model in shards of
+    about the same size, chosen from a sample of keys ordered by the
+    __scatter__ property. There are fewer shards if the kind is small"""
+    query = datastore.Query(model._get_kind(), keys_only=True)
+    query.Order('__scatter__')
+    sample = sorted(ndb.Key.from_old_key(key)
+                    for key in query.Get(shards * SCATTER_OVERSAMPLING))
+    splits = []
+    for shard in range(1, shards):
+        key = sample[len(sample) * shard // shards] if sample else None
+        if key is not None and (not splits or key > splits[-1]):
+            splits.append(key)
+    return splits
+
+
+def shard_query(model, shard):
+    """Returns the keys-only query of the key range of a shard"""
+    query = model.query()
+    if shard.start_key:
+        query = query.filter(model.key >= shard.start_key)
+    if shard.end_key:
+        query = query.filter(model.key < shard.end_key)
+    return query.order(model.key)
+
+
+def queue_batch(shard, transactional=False, countdown=0):
+    """Queues the task of the next batch of a shard"""
+    taskqueue.add(url=MIGRATION_BATCH_URL,
+                  params={'shard': shard.key.id(),
+                          'generation': shard.generation,
+                          'batch': shard.batches},
+                  queue_name=MIGRATIONS_QUEUE,
+                  countdown=countdown,
+                  transactional=transactional)
+
+
+def start(name, shards=1):
+    """Starts a run of a migration.
+    Args:
+        name: the name of a registered migration
+        shards: the number of shards to run in parallel
+    Returns:
+        the id of the run
+    Raises:
+        ValueError: If there is no such migration."""
+    if name not in _migrations:
+        raise ValueError('Unknown migration {!r}'.format(name))
+    shards = max(1, min(shards, MAX_SHARDS))
+    run = '{}-{}'.format(name, int(time.time()))
+    boundaries = [None] + split_keys(_migrations[name].model, shards) + [None]
+    checkpoints = [MigrationShard(key=MigrationShard.key_for(run, shard),
+                                  migration=name,
+                                  run=run,
+                                  shards=len(boundaries) - 1,
+                                  start_key=start_key,
+                                  end_key=end_key)
+                   for shard, (start_key, end_key) in enumerate(
+                       zip(boundaries, boundaries[1:]))]
+    ndb.put_multi(checkpoints)
+    for checkpoint in checkpoints:
+        queue_batch(checkpoint)
+    return run
+
+
+def run_batch(shard_id, generation, batch):
+    """Migrates the next batch of a shard and queues the following one,
+    moving the checkpoint in the same transaction as the task is queued.
+    The task of a batch already applied, or of an older generation of the
+    shard, does nothing, except the retried task of the last batch of an
+    aggregation, which finishes the run again."""
+    key = ndb.Key(MigrationShard, shard_id)
+    shard = key.get()
+    if shard is None or shard.generation != generation:
+        return
+    migration = _migrations[shard.migration]
+    if shard.done:
+        if shard.batches == batch + 1:
+            finish_run(migration, shard)
+        return
+    if shard.batches != batch:
+        return
+    keys, cursor, more = shard_query(migration.model, shard).fetch_page(
+        migration.batch_size, keys_only=True,
+        start_cursor=Cursor(urlsafe=shard.cursor) if shard.cursor else None)
+    processed, written, counts = migration.apply(keys)
+
+    @ndb.transactional
+    def checkpoint():
+        current = key.get()
+        if current.generation != generation or current.batches != batch:
+            return
+        current.cursor = cursor.urlsafe() if cursor else None
+        current.batches += 1
+        current.processed += processed
+        current.written += written
+        current.add_counts(counts)
+        current.done = not (more and cursor)
+        current.put()
+        if not current.done:
+            queue_batch(current, transactional=True,
+                        countdown=migration.countdown)
+        return current
+
+    current = checkpoint()
+    if current is not None and current.done:
+        finish_run(migration, current)
+
+
+def finish_run(migration, shard):
+    """Calls the finish function of an aggregation with the totals of the
+    run of a shard, if all the shards of the run are done. The shards are
+    read by key, so the last one to finish always sees the others done."""
+    if migration.finish is None or not shard.shards:
+        return
+    shards = ndb.get_multi([MigrationShard.key_for(shard.run, index)
+                            for index in range(shard.shards)],
+                           use_cache=False, use_memcache=False)
+    if not all(other and other.done for other in shards):
+        return
+    totals = {}
+    for other in shards:
+        for name, count in (other.totals or {}).items():
+            totals[name] = totals.get(name, 0) + count
+    migration.finish(totals)
+
+
+def resume(run):
+    """Queues again the unfinished shards of a run from their
+    checkpoints, after their task chain stopped. The tasks still queued
+    for the shards are then ignored.
+    Returns:
+        the number of shards resumed"""
+    resumed = 0
+    for shard in MigrationShard.query(MigrationShard.run == run):
+        if shard.done:
+            continue
+
+        @ndb.transactional
+        def restart():
+            current = shard.key.get()
+            current.generation += 1
+            current.put()
+            queue_batch(current, transactional=True)
+        restart()
+        resumed += 1
+    return resumed
+
+
+def status(run):
+    """Returns the progress of the shards of a run"""
+    return [shard.status() for shard in
+            MigrationShard.query(MigrationShard.run == run)]
+
+
+@migration('score_user_names', Score)
+def denormalize_score_user_names(scores):
+    """Stores the name of the player on the Scores written before Scores
+    stored it"""
+    scores = [score for score in scores if not score.user_name]
+    users = dict((user.key, user) for user in ndb.get_multi(
+        list(set(score.user for score in scores))) if user)
+    for score in scores:
+        if score.user in users:
+            score.user_name = users[score.user].name
+    return [score for score in scores if score.user_name]
+
+
+@migration('user_ratios', User, transactional=True)
+def recompute_user_ratios(users):
+    """Recomputes the winning ratio of the Users from their results"""
+    changed = []
+    for user in users:
+        played = user.victories + user.losses
+        ratio = float(user.victories) / played if played else 0.0
+        if user.ratio != ratio:
+            user.ratio = ratio
+            changed.append(user)
+    return changed
+
+
+@migration('game_histories', Game, transactional=True)
+def upgrade_games(games):
+    """Moves the guessed letters of the old Games into the letter masks
+    and their pickled history into Move entities, bumping the version of
+    the Games so the moves played on the old copies are played again"""
+    changed = []
+    for game in games:
+        upgraded = bool(game.missedLetters or game.correctLetters)
+        game.upgrade_letters()
+        legacy = game.upgrade_history()
+        if upgraded or legacy is not None:
+            game.version += 1
+            changed.append(game)
+            changed.extend(legacy or [])
+    return changed
+
+
+@migration('high_scores', Score)
+def backfill_high_scores(scores):
+    """Merges the won Scores into the high score tables"""
+    HighScoreTable.backfill(scores)
+
+
+@migration('user_summaries', User, batch_size=USER_MIGRATION_BATCH_SIZE)
+def rebuild_user_summaries(users):
+    """Rebuilds the UserSummaries of the Users from their Games and
+    Scores, each in its own transaction"""
+    for user in users:
+        rebuild_user_summary(user.key)
+
+
+def rebuild_user_summary(user_key):
+    """Rebuilds the UserSummary of a User from its Games and Scores. The
+    Scores only have a date, so the streaks of games ended on the same day
+    are counted in key order, and the recent games and words are ordered by
+    the last write of their Games. The Games are queried outside the
+    transaction, which writes the summary only if it is unchanged since
+    they were read, and the summary is rebuilt again otherwise, so the
+    results recorded during the rebuild are not lost."""
+    key = UserSummary.key_for(user_key)
+    for _ in range(SUMMARY_REBUILD_ATTEMPTS):
+        before = key.get(use_cache=False, use_memcache=False)
+        summary = build_user_summary(user_key)
+
+        @ndb.transactional
+        def write():
+            if key.get(use_cache=False, use_memcache=False) != before:
+                return False
+            summary.put()
+            return True
+
+        if write():
+            return
+    raise datastore_errors.TransactionFailedError(
+        'The UserSummary of {} kept changing'.format(user_key))
+
+
+def build_user_summary(user_key):
+    """Returns a new UserSummary of a User computed from its Games and
+    Scores"""
+    def last_write(game):
+        return game.updated or datetime.min
+
+    summary = UserSummary(key=UserSummary.key_for(user_key))
+    active = sorted(Game.query(Game.user == user_key,
+                               Game.game_over == False,
+                               Game.game_cancelled == False),
+                    key=last_write, reverse=True)
+    summary.cancelled = Game.query(Game.user == user_key,
+                                   Game.game_cancelled == True).count()
+    scores = sorted(Score.query(Score.user == user_key),
+                    key=lambda score: (score.date, score.key))
+    for score in scores:
+        summary.record_result(score.key.parent(), score)
+    # record_result counts the ended games out of the active ones
+    summary.active = len(active)
+    summary.recent_active = [game.key for game in active[:RECENT_GAMES]]
+    ended = [game for game in ndb.get_multi(
+        [score.key.parent() for score in scores[-RECENT_WORDS:]]) if game]
+    for game in sorted(active + ended, key=last_write, reverse=True):
+        if game.secretWord and game.secretWord not in summary.recent_words:
+            summary.recent_words.append(game.secretWord)
+    del summary.recent_words[RECENT_WORDS:]
+    return summary
+
+
+@migration('users_by_name', User,
+           batch_size=USER_MIGRATION_BATCH_SIZE)
+def key_users_by_name(users):
+    """Moves the Users created before Users were keyed by name to their
+    name keys"""
+    for user in users:
+        if user.key.id() != user.name:
+            migrate_user(user)
+
+
+def migrate_user(user):
+    """Moves a User created before Users were keyed by name to its name
+    key, re-pointing its Games and Scores and moving its UserSummary and
+    Reminder children under the new key. Safe to run again after a
+    failure: the results and the children of the old User are moved in the
+    transaction that creates or updates the new one."""
+    new_key = User.key_for(user.name)
+    UserResultShard.rollup([user.key])
+
+    @ndb.transactional(xg=True)
+    def move_results():
+        old = user.key.get()
+        new = new_key.get() or User(key=new_key, name=old.name,
+                                    email=old.email)
+        new.add_results(old.victories, old.losses)
+        old.victories = old.losses = 0
+        summary, reminder, new_summary, new_reminder = ndb.get_multi([
+            UserSummary.key_for(old.key), Reminder.key_for(old.key),
+            UserSummary.key_for(new_key), Reminder.key_for(new_key)])
+        moved = []
+        if summary and not new_summary:
+            moved.append(UserSummary(key=UserSummary.key_for(new_key),
+                                     **summary.to_dict()))
+        if reminder and (not new_reminder or
+                         reminder.sent > new_reminder.sent):
+            moved.append(Reminder(key=Reminder.key_for(new_key),
+                                  sent=reminder.sent))
+        ndb.put_multi([new, old] + moved)
+        ndb.delete_multi([child.key for child in (summary, reminder)
+                          if child])
+
+    move_results()
+    for model in (Game, Score):
+        batch = []
+        for entity in model.query(model.user == user.key).iter(
+                batch_size=USER_MIGRATION_BATCH_SIZE):
+            entity.user = new_key
+            batch.append(entity)
+            if len(batch) == USER_MIGRATION_BATCH_SIZE:
+                ndb.put_multi(batch)
+                batch = []
+        ndb.put_multi(batch)
+    user.key.delete()
+    User.invalidate(user.name)
+
+
+@aggregation('active_game_stats', Game, stats.reset_active_games,
+             batch_size=stats.RECONCILE_BATCH_SIZE)
+def count_active_games(games):
+    """Counts the active Games and their attempts remaining"""
+    active = [game for game in games
+              if not game.game_over and not game.game_cancelled]
+    return {ACTIVE_GAMES: len(active),
+            ACTIVE_ATTEMPTS: sum(game.attempts_remaining for game in active)}
+
+
+@aggregation('score_stats', Score, stats.reset_scores,
+             batch_size=stats.RECONCILE_BATCH_SIZE)
+def count_scores(scores):
+    """Counts the won and lost games of the Scores by category and the won
+    games by number of guesses"""
+    counts = {}
+    for score in scores:
+        if score.word_category is None:
+            continue
+        if score.won:
+            name = won_counter(score.word_category)
+            bucket = guesses_counter(score.guesses)
+            counts[bucket] = counts.get(bucket, 0) + 1
+        else:
+            name = lost_counter(score.word_category)
+        counts[name] = counts.get(name, 0) + 1
+    return counts
@@ -0,0 +1,60 @@
+"""export_class.py - This file contains the ExportCheckpoint class, the
+   progress of the export of a kind in an export run, and the
+   ExportWatermark class, the point incremental exports start from"""
+
+from google.appengine.ext import ndb
+
+
+class ExportCheckpoint(ndb.Model):
+    """The progress of the export of one kind in an export run: the
+    update time range it exports, the cursor after the last part written
+    and the rows of each part. Keyed by the run and the kind. The part and
+    generation numbers tell the task of the next part from the stale and
+    retried ones"""
+    run = ndb.StringProperty(required=True)
+    kind = ndb.StringProperty(required=True, indexed=False)
+    # Entities updated after since, None for a full export, and up to until
+    since = ndb.DateTimeProperty(indexed=False)
+    until = ndb.DateTimeProperty(required=True, indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    part_rows = ndb.IntegerProperty(repeated=True, indexed=False)
+    generation = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, run, kind):
+        """Returns the key of the checkpoint of a kind in a run"""
+        return ndb.Key(cls, '{}:{}'.format(run, kind))
+
+    @property
+    def parts(self):
+        """The number of parts written"""
+        return len(self.part_rows)
+
+    def status(self):
+        """Returns the progress of the export as a JSON serializable
+        dict"""
+        return {'kind': self.kind,
+                'since': self.since.isoformat() if self.since else None,
+                'until': self.until.isoformat(),
+                'parts': self.parts,
+                'rows': sum(self.part_rows),
+                'done': self.done,
+                'updated': self.updated.isoformat() if self.updated
+                else None}
+
+
+class ExportWatermark(ndb.Model):
+    """The end of the update time range of the last completed export of a
+    kind, keyed by the kind. The next incremental export of the kind
+    starts there"""
+    until = ndb.DateTimeProperty(required=True, indexed=False)
+    run = ndb.StringProperty(required=True, indexed=False)
+
+    @classmethod
+    def get_since(cls, kind):
+        """Returns the start of the next incremental export of a kind, or
+        None if the kind was never exported"""
+        watermark = cls.get_by_id(kind)
+        return watermark.until if watermark else None
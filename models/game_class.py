@@ -1,114 +1,532 @@
 """game_class.py - This file contains the Game class and its forms
    definitions"""
 
-import random
+import logging
+import pickle
+import string
+from difficulty import choose_word
 from score_class import Score
+from move_class import Move
+from leaderboard_class import Leaderboard
+from high_score_class import HighScoreTable
+from summary_class import UserSummary
+from user_class import UserResultShard
+from stats_class import (
+    StatShard,
+    merge_deltas,
+    new_game_deltas,
+    missed_guess_deltas,
+    end_game_deltas,
+)
+import feed
+import rules
+from rules import IllegalMove
 from datetime import date
 from protorpc import messages
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 
-wordList1 = 'antelope badger bear beaver cat cow dog donkey elephant fish\
-            fox giraffe goat hippopotamus horse kangaroo lion monkey parrot\
-            penguin pig pony rhinoceros sheep snake tiger varan wale wolf\
-            zebra'.split()
-wordList2 = 'apple artichoke banana baens bread carrot cheese courgette date\
-             egg eggplant garlic grapefruit ham lemon lettuce mango nut onion\
-             orange pasta pizza pepper potato rice salad salmon strawberry\
-             tomato tuna waffle'.split()
-wordList3 = 'actor attorney carpenter dentist doctor electrician engineer\
-             farmer hairdresser nurse painter pharmacist plumber surgeon\
-             veterinary'.split()
+# The properties that list queries project, so they never load the secret
+# word and the history of the Games
+LIST_PROJECTION = ['attempts_remaining', 'word_category', 'user_name']
+HINTS_PER_GAME = 3
+
+
+def record_results(ended):
+    """Records the ended games in the UserSummaries of their players, one
+    transaction per player, run concurrently. The moves are written by
+    then, so a failure is logged rather than raised, for the moves not to
+    be played again; the user_summaries migration repairs the summaries.
+    Args:
+        ended: a dict user key -> the (game key, Score) of its ended games"""
+    def record(ended):
+        return lambda summary: [summary.record_result(game_key, score)
+                                for game_key, score in ended]
+    futures = [UserSummary.update_async(user_key, record(games))
+               for user_key, games in ended.items()]
+    for future in futures:
+        try:
+            future.get_result()
+        except Exception:
+            logging.exception('Could not update a UserSummary')
+
+
+class StaleGame(Exception):
+    """Raised when a Game was written since it was read"""
+
+
+class MoveResult(object):
+    """The outcome of a guess: the message for the player, the letter and
+    answer to record in the history (None if the move is not recorded),
+    the Score if the move ended the game and the statistics deltas"""
+
+    def __init__(self, message, letter=None, answer=None, score=None,
+                 deltas=None):
+        self.message = message
+        self.letter = letter
+        self.answer = answer if answer is not None else message
+        self.score = score
+        self.deltas = deltas
 
 
 class Game(ndb.Model):
     """Game object"""
-    secretWord = ndb.StringProperty()
-    missedLetters = ndb.StringProperty()
-    correctLetters = ndb.StringProperty()
+    secretWord = ndb.StringProperty(indexed=False)
+    # The letters guessed so far, as masks with one bit per letter
+    missed_mask = ndb.IntegerProperty(default=0, indexed=False)
+    correct_mask = ndb.IntegerProperty(default=0, indexed=False)
+    # The missed letters in guess order, which the masks do not keep
+    missed_order = ndb.StringProperty(default='', indexed=False)
+    # Letter strings of the Games created before the masks, converted by
+    # upgrade_letters
+    missedLetters = ndb.StringProperty(indexed=False)
+    correctLetters = ndb.StringProperty(indexed=False)
     word_category = ndb.IntegerProperty()
+    # The difficulty level the secret word was drawn for, None for any
+    difficulty = ndb.StringProperty(indexed=False)
     attempts_allowed = ndb.IntegerProperty(default=10)
     attempts_remaining = ndb.IntegerProperty(required=True)
     game_over = ndb.BooleanProperty(required=True, default=False)
     game_cancelled = ndb.BooleanProperty(required=True, default=False)
     user = ndb.KeyProperty(required=True, kind='User')
     user_name = ndb.StringProperty()
-    game_history = ndb.PickleProperty(required=True, default=[])
+    # The number of Moves in the history of the Game
+    moves = ndb.IntegerProperty(default=0, indexed=False)
+    # The number of hints computed for the Game, at most HINTS_PER_GAME
+    hints_used = ndb.IntegerProperty(default=0, indexed=False)
+    # Incremented by every write of the Game, which checks it is unchanged
+    # since the Game was read
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    # Pickled history of the Games created before the Moves, left as raw
+    # bytes and converted by upgrade_history when the Game is next written
+    game_history = ndb.BlobProperty(indexed=False)
+    # Indexed for the incremental exports
+    updated = ndb.DateTimeProperty(auto_now=True)
 
     @classmethod
-    def new_game(cls, user, category):
-        """Creates and returns a new game, choose your category"""
-        if category == 1:
-            wordList = wordList1
-        elif category == 2:
-            wordList = wordList2
-        else:
-            wordList = wordList3
-
-        game = Game(user=user,
-                    user_name=user.get().name,
-                    secretWord=wordList[random.randint(0, len(wordList) - 1)],
-                    missedLetters='',
-                    correctLetters='',
+    def new_game(cls, user, category, difficulty=None):
+        """Creates and returns a new game of a User, choose your category
+        by its id in the word dictionary and optionally a difficulty level.
+        The secret word is none of the last words of the User, read from
+        its UserSummary. Raises ValueError if there is no such category or
+        level"""
+        summary = UserSummary.get_or_new(user.key)
+        word = choose_word(category, difficulty, set(summary.recent_words))
+        game = Game(user=user.key,
+                    user_name=user.name,
+                    secretWord=word,
                     word_category=category,
+                    difficulty=difficulty,
                     attempts_allowed=10,
                     attempts_remaining=10,
                     game_cancelled=False,
                     game_over=False)
-        game.game_history = []
         game.put()
+        UserSummary.update(user.key, lambda summary: summary.record_new_game(
+            game.key, game.secretWord))
+        StatShard.increment_multi(new_game_deltas(game))
         return game
 
-    def to_form(self, message):
-        """Returns a GameForm representation of the Game"""
+    def upgrade_letters(self):
+        """Moves the guessed letters of a Game created before the letter
+        masks into the masks"""
+        if self.missedLetters or self.correctLetters:
+            missed = ''.join(c for c in self.missedLetters or ''
+                             if c in string.ascii_lowercase)
+            self.missed_mask |= rules.letters_mask(missed)
+            self.missed_order = missed + (self.missed_order or '')
+            self.correct_mask |= rules.letters_mask(self.correctLetters or '')
+            self.missedLetters = None
+            self.correctLetters = None
+
+    @property
+    def missed_count(self):
+        """The number of missed letters"""
+        return rules.count_letters(self.missed_mask)
+
+    @property
+    def correct_count(self):
+        """The number of correct letters"""
+        return rules.count_letters(self.correct_mask)
+
+    @property
+    def missed_letters(self):
+        """The missed letters in guess order. The letters of the Games
+        missed before the order was stored come first, in alphabetical
+        order"""
+        order = self.missed_order or ''
+        return rules.mask_letters(
+            self.missed_mask & ~rules.letters_mask(order)) + order
+
+    def is_guessed(self, letter):
+        """Tells if a letter has already been guessed"""
+        return bool((self.missed_mask | self.correct_mask) &
+                    rules.letter_bit(letter))
+
+    def revealed_word(self):
+        """Returns the secret word with a - in place of each letter not
+        guessed yet"""
+        return rules.revealed_word(self.secretWord, self.correct_mask)
+
+    def use_hint(self):
+        """Counts a hint against the HINTS_PER_GAME of the Game, in a
+        transaction so concurrent requests cannot exceed them.
+        Returns:
+            True if the Game had a hint left"""
+        def use():
+            game = self.key.get()
+            if game.hints_used >= HINTS_PER_GAME:
+                return game.hints_used, False
+            game.hints_used += 1
+            game.version += 1
+            game.put()
+            return game.hints_used, True
+        self.hints_used, used = ndb.transaction(use)
+        return used
+
+    def play(self, guess):
+        """Applies a guess, a single letter or the whole word, to the Game
+        without writing it.
+        Returns:
+            the MoveResult, to write with add_moves if it has a letter
+        Raises:
+            IllegalMove: If the game is over or cancelled, or the guess is
+            not made of letters."""
+        if self.game_over:
+            raise IllegalMove('Illegal action: Game is already over.')
+        if self.game_cancelled:
+            raise IllegalMove('Illegal action: Game has been cancelled.')
+        self.upgrade_letters()
+        letter = rules.normalize_guess(guess)
+        outcome, self.correct_mask, self.missed_mask = rules.judge(
+            self.secretWord, self.correct_mask, self.missed_mask, letter)
+        if outcome == rules.SOLVED:
+            msg = 'Yes, the secret word is: ' + self.secretWord + \
+                  '! You win after ' + str(self.missed_count) + \
+                  ' missed guesses'
+            return MoveResult(msg, letter, score=self.end_game(True))
+        if outcome == rules.NOT_A_LETTER:
+            return MoveResult(
+                'Enter a single letter or try to guess the whole word')
+        if outcome == rules.REPEATED:
+            return MoveResult('Letter already guessed. Choose again!')
+        deltas = None
+        if outcome == rules.CORRECT:
+            mess = 'Yes, the letter ' + letter.upper() + ' is correct! *** '
+        else:
+            self.missed_order = (self.missed_order or '') + letter
+            self.attempts_remaining = rules.attempts_remaining(
+                self.missed_mask, self.attempts_allowed)
+            deltas = missed_guess_deltas(self)
+            mess = 'No, the letter ' + letter.upper() + ' is not correct! *** '
+        # Print the missed letters and replace blanks with guessed letters
+        msg = mess + 'Missed Letters: ' + self.missed_letters +\
+            ' *** Guessed letters: ' + self.revealed_word() +\
+            ' *** You have ' + str(self.attempts_remaining) +\
+            ' attempts left.'
+        # Check if player has guessed too many times and lost
+        if rules.is_lost(self.missed_mask, self.attempts_allowed):
+            msg = 'You are an Hangman! You have run out of guesses after ' + \
+                str(self.missed_count) + ' missed guesses and ' + \
+                str(self.correct_count) + ' correct guesses, '\
+                'the secret word was: ' + self.secretWord + '! '
+            return MoveResult(msg + 'Game over!', letter, msg,
+                              self.end_game(False), deltas)
+        return MoveResult(msg, letter, deltas=deltas)
+
+    def to_form(self, message, user_name=None, state=None):
+        """Returns a GameForm representation of the Game. The state dict
+        gives the game_over and game_cancelled flags of a Game fetched by
+        a LIST_PROJECTION query, which filtered on them"""
+        if state is None:
+            state = {'game_over': self.game_over,
+                     'game_cancelled': self.game_cancelled}
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = self.user_name or user_name or self.user.get().name
         form.word_category = self.word_category
         form.attempts_remaining = self.attempts_remaining
-        form.game_over = self.game_over
-        form.game_cancelled = self.game_cancelled
+        form.game_over = state['game_over']
+        form.game_cancelled = state['game_cancelled']
         form.message = message
         return form
 
+    @staticmethod
+    def to_forms(games, message, state=None, next_page_token=None):
+        """Returns the GameForms of many Games, resolving the names that
+        are not stored on the Games with a single batched get. The user
+        key is only read from the Games without a name, as the
+        LIST_PROJECTION queries do not project it"""
+        games = list(games)
+        keys = list(set(game.user for game in games if not game.user_name))
+        names = dict((user.key, user.name)
+                     for user in ndb.get_multi(keys) if user)
+        return GameForms(items=[game.to_form(
+            message, None if game.user_name else names.get(game.user), state)
+            for game in games],
+                         next_page_token=next_page_token)
+
     def end_game(self, won=False):
         """Ends the game - if won is True, the player won. - if won is False,
-        the player lost."""
+        the player lost.
+        Returns:
+            the Score of the game, to be written with the last move by
+            add_moves"""
         self.game_over = True
-        self.put()
         # Add the game to the score 'board'
-        score = Score(user=self.user,
-                      date=date.today(),
-                      won=won,
-                      guesses=self.attempts_allowed - self.attempts_remaining)
-        score.put()
+        return Score(key=Score.key_for(self.key),
+                     user=self.user,
+                     user_name=self.user_name,
+                     date=date.today(),
+                     won=won,
+                     guesses=self.attempts_allowed - self.attempts_remaining,
+                     word_category=self.word_category)
+
+    def cancel(self):
+        """Cancels the Game in a transaction, unless it is over or already
+        cancelled.
+        Returns:
+            the cancelled Game, or None if it was already cancelled
+        Raises:
+            IllegalMove: If the game is over."""
+        def cancel():
+            game = self.key.get(use_cache=False, use_memcache=False)
+            if game.game_over:
+                raise IllegalMove('Illegal action: Game is already over, '
+                                  'you cannot cancel it.')
+            if game.game_cancelled:
+                return None
+            game.game_cancelled = True
+            game.version += 1
+            game.put()
+            return game
+        cancelled = ndb.transaction(cancel)
+        if cancelled:
+            feed.notify([cancelled])
+        return cancelled
+
+    def add_moves(self, results):
+        """Appends the Moves of some MoveResults to the history and writes
+        everything they changed with a single batched put in one
+        cross-group transaction: the Game, the Moves and, if the last move
+        ended the game, its Score and a UserResultShard of the player,
+        which are also queued for the Leaderboard and the HighScoreTables.
+        The deltas of the live statistics counters are queued in the same
+        transaction and added to the shared shards by a cron job, so the
+        moves of different games do not contend. The write is a
+        compare-and-set on the version of the Game, which also writes the
+        Moves of the pickled history of an old Game. The UserSummary of the
+        player is updated after the write, in its own transaction, so the
+        games of a player ending at once do not contend on its entity
+        group, and the watchers of the Game are notified.
+        Args:
+            results: the MoveResults returned by play, in order
+        Raises:
+            StaleGame: If the Game was written since it was read."""
+        score = self.write_moves_async(results).get_result()
+        if score:
+            record_results({self.user: [(self.key, score)]})
 
-    def add_history(self, letter, msg):
-        self.game_history.append({'guess': letter, 'answer': msg})
-        self.put()
+    @ndb.tasklet
+    def write_moves_async(self, results):
+        """Writes the moves of add_moves, without the UserSummary.
+        Args:
+            results: the MoveResults returned by play, in order
+        Returns:
+            a Future of the Score if the moves ended the game, or None"""
+        score = None
+        deltas = [result.deltas for result in results]
+        for result in results:
+            if result.score:
+                score = result.score
+                deltas.append(end_game_deltas(self, score.won,
+                                              score.guesses))
+        deltas = merge_deltas(*deltas)
+        version = self.version
+        moves = self.moves
+        history = self.game_history
+        # The version check makes sure the Game still has this history
+        legacy = self.upgrade_history() or []
+
+        @ndb.tasklet
+        def write_moves():
+            current_future = self.key.get_async(use_cache=False,
+                                                use_memcache=False)
+            if score:
+                result_future = UserResultShard.prepare_async(
+                    self.user, int(score.won), int(not score.won))
+            current = yield current_future
+            if current.version != version:
+                raise StaleGame()
+            self.version = version + 1
+            self.moves = moves + len(legacy) + len(results)
+            entities = [self]
+            entities.extend(legacy)
+            entities.extend(Move.make(self.key, sequence, result.letter,
+                                      result.answer)
+                            for sequence, result in enumerate(
+                                results, moves + len(legacy) + 1))
+            StatShard.enqueue(deltas)
+            if score:
+                result_shard = yield result_future
+                entities.extend([result_shard, score])
+                Leaderboard.enqueue([self.user])
+                if score.won:
+                    HighScoreTable.enqueue([score])
+            yield ndb.put_multi_async(entities)
+
+        try:
+            yield ndb.transaction_async(write_moves, xg=True)
+        except Exception:
+            self.version = version
+            self.moves = moves
+            self.game_history = history
+            raise
+        feed.notify([self])
+        if score:
+            UserResultShard.offset_cache(
+                {self.user: (int(score.won), int(not score.won))})
+        raise ndb.Return(score)
+
+    @classmethod
+    def add_histories(cls, games, results):
+        """Writes the moves of many Games, each with the compare-and-set
+        transaction of add_moves, all of them concurrently. The
+        UserSummaries are updated after the writes, with one transaction
+        per player.
+        Args:
+            games: the Games the moves were applied to by play
+            results: a dict game key -> the MoveResults to record, in
+            order
+        Returns:
+            a (stale, failed) tuple: the keys of the Games written since
+            they were read, whose moves were not written and must be played
+            again, and a dict game key -> the error that failed the write
+            of the other Games whose moves may not have been written"""
+        writes = [(game, game.write_moves_async(results[game.key]))
+                  for game in games if results.get(game.key)]
+        ndb.Future.wait_all([future for _, future in writes])
+        stale = []
+        failed = {}
+        ended = {}
+        for game, future in writes:
+            exception = future.get_exception()
+            if isinstance(exception, (
+                    StaleGame, datastore_errors.TransactionFailedError)):
+                stale.append(game.key)
+            elif exception is not None:
+                logging.error('The moves of game %s were not written: %r',
+                              game.key.urlsafe(), exception)
+                failed[game.key] = exception
+            elif future.get_result():
+                ended.setdefault(game.user, []).append(
+                    (game.key, future.get_result()))
+        record_results(ended)
+        return stale, failed
+
+    def legacy_moves(self):
+        """Returns the Moves of the pickled history of a Game created
+        before the Moves, without writing them, or [] if it has none"""
+        if not self.game_history:
+            return []
+        return [Move.make(self.key, sequence, move['guess'], move['answer'])
+                for sequence, move in enumerate(
+                    pickle.loads(self.game_history), 1)]
+
+    def upgrade_history(self):
+        """Converts the pickled history of a Game created before the Moves
+        in memory: the history is cleared, even if it is an empty list, and
+        its moves are counted. Writes nothing; the caller writes the Game
+        and the returned Moves in one transaction that checks the Game is
+        unchanged and bumps its version, as write_moves_async does.
+        Returns:
+            the Moves of the history, or None if the Game has no pickled
+            history"""
+        if self.game_history is None:
+            return None
+        legacy = self.legacy_moves()
+        if legacy:
+            self.moves = len(legacy)
+        self.game_history = None
+        return legacy
 
 
 class GameForm(messages.Message):
-    """GameForm for outbound game state information"""
+    """GameForm for outbound game state information. A conditional
+    get_game of an unchanged game only has the key, the etag and unchanged"""
     urlsafe_key = messages.StringField(1, required=True)
-    attempts_remaining = messages.IntegerField(2, required=True)
-    word_category = messages.IntegerField(3, required=True)
-    game_over = messages.BooleanField(4, required=True)
-    game_cancelled = messages.BooleanField(5, required=True)
+    attempts_remaining = messages.IntegerField(2)
+    word_category = messages.IntegerField(3)
+    game_over = messages.BooleanField(4)
+    game_cancelled = messages.BooleanField(5)
+    message = messages.StringField(6)
+    user_name = messages.StringField(7)
+    etag = messages.StringField(8)
+    unchanged = messages.BooleanField(9, default=False)
+
+
+class HintForm(messages.Message):
+    """HintForm for the outbound suggested next guess of a game"""
+    urlsafe_key = messages.StringField(1, required=True)
+    letter = messages.StringField(2)
+    candidates = messages.IntegerField(3, required=True)
+    probability = messages.FloatField(4, required=True)
+    hints_remaining = messages.IntegerField(5, required=True)
     message = messages.StringField(6, required=True)
-    user_name = messages.StringField(7, required=True)
 
 
 class GameForms(messages.Message):
     """GameForms -- multiple Game outbound form message"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
+
+
+class DashboardForm(messages.Message):
+    """DashboardForm for the outbound summary of the games of a player"""
+    user_name = messages.StringField(1, required=True)
+    active = messages.IntegerField(2, required=True)
+    cancelled = messages.IntegerField(3, required=True)
+    won = messages.IntegerField(4, required=True)
+    lost = messages.IntegerField(5, required=True)
+    current_streak = messages.IntegerField(6, required=True)
+    best_streak = messages.IntegerField(7, required=True)
+    best_guesses = messages.IntegerField(8)
+    recent_active_games = messages.MessageField(GameForm, 9, repeated=True)
 
 
 class NewGameForm(messages.Message):
     """Used to create a new game"""
     user_name = messages.StringField(1, required=True)
     cat_1_animals_2_food_3_jobs = messages.IntegerField(2)
+    category = messages.StringField(3)
+    # One of difficulty.LEVELS, any difficulty if missing
+    difficulty = messages.StringField(4)
 
 
 class MakeMoveForm(messages.Message):
     """Used to make a move in an existing game"""
     guess = messages.StringField(1, required=True)
+
+
+class BatchMoveForm(messages.Message):
+    """Used to make a move in one of the games of a batch"""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    guess = messages.StringField(2, required=True)
+
+
+class MakeMovesForm(messages.Message):
+    """Used to make many moves, in one or more games, with one call"""
+    moves = messages.MessageField(BatchMoveForm, 1, repeated=True)
+
+
+class MoveResultForm(messages.Message):
+    """MoveResultForm for the outcome of a move of a batch: the game
+    after the move, or the error that rejected it"""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    game = messages.MessageField(GameForm, 2)
+    error = messages.StringField(3)
+
+
+class MoveResultForms(messages.Message):
+    """Return the outcomes of a batch of moves, in request order"""
+    items = messages.MessageField(MoveResultForm, 1, repeated=True)
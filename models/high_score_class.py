@@ -0,0 +1,162 @@
+"""high_score_class.py - This file contains the HighScoreTable class, the
+   pre-aggregated best scores of a period and a category"""
+
+import json
+from datetime import date
+from protorpc import messages
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from score_class import ScoreForm, ScoreForms
+
+HIGH_SCORES_QUEUE = 'high-scores'
+MEMCACHE_HIGH_SCORES_PREFIX = 'HIGH_SCORES:'
+TABLE_SIZE = 100
+LEASE_SECONDS = 60
+LEASE_BATCH_SIZE = 1000
+
+
+class Window(messages.Enum):
+    """The periods high scores are kept for"""
+    ALL = 1
+    WEEK = 2
+    DAY = 3
+
+
+def period_of(window, day):
+    """Returns the name of the period of a window that contains a day"""
+    if window == Window.DAY:
+        return day.isoformat()
+    if window == Window.WEEK:
+        year, week, _ = day.isocalendar()
+        return '{:04d}-W{:02d}'.format(year, week)
+    return 'all'
+
+
+def table_id(window, day, category):
+    """Returns the id of the table of a window, the period of that window
+    containing day, and a category (None for all the categories)"""
+    return '{}:{}:{}'.format(window.name.lower(), period_of(window, day),
+                             'all' if category is None else category)
+
+
+def score_entry(score, user_name=None):
+    """Returns the entry of a won Score in the tables. Entries sort with
+    the fewest guesses first, then the oldest; the last item identifies the
+    Score, so an entry is never counted twice"""
+    return [score.guesses, score.date.isoformat(),
+            score.user_name or user_name or score.user.get().name,
+            score.key.urlsafe()]
+
+
+def score_tables(score):
+    """Returns the ids of the tables a won Score belongs to"""
+    categories = [None]
+    if score.word_category is not None:
+        categories.append(score.word_category)
+    return [table_id(window, score.date, category)
+            for window in Window for category in categories]
+
+
+class HighScoreTable(ndb.Model):
+    """The TABLE_SIZE best won Scores of a window period and a category,
+    kept sorted. Updated in batches by update_from_queue from the Scores
+    queued by make_move"""
+    entries = ndb.JsonProperty()
+
+    def merge(self, entries):
+        """Adds entries not in the table yet and keeps the best ones.
+        Returns:
+            True if the table changed"""
+        known = set(entry[3] for entry in self.entries)
+        added = [entry for entry in entries if entry[3] not in known]
+        if not added:
+            return False
+        merged = sorted(self.entries + added)[:TABLE_SIZE]
+        if merged == self.entries:
+            return False
+        self.entries = merged
+        return True
+
+    @classmethod
+    def enqueue(cls, scores, transactional=True):
+        """Queues won Scores, whose keys must be complete, by default inside
+        the transaction that writes them"""
+        taskqueue.Queue(HIGH_SCORES_QUEUE).add(
+            [taskqueue.Task(payload=json.dumps({
+                'tables': score_tables(score),
+                'entry': score_entry(score)}), method='PULL')
+             for score in scores],
+            transactional=transactional)
+
+    @classmethod
+    def apply(cls, entries_by_table):
+        """Merges entries into their tables, writing only the tables that
+        change.
+        Args:
+            entries_by_table: a dict table id -> list of entries"""
+        for table, entries in entries_by_table.items():
+            def merge():
+                high_scores = cls.get_by_id(table) or cls(id=table,
+                                                          entries=[])
+                if high_scores.merge(entries):
+                    high_scores.put()
+                return high_scores
+            high_scores = ndb.transaction(merge)
+            memcache.set(MEMCACHE_HIGH_SCORES_PREFIX + table,
+                         high_scores.entries)
+
+    @classmethod
+    def update_from_queue(cls):
+        """Applies the Scores queued by make_move in batches"""
+        queue = taskqueue.Queue(HIGH_SCORES_QUEUE)
+        while True:
+            tasks = queue.lease_tasks(LEASE_SECONDS, LEASE_BATCH_SIZE)
+            if not tasks:
+                return
+            entries_by_table = {}
+            for task in tasks:
+                payload = json.loads(task.payload)
+                for table in payload['tables']:
+                    entries_by_table.setdefault(table, []).append(
+                        payload['entry'])
+            cls.apply(entries_by_table)
+            queue.delete_tasks(tasks)
+
+    @classmethod
+    def backfill(cls, scores):
+        """Merges won Scores into the all-time tables and into the tables
+        of the current day and week"""
+        scores = [score for score in scores if score.won]
+        keys = list(set(score.user for score in scores
+                        if not score.user_name))
+        names = dict((user.key, user.name)
+                     for user in ndb.get_multi(keys) if user)
+        today = date.today()
+        current = set(table_id(window, today, category)
+                      for window in Window
+                      for category in [None] + [score.word_category
+                                                for score in scores])
+        entries_by_table = {}
+        for score in scores:
+            for table in score_tables(score):
+                if table in current:
+                    entries_by_table.setdefault(table, []).append(
+                        score_entry(score, names.get(score.user)))
+        cls.apply(entries_by_table)
+
+    @classmethod
+    def to_forms(cls, window, category, count):
+        """Returns the ScoreForms of the best Scores of the current period
+        of a window in a category (None for all the categories)"""
+        table = table_id(window, date.today(), category)
+        entries = memcache.get(MEMCACHE_HIGH_SCORES_PREFIX + table)
+        if entries is None:
+            high_scores = cls.get_by_id(table)
+            entries = high_scores.entries if high_scores else []
+            memcache.add(MEMCACHE_HIGH_SCORES_PREFIX + table, entries)
+        return ScoreForms(items=[
+            ScoreForm(guesses=guesses, date=day, user_name=user_name,
+                      won=True)
+            for guesses, day, user_name, _ in entries[:count]])
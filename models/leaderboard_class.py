@@ -0,0 +1,333 @@
+"""leaderboard_class.py - This file contains the Leaderboard class, the
+   materialized ranking of the players, its LeaderboardBucket and
+   LeaderboardEntry children, and its forms definitions"""
+
+from bisect import bisect_left, bisect_right, insort
+from protorpc import messages
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from user_class import UserResultShard
+from utils import LRUCache
+
+LEADERBOARD_ID = 'global'
+LEADERBOARD_QUEUE = 'leaderboard'
+MEMCACHE_LEADERBOARD_VERSION = 'LEADERBOARD_VERSION'
+TOP_SIZE = 100
+LEASE_SECONDS = 60
+LEASE_BATCH_SIZE = 1000
+# A bucket is split in two when it holds more entries
+BUCKET_SIZE = 500
+# The Users moved by one transaction of apply, so its writes stay within
+# the limits of a commit
+APPLY_BATCH_SIZE = 200
+LOCAL_BUCKETS_SIZE = 100
+
+# The copy of the Leaderboard of this instance, refreshed when the version
+# in memcache changes
+_local = {'version': None, 'board': None}
+# The (version, entries) of the buckets recently read by this instance, by
+# bucket id
+_local_buckets = LRUCache(LOCAL_BUCKETS_SIZE)
+
+
+def ranking_entry(user):
+    """Returns the entry of a User in the Leaderboard. Entries sort like
+    the User query of get_user_rankings: by ratio, best first, with ties
+    broken by the number of victories, then by name"""
+    return [-user.ratio, user.victories, user.name, user.losses]
+
+
+class LeaderboardBucket(ndb.Model):
+    """A slice of consecutive entries of the Leaderboard, sorted, child of
+    the Leaderboard"""
+    entries = ndb.JsonProperty(compressed=True)
+
+
+class LeaderboardEntry(ndb.Model):
+    """The entry of a player in the Leaderboard, child of the Leaderboard
+    keyed by the player name, so a player is found in its bucket and moved
+    out of it without scanning the buckets"""
+    entry = ndb.JsonProperty()
+
+    @classmethod
+    def key_for(cls, name):
+        """Returns the key of the LeaderboardEntry of a player"""
+        return ndb.Key(cls, name, parent=ndb.Key(Leaderboard,
+                                                 LEADERBOARD_ID))
+
+
+class Leaderboard(ndb.Model):
+    """The players who completed at least a game, sorted by their entries
+    and split in LeaderboardBuckets of at most BUCKET_SIZE entries. The
+    Leaderboard holds the bounds of the buckets only, so a rank is found by
+    bisection of the bounds, then of a single bucket, and an update reads
+    and writes the buckets it changes. The buckets, the entries and the
+    Leaderboard share an entity group. Updated in batches by
+    update_from_queue from the users queued by make_move"""
+    # Refreshed through the version in memcache
+    _use_memcache = False
+    _use_cache = False
+
+    # The [first entry, id, number of entries, version] of every bucket, in
+    # order; None for a Leaderboard that was never built
+    buckets = ndb.JsonProperty(compressed=True)
+    next_bucket = ndb.IntegerProperty(default=1, indexed=False)
+    version = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def get_or_create(cls):
+        """Returns the stored Leaderboard or an empty one"""
+        board = cls.get_by_id(LEADERBOARD_ID)
+        if board is None or board.buckets is None:
+            board = cls(id=LEADERBOARD_ID, buckets=[],
+                        version=board.version if board else 0)
+        return board
+
+    @property
+    def offsets(self):
+        """The number of entries before each bucket, built once per
+        copy"""
+        if not hasattr(self, '_offsets'):
+            self._offsets = [0]
+            for bucket in self.buckets:
+                self._offsets.append(self._offsets[-1] + bucket[2])
+        return self._offsets
+
+    def locate(self, entry):
+        """Returns the position of the bucket an entry belongs to. The
+        first entry of the first bucket is not a bound: every entry before
+        the second bucket belongs to it"""
+        if not hasattr(self, '_bounds'):
+            self._bounds = [bucket[0] for bucket in self.buckets[1:]]
+        return bisect_right(self._bounds, entry)
+
+    def bucket_key(self, bucket_id):
+        return ndb.Key(LeaderboardBucket, bucket_id, parent=self.key)
+
+    def bucket_entries(self, position):
+        """Returns the entries of the bucket at a position, reading it only
+        when the copy of this instance is stale"""
+        bucket_id, version = self.buckets[position][1], \
+            self.buckets[position][3]
+        cached = _local_buckets.get(bucket_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        bucket = self.bucket_key(bucket_id).get()
+        entries = bucket.entries if bucket else []
+        _local_buckets.set(bucket_id, (version, entries))
+        return entries
+
+    def rank(self, name):
+        """Returns the rank (1 is the best) and the entry of a player, or
+        None if the player has not completed a game yet"""
+        record = LeaderboardEntry.key_for(name).get()
+        if record is None or not self.buckets:
+            return None
+        position = self.locate(record.entry)
+        return (self.offsets[position] + bisect_left(
+            self.bucket_entries(position), record.entry) + 1, record.entry)
+
+    def top_entries(self, count):
+        """Returns the entries of the best players, reading the first
+        buckets"""
+        entries = []
+        for position in range(len(self.buckets)):
+            if len(entries) >= count:
+                break
+            entries.extend(self.bucket_entries(position))
+        return entries[:count]
+
+    def edit(self, removed, added):
+        """Moves entries out of and into the buckets, splitting the full
+        buckets and dropping the empty ones. Must be called inside a
+        transaction.
+        Returns:
+            the (buckets to put, keys of the buckets to delete)"""
+        if not self.buckets:
+            self.buckets = [[None, self.next_bucket, 0, 0]]
+            self.next_bucket += 1
+        self.__dict__.pop('_bounds', None)
+        self.__dict__.pop('_offsets', None)
+        positions = [self.locate(entry) for entry in removed + added]
+        ids = sorted(set(self.buckets[position][1]
+                         for position in positions))
+        loaded = dict((bucket_id, bucket or LeaderboardBucket(
+            key=self.bucket_key(bucket_id), entries=[]))
+            for bucket_id, bucket in zip(ids, ndb.get_multi(
+                [self.bucket_key(bucket_id) for bucket_id in ids])))
+        for entry, position in zip(removed, positions):
+            entries = loaded[self.buckets[position][1]].entries
+            index = bisect_left(entries, entry)
+            if index < len(entries) and entries[index] == entry:
+                del entries[index]
+        for entry, position in zip(added, positions[len(removed):]):
+            insort(loaded[self.buckets[position][1]].entries, entry)
+        self.version += 1
+        buckets, put, deleted = [], [], []
+        for first, bucket_id, count, version in self.buckets:
+            bucket = loaded.get(bucket_id)
+            if bucket is None:
+                buckets.append([first, bucket_id, count, version])
+                continue
+            if not bucket.entries:
+                deleted.append(bucket.key)
+                continue
+            chunks = [bucket.entries]
+            while len(chunks[-1]) > BUCKET_SIZE:
+                half = len(chunks[-1]) // 2
+                chunks[-1:] = [chunks[-1][:half], chunks[-1][half:]]
+            bucket.entries = chunks[0]
+            put.append(bucket)
+            for chunk in chunks[1:]:
+                put.append(LeaderboardBucket(
+                    key=self.bucket_key(self.next_bucket), entries=chunk))
+                self.next_bucket += 1
+        for bucket in put:
+            buckets.append([bucket.entries[0], bucket.key.id(),
+                            len(bucket.entries), self.version])
+        buckets.sort(key=lambda bucket: bucket[0])
+        self.buckets = buckets
+        self.__dict__.pop('_bounds', None)
+        self.__dict__.pop('_offsets', None)
+        return put, deleted
+
+    def cache(self):
+        """Makes the other instances reload their copy"""
+        memcache.set(MEMCACHE_LEADERBOARD_VERSION, self.version)
+        _local['version'] = self.version
+        _local['board'] = self
+
+    @classmethod
+    def enqueue(cls, user_keys, transactional=True):
+        """Queues the Users whose results changed, by default inside the
+        transaction that changes them"""
+        taskqueue.Queue(LEADERBOARD_QUEUE).add(
+            [taskqueue.Task(payload=key.urlsafe(), method='PULL')
+             for key in user_keys],
+            transactional=transactional)
+
+    @classmethod
+    def load(cls):
+        """Returns the current Leaderboard, reading the datastore only when
+        the copy of this instance is stale"""
+        version = memcache.get(MEMCACHE_LEADERBOARD_VERSION)
+        if version is not None and version == _local['version']:
+            return _local['board']
+        board = cls.get_or_create()
+        # add() does not move back the version an update just cached
+        memcache.add(MEMCACHE_LEADERBOARD_VERSION, board.version)
+        _local['version'] = board.version
+        _local['board'] = board
+        return board
+
+    @classmethod
+    def top(cls, count):
+        """Returns the RankForms of the best players, at most TOP_SIZE"""
+        entries = cls.load().top_entries(min(count, TOP_SIZE))
+        return RankForms(items=[rank_form(rank, entry) for rank, entry
+                                in enumerate(entries, 1)])
+
+    @classmethod
+    def apply(cls, users):
+        """Moves some Users to their current positions, APPLY_BATCH_SIZE
+        Users per transaction. Users sharing a name, the old and the new
+        User of the users_by_name migration, count once, with the User that
+        played the most games"""
+        users = dict((user.name, user) for user in sorted(
+            users, key=lambda user: user.victories + user.losses)).values()
+        for start in range(0, len(users), APPLY_BATCH_SIZE):
+            batch = users[start:start + APPLY_BATCH_SIZE]
+
+            def update():
+                board = cls.get_or_create()
+                records = ndb.get_multi([LeaderboardEntry.key_for(user.name)
+                                         for user in batch])
+                removed, added, put, deleted = [], [], [], []
+                for user, record in zip(batch, records):
+                    entry = ranking_entry(user)
+                    if record is not None and record.entry == entry:
+                        continue
+                    if record is not None:
+                        removed.append(record.entry)
+                    if user.victories + user.losses:
+                        added.append(entry)
+                        put.append(LeaderboardEntry(
+                            key=LeaderboardEntry.key_for(user.name),
+                            entry=entry))
+                    elif record is not None:
+                        deleted.append(record.key)
+                if not removed and not added:
+                    return board
+                buckets, emptied = board.edit(removed, added)
+                ndb.put_multi([board] + buckets + put)
+                ndb.delete_multi(emptied + deleted)
+                return board
+            ndb.transaction(update).cache()
+
+    @classmethod
+    def update_from_queue(cls):
+        """Rolls up the results of the users queued by make_move onto the
+        Users and applies them, in batches"""
+        queue = taskqueue.Queue(LEADERBOARD_QUEUE)
+        while True:
+            tasks = queue.lease_tasks(LEASE_SECONDS, LEASE_BATCH_SIZE)
+            if not tasks:
+                return
+            keys = list(set(ndb.Key(urlsafe=task.payload) for task in tasks))
+            cls.apply(UserResultShard.rollup(keys))
+            queue.delete_tasks(tasks)
+
+    @classmethod
+    def exists(cls):
+        """Tells if the Leaderboard has been built"""
+        board = ndb.Key(cls, LEADERBOARD_ID).get()
+        return board is not None and board.buckets is not None
+
+    @classmethod
+    def rebuild(cls, users):
+        """Replaces the Leaderboard with the given Users who completed at
+        least a game. The buckets are filled to half their size, so the
+        first updates do not split them. Not transactional: the Leaderboard
+        is written last, once its buckets and entries are"""
+        entries = sorted(ranking_entry(user) for user in users
+                         if user.victories + user.losses)
+        old = cls.get_or_create()
+        board = cls(id=LEADERBOARD_ID, buckets=[], version=old.version + 1,
+                    next_bucket=old.next_bucket)
+        fill = BUCKET_SIZE // 2
+        buckets = []
+        for start in range(0, len(entries), fill):
+            bucket = LeaderboardBucket(key=board.bucket_key(board.next_bucket),
+                                       entries=entries[start:start + fill])
+            board.next_bucket += 1
+            board.buckets.append([bucket.entries[0], bucket.key.id(),
+                                  len(bucket.entries), board.version])
+            buckets.append(bucket)
+        ndb.put_multi(buckets + [
+            LeaderboardEntry(key=LeaderboardEntry.key_for(entry[2]),
+                             entry=entry) for entry in entries])
+        board.put()
+        ndb.delete_multi([old.bucket_key(bucket[1])
+                          for bucket in old.buckets])
+        board.cache()
+
+
+def rank_form(rank, entry):
+    """Returns the RankForm of a Leaderboard entry"""
+    return RankForm(rank=rank, user_name=entry[2], ratio=-entry[0],
+                    victories=entry[1], losses=entry[3])
+
+
+class RankForm(messages.Message):
+    """RankForm for outbound position of a player in the ranking"""
+    rank = messages.IntegerField(1, required=True)
+    user_name = messages.StringField(2, required=True)
+    ratio = messages.FloatField(3, required=True)
+    victories = messages.IntegerField(4, required=True)
+    losses = messages.IntegerField(5, required=True)
+
+
+class RankForms(messages.Message):
+    """Return multiple RankForms"""
+    items = messages.MessageField(RankForm, 1, repeated=True)
@@ -0,0 +1,51 @@
+"""migration_class.py - This file contains the MigrationShard class, the
+   checkpoint of a shard of a migration run"""
+
+from google.appengine.ext import ndb
+
+
+class MigrationShard(ndb.Model):
+    """The progress of one shard of a migration run: the key range it
+    walks, the cursor of the last batch it applied and its counts. Keyed by
+    the run and the shard number. The batch and generation numbers tell
+    the task of the next batch from the stale and retried ones. The shards
+    of an aggregation also add up the counts of their batches"""
+    migration = ndb.StringProperty(required=True)
+    run = ndb.StringProperty(required=True)
+    # The number of shards of the run
+    shards = ndb.IntegerProperty(indexed=False)
+    start_key = ndb.KeyProperty(indexed=False)
+    end_key = ndb.KeyProperty(indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    batches = ndb.IntegerProperty(default=0, indexed=False)
+    generation = ndb.IntegerProperty(default=0, indexed=False)
+    processed = ndb.IntegerProperty(default=0, indexed=False)
+    written = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+    # The counts of an aggregation, by name
+    totals = ndb.JsonProperty()
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, run, shard):
+        """Returns the key of a shard of a run"""
+        return ndb.Key(cls, '{}:{}'.format(run, shard))
+
+    def add_counts(self, counts):
+        """Adds the counts of a batch to the totals of the shard"""
+        if counts:
+            totals = dict(self.totals or {})
+            for name, count in counts.items():
+                totals[name] = totals.get(name, 0) + count
+            self.totals = totals
+
+    def status(self):
+        """Returns the progress of the shard as a JSON serializable dict"""
+        return {'shard': self.key.id(),
+                'batches': self.batches,
+                'processed': self.processed,
+                'written': self.written,
+                'done': self.done,
+                'totals': self.totals,
+                'updated': self.updated.isoformat() if self.updated
+                else None}
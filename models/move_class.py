@@ -0,0 +1,63 @@
+"""move_class.py - This file contains the Move class, a record of the
+   game history, and its forms definitions"""
+
+from protorpc import messages
+from google.appengine.ext import ndb
+
+
+class Move(ndb.Model):
+    """One guess of a game and its answer, stored as a child of the Game
+    with the position of the move in the game as id, so the history of a
+    game is appended one small entity at a time and read in order"""
+    guess = ndb.StringProperty(indexed=False)
+    answer = ndb.TextProperty()
+
+    @classmethod
+    def key_for(cls, game_key, sequence):
+        """Returns the key of the Move at a position of the history of a
+        game"""
+        return ndb.Key(cls, sequence, parent=game_key)
+
+    @classmethod
+    def make(cls, game_key, sequence, guess, answer):
+        """Returns the Move at a position of the history of a game"""
+        return cls(parent=game_key, id=sequence, guess=guess, answer=answer)
+
+    @classmethod
+    def query_game(cls, game_key):
+        """Returns the query of the history of a game, in order"""
+        return cls.query(ancestor=game_key).order(cls.key)
+
+    def to_form(self):
+        form = MoveForm()
+        form.sequence = self.key.id()
+        form.guess = self.guess
+        form.answer = self.answer
+        return form
+
+
+class MoveForm(messages.Message):
+    """MoveForm for outbound game history"""
+    sequence = messages.IntegerField(1, required=True)
+    guess = messages.StringField(2, required=True)
+    answer = messages.StringField(3, required=True)
+
+
+class MoveForms(messages.Message):
+    """Return multiple MoveForms. A conditional page of an unchanged game
+    only has the etag and unchanged"""
+    items = messages.MessageField(MoveForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
+    etag = messages.StringField(3)
+    unchanged = messages.BooleanField(4, default=False)
+
+
+class GameChangesForm(messages.Message):
+    """GameChangesForm for outbound moves appended to a game history since
+    a sequence number"""
+    items = messages.MessageField(MoveForm, 1, repeated=True)
+    # The sequence number of the last move returned, or of the last move
+    # of the game if there is none, to send as after with the next request
+    sequence = messages.IntegerField(2, required=True)
+    # True if the game is over or cancelled and no move will follow
+    finished = messages.BooleanField(3, required=True)
@@ -0,0 +1,54 @@
+"""reminder_class.py - This file contains the Reminder class, the record of
+   the last reminder email sent to a user"""
+
+from datetime import datetime, timedelta
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+# A user is reminded at most once in this window
+REMINDER_WINDOW = timedelta(hours=20)
+
+
+class Reminder(ndb.Model):
+    """The time of the last reminder sent to a User, stored as the only
+    child Reminder of the User"""
+    sent = ndb.DateTimeProperty(required=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, user_key):
+        """Returns the key of the Reminder of a User"""
+        return ndb.Key(cls, 1, parent=user_key)
+
+    @classmethod
+    def claim(cls, user_keys):
+        """Records a reminder now for the Users not reminded in the
+        REMINDER_WINDOW, before it is sent, so nobody is reminded twice.
+        Each Reminder is claimed in its own transaction, which compares
+        its time and sets it, all of them concurrently, so overlapping runs
+        and retried tasks never claim the same User.
+        Returns:
+            the keys of the Users to remind"""
+        now = datetime.now()
+
+        @ndb.tasklet
+        def claim_one(user_key):
+            @ndb.tasklet
+            def claim():
+                key = cls.key_for(user_key)
+                reminder = yield key.get_async(use_cache=False,
+                                               use_memcache=False)
+                if reminder is not None and \
+                        reminder.sent > now - REMINDER_WINDOW:
+                    raise ndb.Return(False)
+                yield cls(key=key, sent=now).put_async()
+                raise ndb.Return(True)
+            try:
+                claimed = yield ndb.transaction_async(claim)
+            except datastore_errors.TransactionFailedError:
+                # Another run is claiming the same Reminder
+                claimed = False
+            raise ndb.Return(claimed)
+
+        futures = [claim_one(key) for key in user_keys]
+        return [key for key, future in zip(user_keys, futures)
+                if future.get_result()]
@@ -11,15 +11,40 @@ class Score(ndb.Model):
     date = ndb.DateProperty(required=True)
     won = ndb.BooleanProperty(required=True)
     guesses = ndb.IntegerProperty(required=True)
-
-    def to_form(self):
+    word_category = ndb.IntegerProperty()
+    user_name = ndb.StringProperty()
+    # Indexed for the incremental exports
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def key_for(cls, game_key):
+        """Returns the key of the Score of a game, its only child Score,
+        known before the Score is written"""
+        return ndb.Key(cls, 1, parent=game_key)
+
+    def to_form(self, user_name=None):
+        """Returns a ScoreForm representation of the Score. The user name
+        is fetched only if it is neither stored on the Score nor given"""
         form = ScoreForm()
-        form.user_name = self.user.get().name
+        form.user_name = self.user_name or user_name or self.user.get().name
         form.won = self.won
         form.date = str(self.date)
         form.guesses = self.guesses
         return form
 
+    @staticmethod
+    def to_forms(scores, next_page_token=None):
+        """Returns the ScoreForms of many Scores, resolving the names that
+        are not stored on the Scores with a single batched get"""
+        scores = list(scores)
+        keys = list(set(score.user for score in scores
+                        if not score.user_name))
+        names = dict((user.key, user.name)
+                     for user in ndb.get_multi(keys) if user)
+        return ScoreForms(items=[score.to_form(names.get(score.user))
+                                 for score in scores],
+                          next_page_token=next_page_token)
+
 
 class ScoreForm(messages.Message):
     """ScoreForm for outbound Score information"""
@@ -32,3 +57,4 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
@@ -0,0 +1,223 @@
+"""stats_class.py - This file contains the sharded statistics counters
+   and the forms used to present the live game statistics"""
+
+import json
+import random
+from protorpc import messages
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+NUM_SHARDS = 20
+MEMCACHE_STAT_PREFIX = 'STAT:'
+STATS_QUEUE = 'stats'
+LEASE_SECONDS = 60
+LEASE_BATCH_SIZE = 1000
+# The counters incremented by one transaction, each on its own entity
+# group, under the limit of the cross-group transactions
+COUNTERS_PER_TRANSACTION = 20
+
+ACTIVE_GAMES = 'active_games'
+ACTIVE_ATTEMPTS = 'active_attempts'
+
+
+def won_counter(category):
+    """Name of the counter of the games won in a category"""
+    return 'won-{}'.format(category)
+
+
+def lost_counter(category):
+    """Name of the counter of the games lost in a category"""
+    return 'lost-{}'.format(category)
+
+
+def guesses_counter(guesses):
+    """Name of the histogram bucket of the games won with that
+    number of guesses"""
+    return 'guesses-{}'.format(guesses)
+
+
+def merge_deltas(*deltas):
+    """Returns the sum of some counter deltas, without the counters whose
+    delta is zero. Empty deltas may be given as None"""
+    merged = {}
+    for delta in deltas:
+        for name, value in (delta or {}).items():
+            merged[name] = merged.get(name, 0) + value
+    return dict((name, value) for name, value in merged.items() if value)
+
+
+def new_game_deltas(game):
+    """Counter deltas for a game that has just been created"""
+    return {ACTIVE_GAMES: 1,
+            ACTIVE_ATTEMPTS: game.attempts_remaining}
+
+
+def missed_guess_deltas(game):
+    """Counter deltas for a wrong guess in an active game"""
+    return {ACTIVE_ATTEMPTS: -1}
+
+
+def cancel_game_deltas(game):
+    """Counter deltas for an active game that has been cancelled"""
+    return {ACTIVE_GAMES: -1,
+            ACTIVE_ATTEMPTS: -game.attempts_remaining}
+
+
+def end_game_deltas(game, won, guesses):
+    """Counter deltas for an active game that has just been completed"""
+    deltas = {ACTIVE_GAMES: -1,
+              ACTIVE_ATTEMPTS: -game.attempts_remaining}
+    if won:
+        deltas[won_counter(game.word_category)] = 1
+        deltas[guesses_counter(guesses)] = 1
+    else:
+        deltas[lost_counter(game.word_category)] = 1
+    return deltas
+
+
+class StatShard(ndb.Model):
+    """One shard of a named running sum. The total of a counter is the
+    sum of its NUM_SHARDS shards, so concurrent updates are spread over
+    different entity groups instead of contending on a single one."""
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+    @staticmethod
+    def shard_keys(name):
+        """Returns the keys of all the shards of a counter"""
+        return [ndb.Key(StatShard, '{}:{}'.format(name, index))
+                for index in range(NUM_SHARDS)]
+
+    @classmethod
+    @ndb.tasklet
+    def prepare_async(cls, deltas):
+        """Reads a random shard of every counter in deltas and returns the
+        updated entities, ready to be put. Must be called inside a
+        (cross-group) transaction.
+        Args:
+            deltas: a dict counter name -> integer increment
+        Returns:
+            a Future of the list of StatShard entities to put"""
+        keys = [ndb.Key(cls, '{}:{}'.format(
+                    name, random.randint(0, NUM_SHARDS - 1)))
+                for name in deltas]
+        shards = yield ndb.get_multi_async(keys)
+        updated = []
+        for key, shard, name in zip(keys, shards, deltas):
+            if shard is None:
+                shard = cls(key=key)
+            shard.count += deltas[name]
+            updated.append(shard)
+        raise ndb.Return(updated)
+
+    @staticmethod
+    def offset_cache(deltas):
+        """Applies committed deltas to the cached totals. Totals that are
+        not cached are left alone and rebuilt from the shards on read."""
+        if deltas:
+            memcache.offset_multi(deltas, key_prefix=MEMCACHE_STAT_PREFIX)
+
+    @classmethod
+    def increment_multi(cls, deltas):
+        """Adds the deltas to their counters, atomically for every
+        COUNTERS_PER_TRANSACTION counters.
+        Args:
+            deltas: a dict counter name -> integer increment"""
+        deltas = merge_deltas(deltas)
+        names = sorted(deltas)
+        for start in range(0, len(names), COUNTERS_PER_TRANSACTION):
+            chunk = dict((name, deltas[name]) for name in
+                         names[start:start + COUNTERS_PER_TRANSACTION])
+            ndb.transaction(
+                lambda: ndb.put_multi(cls.prepare_async(chunk).get_result()),
+                xg=True)
+            cls.offset_cache(chunk)
+
+    @staticmethod
+    def enqueue(deltas, transactional=True):
+        """Queues counter deltas, by default inside the transaction that
+        changes the entities they count, so the statistics shards are not
+        written by that transaction"""
+        deltas = merge_deltas(deltas)
+        if deltas:
+            taskqueue.Queue(STATS_QUEUE).add(
+                taskqueue.Task(payload=json.dumps(deltas), method='PULL'),
+                transactional=transactional)
+
+    @classmethod
+    def update_from_queue(cls):
+        """Adds the deltas queued by the moves to the counters, merged in
+        batches"""
+        queue = taskqueue.Queue(STATS_QUEUE)
+        while True:
+            tasks = queue.lease_tasks(LEASE_SECONDS, LEASE_BATCH_SIZE)
+            if not tasks:
+                return
+            cls.increment_multi(merge_deltas(
+                *[json.loads(task.payload) for task in tasks]))
+            queue.delete_tasks(tasks)
+
+    @classmethod
+    def get_totals(cls, names):
+        """Returns the totals of the counters, reading the shards only for
+        the ones missing from memcache.
+        Args:
+            names: the counter names
+        Returns:
+            a dict counter name -> total"""
+        totals = memcache.get_multi(names, key_prefix=MEMCACHE_STAT_PREFIX)
+        missing = [name for name in names if name not in totals]
+        if missing:
+            keys = []
+            for name in missing:
+                keys.extend(cls.shard_keys(name))
+            shards = ndb.get_multi(keys)
+            rebuilt = {}
+            for index, name in enumerate(missing):
+                rebuilt[name] = sum(
+                    shard.count for shard in
+                    shards[index * NUM_SHARDS:(index + 1) * NUM_SHARDS]
+                    if shard)
+            # add() does not overwrite a total another request already
+            # cached and possibly offset in the meantime
+            memcache.add_multi(rebuilt, key_prefix=MEMCACHE_STAT_PREFIX)
+            totals.update(rebuilt)
+        return totals
+
+    @classmethod
+    def reset_multi(cls, totals):
+        """Overwrites the counters with the given totals, storing each one
+        on its first shard and zeroing the others.
+        Args:
+            totals: a dict counter name -> exact total"""
+        shards = []
+        for name, total in totals.items():
+            for index, key in enumerate(cls.shard_keys(name)):
+                shards.append(cls(key=key, count=total if index == 0 else 0))
+        ndb.put_multi(shards)
+        memcache.set_multi(totals, key_prefix=MEMCACHE_STAT_PREFIX)
+
+
+class CategoryStatsForm(messages.Message):
+    """CategoryStatsForm for outbound per-category results"""
+    word_category = messages.IntegerField(1, required=True)
+    won = messages.IntegerField(2, required=True)
+    lost = messages.IntegerField(3, required=True)
+    win_rate = messages.FloatField(4, required=True)
+
+
+class CategoryStatsForms(messages.Message):
+    """Return multiple CategoryStatsForms"""
+    items = messages.MessageField(CategoryStatsForm, 1, repeated=True)
+
+
+class HistogramBucketForm(messages.Message):
+    """HistogramBucketForm for outbound number of games won with a given
+    number of guesses"""
+    guesses = messages.IntegerField(1, required=True)
+    games = messages.IntegerField(2, required=True)
+
+
+class HistogramForm(messages.Message):
+    """Return the guesses histogram"""
+    items = messages.MessageField(HistogramBucketForm, 1, repeated=True)
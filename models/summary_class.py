@@ -0,0 +1,94 @@
+"""summary_class.py - This file contains the UserSummary class, the
+   counts and records of the games of a user"""
+
+from google.appengine.ext import ndb
+
+# The number of active games a UserSummary keeps the keys of
+RECENT_GAMES = 10
+# The number of secret words of its last games a UserSummary keeps, which
+# new games avoid
+RECENT_WORDS = 20
+
+
+class UserSummary(ndb.Model):
+    """The games of a User by state, the keys of its most recently created
+    active games, the secret words of its last games, its winning streaks
+    and its best score. Stored as the only
+    child UserSummary of the User, and updated in its own transactions by
+    new_game, make_move and cancel_game after they write the Game"""
+    active = ndb.IntegerProperty(default=0, indexed=False)
+    cancelled = ndb.IntegerProperty(default=0, indexed=False)
+    won = ndb.IntegerProperty(default=0, indexed=False)
+    lost = ndb.IntegerProperty(default=0, indexed=False)
+    # Most recent first
+    recent_active = ndb.KeyProperty(kind='Game', repeated=True,
+                                    indexed=False)
+    # Most recent first
+    recent_words = ndb.StringProperty(repeated=True, indexed=False)
+    current_streak = ndb.IntegerProperty(default=0, indexed=False)
+    best_streak = ndb.IntegerProperty(default=0, indexed=False)
+    # The fewest guesses of a won game, None before the first victory
+    best_guesses = ndb.IntegerProperty(indexed=False)
+
+    @classmethod
+    def key_for(cls, user_key):
+        """Returns the key of the UserSummary of a User"""
+        return ndb.Key(cls, 1, parent=user_key)
+
+    @classmethod
+    def get_or_new(cls, user_key):
+        """Returns the UserSummary of a User, or an empty one"""
+        return (cls.key_for(user_key).get() or
+                cls(key=cls.key_for(user_key)))
+
+    def remove_active(self, game_key):
+        """Counts an active game out"""
+        self.active = max(0, self.active - 1)
+        if game_key in self.recent_active:
+            self.recent_active.remove(game_key)
+
+    def record_new_game(self, game_key, word=None):
+        """Counts a new active game in, and its secret word if given"""
+        self.active += 1
+        recent = [key for key in self.recent_active if key != game_key]
+        self.recent_active = [game_key] + recent[:RECENT_GAMES - 1]
+        if word:
+            words = [other for other in self.recent_words if other != word]
+            self.recent_words = [word] + words[:RECENT_WORDS - 1]
+
+    def record_cancel(self, game_key):
+        """Moves a game from active to cancelled"""
+        self.remove_active(game_key)
+        self.cancelled += 1
+
+    def record_result(self, game_key, score):
+        """Moves a game from active to won or lost with its Score"""
+        self.remove_active(game_key)
+        if score.won:
+            self.won += 1
+            self.current_streak += 1
+            self.best_streak = max(self.best_streak, self.current_streak)
+            if self.best_guesses is None or score.guesses < self.best_guesses:
+                self.best_guesses = score.guesses
+        else:
+            self.lost += 1
+            self.current_streak = 0
+
+    @classmethod
+    def update(cls, user_key, change):
+        """Applies a change to the UserSummary of a User in a transaction.
+        Args:
+            user_key: the key of the User
+            change: a function taking the UserSummary"""
+        cls.update_async(user_key, change).get_result()
+
+    @classmethod
+    def update_async(cls, user_key, change):
+        """Like update, returning a Future"""
+        @ndb.tasklet
+        def update():
+            key = cls.key_for(user_key)
+            summary = (yield key.get_async()) or cls(key=key)
+            change(summary)
+            yield summary.put_async()
+        return ndb.transaction_async(update)
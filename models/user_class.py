@@ -1,17 +1,111 @@
 """user_class.py - This file contains the Game class and its forms
    definitions"""
 
+import random
+import time
 from protorpc import messages
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
+from utils import LRUCache
+
+MEMCACHE_USER_PREFIX = 'USER:'
+LOCAL_USERS_SIZE = 1000
+# Writes on other instances invalidate memcache only, so the copies of
+# this instance expire after a while
+LOCAL_USERS_SECONDS = 60
+NUM_RESULT_SHARDS = 8
+MEMCACHE_RESULTS_PREFIX = 'USER_RESULTS:'
+# A total rebuilt from the shards while a rollup or an increment commits
+# can be stale when it is cached, so it expires after a while
+RESULTS_CACHE_SECONDS = 30
+
+# The (expiry time, User) of the Users recently resolved by this instance,
+# by name
+_local_users = LRUCache(LOCAL_USERS_SIZE)
 
 
 class User(ndb.Model):
-    """User profile"""
+    """User profile, keyed by the user name"""
+    # get_by_name caches the Users itself
+    _use_memcache = False
+
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
     victories = ndb.IntegerProperty(default=0)
     losses = ndb.IntegerProperty(default=0)
     ratio = ndb.FloatProperty(default=0.0)
+    # Indexed for the incremental exports
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def key_for(cls, name):
+        """Returns the key of the User with a name"""
+        return ndb.Key(cls, name)
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Returns the User with a name, or None. The User is looked up in
+        the cache of the instance, then in memcache, then by key; Users
+        created before they were keyed by name are found by a query until
+        they are migrated. The returned User must not be modified."""
+        if not name:
+            return None
+        cached = _local_users.get(name)
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+        user = memcache.get(MEMCACHE_USER_PREFIX + name)
+        if user is None:
+            user = (cls.key_for(name).get() or
+                    cls.query(cls.name == name).get())
+            if user is None:
+                return None
+            memcache.add(MEMCACHE_USER_PREFIX + name, user)
+        _local_users.set(name, (time.time() + LOCAL_USERS_SECONDS, user))
+        return user
+
+    @classmethod
+    def create(cls, name, email=None):
+        """Creates and returns the User with a name, or returns None if a
+        User with that name already exists"""
+        if cls.get_by_name(name):
+            return None
+
+        @ndb.transactional
+        def insert():
+            key = cls.key_for(name)
+            if key.get():
+                return None
+            user = cls(key=key, name=name, email=email)
+            user.put()
+            return user
+        return insert()
+
+    @staticmethod
+    def invalidate(name):
+        """Removes a User from the caches of get_by_name"""
+        _local_users.delete(name)
+        memcache.delete(MEMCACHE_USER_PREFIX + name)
+
+    def _post_put_hook(self, future):
+        if ndb.in_transaction():
+            ndb.get_context().call_on_commit(
+                lambda: self.invalidate(self.name))
+        else:
+            self.invalidate(self.name)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        if isinstance(key.id(), basestring):
+            cls.invalidate(key.id())
+
+    def add_results(self, victories, losses):
+        """Adds won and lost games to the victories and losses and updates
+        the ratio"""
+        self.victories += victories
+        self.losses += losses
+        if self.victories + self.losses:
+            self.ratio = float(self.victories) / float(
+                self.victories + self.losses)
 
     def to_form(self):
         form = UserForm()
@@ -23,6 +117,159 @@ class User(ndb.Model):
         return form
 
 
+class UserResultShard(ndb.Model):
+    """One shard of the results of a User not rolled up onto the User yet.
+    A game end adds its result to a random shard of its player, each shard
+    in its own entity group, so the games of a player ending at once do not
+    contend on the User; rollup moves the shards onto the User. The results
+    of a User are the ones of the User plus the ones of its shards"""
+    victories = ndb.IntegerProperty(default=0, indexed=False)
+    losses = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def shard_keys(cls, user_key):
+        """Returns the keys of all the shards of a User"""
+        return [ndb.Key(cls, '{}:{}'.format(user_key.urlsafe(), index))
+                for index in range(NUM_RESULT_SHARDS)]
+
+    @staticmethod
+    def cache_keys(user_key):
+        """Returns the memcache keys of the victories and losses in the
+        shards of a User"""
+        return ['won:' + user_key.urlsafe(), 'lost:' + user_key.urlsafe()]
+
+    @classmethod
+    @ndb.tasklet
+    def prepare_async(cls, user_key, victories, losses):
+        """Reads a random shard of a User and returns it with the results
+        added, ready to be put. Must be called inside a transaction.
+        Returns:
+            a Future of the UserResultShard to put"""
+        key = random.choice(cls.shard_keys(user_key))
+        shard = (yield key.get_async()) or cls(key=key)
+        shard.victories += victories
+        shard.losses += losses
+        raise ndb.Return(shard)
+
+    @classmethod
+    def offset_cache(cls, results):
+        """Applies committed results to the cached shard totals. Totals
+        that are not cached are left alone and rebuilt from the shards on
+        read.
+        Args:
+            results: a dict user key -> (victories, losses)"""
+        offsets = {}
+        for user_key, counts in results.items():
+            offsets.update(zip(cls.cache_keys(user_key), counts))
+        if offsets:
+            memcache.offset_multi(offsets, key_prefix=MEMCACHE_RESULTS_PREFIX)
+
+    @classmethod
+    def increment_multi(cls, results):
+        """Adds results to the shards of many Users, each User in its own
+        transaction, run concurrently.
+        Args:
+            results: a dict user key -> (victories, losses)"""
+        @ndb.tasklet
+        def increment(user_key, victories, losses):
+            shard = yield cls.prepare_async(user_key, victories, losses)
+            yield shard.put_async()
+
+        futures = [ndb.transaction_async(
+            lambda user_key=user_key, counts=counts: increment(user_key,
+                                                               *counts))
+            for user_key, counts in results.items()]
+        for future in futures:
+            future.get_result()
+        cls.offset_cache(results)
+
+    @classmethod
+    def pending(cls, user_keys):
+        """Returns the results in the shards of some Users, reading the
+        shards only for the Users missing from memcache.
+        Returns:
+            a dict user key -> (victories, losses)"""
+        cache_keys = dict((user_key, cls.cache_keys(user_key))
+                          for user_key in user_keys)
+        cached = memcache.get_multi(
+            [key for keys in cache_keys.values() for key in keys],
+            key_prefix=MEMCACHE_RESULTS_PREFIX)
+        results = {}
+        missing = []
+        for user_key, keys in cache_keys.items():
+            if all(key in cached for key in keys):
+                results[user_key] = tuple(cached[key] for key in keys)
+            else:
+                missing.append(user_key)
+        if missing:
+            shards = ndb.get_multi([key for user_key in missing
+                                    for key in cls.shard_keys(user_key)])
+            rebuilt = {}
+            for index, user_key in enumerate(missing):
+                found = [shard for shard in shards[
+                    index * NUM_RESULT_SHARDS:(index + 1) * NUM_RESULT_SHARDS]
+                    if shard]
+                results[user_key] = (sum(shard.victories for shard in found),
+                                     sum(shard.losses for shard in found))
+                rebuilt.update(zip(cls.cache_keys(user_key),
+                                   results[user_key]))
+            # add() does not overwrite a total another request already
+            # cached and possibly offset in the meantime
+            memcache.add_multi(rebuilt, time=RESULTS_CACHE_SECONDS,
+                               key_prefix=MEMCACHE_RESULTS_PREFIX)
+        return results
+
+    @classmethod
+    def totals(cls, users):
+        """Returns the results of some Users, rolled up or not.
+        Returns:
+            a list of (victories, losses, ratio), in the order of users"""
+        pending = cls.pending([user.key for user in users])
+        totals = []
+        for user in users:
+            victories, losses = pending[user.key]
+            victories += user.victories
+            losses += user.losses
+            played = victories + losses
+            totals.append((victories, losses,
+                           float(victories) / played if played else 0.0))
+        return totals
+
+    @classmethod
+    def rollup(cls, user_keys):
+        """Moves the results in the shards of some Users onto the Users,
+        each User in a cross-group transaction with its shards, and updates
+        their ratio, so get_user_rankings sees them.
+        Returns:
+            the Users, with all their results"""
+        def move(user_key):
+            user = user_key.get()
+            if user is None:
+                return None
+            shards = [shard for shard in ndb.get_multi(
+                cls.shard_keys(user_key)) if shard and
+                (shard.victories or shard.losses)]
+            if not shards:
+                return user
+            user.add_results(sum(shard.victories for shard in shards),
+                             sum(shard.losses for shard in shards))
+            for shard in shards:
+                shard.victories = shard.losses = 0
+            ndb.put_multi([user] + shards)
+            return user
+
+        users = []
+        for user_key in user_keys:
+            user = ndb.transaction(lambda: move(user_key), xg=True)
+            if user is not None:
+                users.append(user)
+        # The totals cached before the rollup include the moved results
+        memcache.delete_multi([key for user_key in user_keys
+                               for key in cls.cache_keys(user_key)],
+                              key_prefix=MEMCACHE_RESULTS_PREFIX)
+        return users
+
+
 class UserForm(messages.Message):
     """UserForm for outbound ranking"""
     name = messages.StringField(1, required=True)
@@ -35,6 +282,7 @@ class UserForm(messages.Message):
 class UserForms(messages.Message):
     """Return multiple UserForms"""
     items = messages.MessageField(UserForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
 
 
 class StringMessage(messages.Message):
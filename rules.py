@@ -0,0 +1,93 @@
+"""rules.py - The rules of Hangman, free of the datastore, so the API and
+the offline simulations play by the same code.
+A game state is the secret word and the masks of the correct and of the
+missed letters, with one bit per letter."""
+import string
+
+# The outcomes of a guess
+SOLVED = 'solved'
+CORRECT = 'correct'
+MISSED = 'missed'
+# The letter was guessed before
+REPEATED = 'repeated'
+# A word that is not the secret word
+NOT_A_LETTER = 'not_a_letter'
+
+
+class IllegalMove(Exception):
+    """Raised for a guess the game does not accept"""
+
+
+def letter_bit(letter):
+    """Returns the bit of a lowercase ascii letter in a letter mask"""
+    return 1 << (ord(letter) - ord('a'))
+
+
+def letters_mask(letters):
+    """Returns the mask of some lowercase ascii letters"""
+    mask = 0
+    for letter in letters:
+        mask |= letter_bit(letter)
+    return mask
+
+
+def mask_letters(mask):
+    """Returns the letters of a mask in alphabetical order"""
+    return ''.join(letter for letter in string.ascii_lowercase
+                   if mask & letter_bit(letter))
+
+
+def count_letters(mask):
+    """Returns the number of letters in a mask"""
+    return bin(mask).count('1')
+
+
+def normalize_guess(guess):
+    """Returns a guess in lowercase.
+    Raises:
+        IllegalMove: If the guess is not made of ascii letters."""
+    guess = guess.lower()
+    if not (guess.isalpha() and all(c in string.ascii_lowercase
+                                    for c in guess)):
+        raise IllegalMove(
+            'Illegal guess: you have to insert a proper single letter!')
+    return guess
+
+
+def judge(secret, correct_mask, missed_mask, guess):
+    """Applies a normalized guess, a letter or a whole word, to a game
+    state.
+    Returns:
+        an (outcome, correct_mask, missed_mask) tuple with the new state"""
+    if guess == secret:
+        return SOLVED, correct_mask, missed_mask
+    if len(guess) != 1:
+        return NOT_A_LETTER, correct_mask, missed_mask
+    bit = letter_bit(guess)
+    if (correct_mask | missed_mask) & bit:
+        return REPEATED, correct_mask, missed_mask
+    if bit & letters_mask(secret):
+        return CORRECT, correct_mask | bit, missed_mask
+    return MISSED, correct_mask, missed_mask | bit
+
+
+def attempts_remaining(missed_mask, attempts_allowed):
+    """Returns the number of misses a player can still make"""
+    return attempts_allowed - count_letters(missed_mask)
+
+
+def is_lost(missed_mask, attempts_allowed):
+    """Tells if a player has run out of attempts"""
+    return count_letters(missed_mask) >= attempts_allowed
+
+
+def is_revealed(secret, correct_mask):
+    """Tells if every letter of the secret word has been guessed"""
+    return not letters_mask(secret) & ~correct_mask
+
+
+def revealed_word(secret, correct_mask):
+    """Returns the secret word with a - in place of each letter not
+    guessed yet"""
+    return ''.join(letter if correct_mask & letter_bit(letter) else '-'
+                   for letter in secret)
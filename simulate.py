@@ -0,0 +1,210 @@
+"""simulate.py - Offline simulation of Hangman games, to tune the attempts
+allowed and the difficulty of the categories.
+Plays a guessing strategy on every word of the dictionary with the rules
+the API uses, over a pool of processes, and reports by category, and
+optionally by word, the win rates and the distribution of the missed
+guesses. A game is played until the word is solved, so one game gives its
+outcome for every number of attempts allowed: it is won if it missed fewer
+letters than the attempts. Usage:
+    python simulate.py [--strategy candidates] [--attempts 6 8 10]
+        [--games-per-word 1] [--processes N] [--seed 0]
+        [--per-word FILE]"""
+import argparse
+import csv
+import multiprocessing
+import random
+import string
+import sys
+from collections import defaultdict
+
+import rules
+from dictionary import get_dictionary
+
+# English letters from the most to the least frequent
+FREQUENCY_ORDER = 'etaoinshrdlcumwfgypbvkjxqz'
+# The words a worker plays per task
+CHUNK_SIZE = 20
+
+
+def frequency_strategy(revealed, missed_mask, words, rng):
+    """Guesses the letters in the order of their frequency in English"""
+    guessed = rules.letters_mask(c for c in revealed if c != '-') | \
+        missed_mask
+    for letter in FREQUENCY_ORDER:
+        if not guessed & rules.letter_bit(letter):
+            return letter
+
+
+def random_strategy(revealed, missed_mask, words, rng):
+    """Guesses a random letter not guessed yet"""
+    guessed = rules.letters_mask(c for c in revealed if c != '-') | \
+        missed_mask
+    return rng.choice([letter for letter in string.ascii_lowercase
+                       if not guessed & rules.letter_bit(letter)])
+
+
+def candidates_strategy(revealed, missed_mask, words, rng):
+    """Guesses the letter not guessed yet found in the most words of the
+    category that match the revealed letters and the missed letters, as
+    the get_hint endpoint does"""
+    correct_mask = rules.letters_mask(c for c in revealed if c != '-')
+    guessed = correct_mask | missed_mask
+    hits = defaultdict(int)
+    for word in words:
+        if len(word) != len(revealed):
+            continue
+        mask = rules.letters_mask(word)
+        if mask & missed_mask or rules.revealed_word(
+                word, correct_mask) != revealed:
+            continue
+        for letter in rules.mask_letters(mask & ~guessed):
+            hits[letter] += 1
+    if not hits:
+        return frequency_strategy(revealed, missed_mask, words, rng)
+    return min(hits, key=lambda letter: (-hits[letter], letter))
+
+
+STRATEGIES = {
+    'frequency': frequency_strategy,
+    'random': random_strategy,
+    'candidates': candidates_strategy,
+}
+
+
+def play(word, strategy, words, rng):
+    """Plays a game until the word is solved, guessing the whole word as
+    soon as all its letters are revealed.
+    Returns:
+        the number of missed letters"""
+    correct_mask = missed_mask = 0
+    while True:
+        revealed = rules.revealed_word(word, correct_mask)
+        if rules.is_revealed(word, correct_mask):
+            guess = word
+        else:
+            guess = strategy(revealed, missed_mask, words, rng)
+        outcome, correct_mask, missed_mask = rules.judge(
+            word, correct_mask, missed_mask, guess)
+        if outcome == rules.SOLVED:
+            return rules.count_letters(missed_mask)
+        if outcome not in (rules.CORRECT, rules.MISSED):
+            raise ValueError('Invalid guess {!r} for {!r}'.format(guess,
+                                                                   word))
+
+
+def play_chunk(task):
+    """Plays the games of a range of words of a category.
+    Args:
+        task: a (category id, start, end, strategy name, games per word,
+        seed) tuple, start and end being indexes of the dictionary
+    Returns:
+        a list of (category id, word, missed letters of every game)"""
+    category_id, start, end, strategy, games, seed = task
+    dictionary = get_dictionary()
+    words = dictionary.words(category_id)
+    results = []
+    for index in range(start, end):
+        word = dictionary.word(index)
+        missed = []
+        for game in range(games):
+            rng = random.Random('{}:{}:{}'.format(seed, index, game))
+            missed.append(play(word, STRATEGIES[strategy], words, rng))
+        results.append((category_id, word, missed))
+    return results
+
+
+def tasks(strategy, games, seed):
+    """Splits the words of the dictionary in tasks of CHUNK_SIZE words"""
+    for category in get_dictionary().categories:
+        for start in range(category.start, category.end, CHUNK_SIZE):
+            yield (category.id, start, min(start + CHUNK_SIZE, category.end),
+                   strategy, games, seed)
+
+
+def simulate(strategy, games, seed, processes):
+    """Plays every word of the dictionary.
+    Returns:
+        a list of (category id, word, missed letters of every game)"""
+    work = list(tasks(strategy, games, seed))
+    if processes == 1:
+        chunks = map(play_chunk, work)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            chunks = list(pool.imap_unordered(play_chunk, work))
+        finally:
+            pool.close()
+            pool.join()
+    return [result for chunk in chunks for result in chunk]
+
+
+def win_rate(missed, attempts):
+    """Returns the fraction of games that missed fewer letters than the
+    attempts allowed"""
+    return float(sum(1 for m in missed if m < attempts)) / len(missed)
+
+
+def report(results, attempts):
+    """Prints the win rates and the missed letters distribution of every
+    category"""
+    names = dict((category.id, category.name)
+                 for category in get_dictionary().categories)
+    by_category = defaultdict(list)
+    for category_id, _, missed in results:
+        by_category[category_id].extend(missed)
+    print '{:<12} {:>7} {:>7}  {}'.format(
+        'category', 'games', 'missed', '  '.join(
+            'win@{:<3}'.format(a) for a in attempts))
+    for category_id, missed in sorted(by_category.items()):
+        print '{:<12} {:>7} {:>7.2f}  {}'.format(
+            names[category_id], len(missed),
+            float(sum(missed)) / len(missed), '  '.join(
+                '{:>7.1%}'.format(win_rate(missed, a)) for a in attempts))
+    print
+    print 'Games by missed letters'
+    for category_id, missed in sorted(by_category.items()):
+        counts = defaultdict(int)
+        for m in missed:
+            counts[m] += 1
+        print '{:<12} {}'.format(names[category_id], ' '.join(
+            '{}:{}'.format(m, counts[m]) for m in sorted(counts)))
+
+
+def write_per_word(results, attempts, path):
+    """Writes the results of every word as CSV"""
+    names = dict((category.id, category.name)
+                 for category in get_dictionary().categories)
+    with open(path, 'wb') as per_word:
+        writer = csv.writer(per_word)
+        writer.writerow(['category', 'word', 'games', 'mean_missed'] +
+                        ['win_rate_{}'.format(a) for a in attempts])
+        for category_id, word, missed in sorted(results):
+            writer.writerow(
+                [names[category_id], word, len(missed),
+                 '{:.3f}'.format(float(sum(missed)) / len(missed))] +
+                ['{:.3f}'.format(win_rate(missed, a)) for a in attempts])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--strategy', choices=sorted(STRATEGIES),
+                        default='candidates')
+    parser.add_argument('--attempts', type=int, nargs='+', default=[10],
+                        help='attempts allowed to report win rates for')
+    parser.add_argument('--games-per-word', type=int, default=1)
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--per-word', help='CSV file of per word results')
+    args = parser.parse_args(argv)
+
+    results = simulate(args.strategy, args.games_per_word, args.seed,
+                       args.processes)
+    report(results, args.attempts)
+    if args.per_word:
+        write_per_word(results, args.attempts, args.per_word)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,196 @@
+"""startup.py - Profiler of the cold start of an instance.
+Imports each entry point of the app (main, api) in a fresh process, as a
+new instance does, and reports the time spent importing every module, with
+and without the modules it imports, the time spent in endpoints.api_server
+and the time the word dictionary takes to load. Usage:
+    python startup.py --sdk PATH_TO_APPENGINE_SDK [--modules main api]
+        [--repeat 5] [--top 20] [--budget main=1200 api=1500]
+Exits with status 1 if the median import time of an entry point exceeds
+its budget in milliseconds, or if it loads a module that is meant to be
+imported only by the handlers using it."""
+import __builtin__
+import argparse
+import json
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+from benchmark import setup_sdk
+
+# The import time budgets of the entry points, in milliseconds. The
+# datastore modules of the SDK alone take about 650 ms to import
+DEFAULT_BUDGETS_MS = {'main': 1200, 'api': 1500}
+
+# The modules each entry point must not load at import time
+DEFERRED_MODULES = {
+    'main': ['endpoints', 'numpy', 'hints', 'migrations', 'exports',
+             'simulate'],
+    'api': ['numpy', 'hints', 'migrations', 'exports', 'simulate'],
+}
+
+
+class ImportProfiler(object):
+    """Replaces the import function to time the imports that load new
+    modules: the total time of each import and its own time, without the
+    imports nested in it. on_import, if given, is called after every
+    import"""
+
+    def __init__(self, on_import=None):
+        self.total = defaultdict(float)
+        self.own = defaultdict(float)
+        self.on_import = on_import
+        self._nested = []
+        self._import = __builtin__.__import__
+
+    def __call__(self, name, *args, **kwargs):
+        loaded = len(sys.modules)
+        self._nested.append(0.0)
+        start = time.time()
+        try:
+            return self._import(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+            if len(sys.modules) > loaded:
+                self.total[name] += elapsed
+                self.own[name] += elapsed - nested
+                if self.on_import:
+                    self.on_import()
+
+    def install(self):
+        __builtin__.__import__ = self
+
+    def uninstall(self):
+        __builtin__.__import__ = self._import
+
+
+def profile(module):
+    """Imports an entry point and returns its timings in milliseconds and
+    the names of the modules it loaded"""
+    api_server = [0.0]
+
+    def time_api_server():
+        """Times endpoints.api_server once the entry point imported
+        endpoints, so the entry points that do not import it are not
+        charged for it"""
+        endpoints = sys.modules.get('endpoints')
+        if endpoints is None or not hasattr(endpoints, 'api_server') or \
+                hasattr(endpoints.api_server, 'timed'):
+            return
+        original = endpoints.api_server
+
+        def timed_api_server(*args, **kwargs):
+            started = time.time()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                api_server[0] += time.time() - started
+        timed_api_server.timed = True
+        endpoints.api_server = timed_api_server
+
+    profiler = ImportProfiler(time_api_server)
+    before = set(sys.modules)
+    start = time.time()
+    profiler.install()
+    try:
+        __import__(module)
+    finally:
+        profiler.uninstall()
+    total = time.time() - start
+    loaded = sorted(name for name in set(sys.modules) - before
+                    if sys.modules[name] is not None)
+    from dictionary import get_dictionary
+    start = time.time()
+    get_dictionary()
+    dictionary = time.time() - start
+    return {
+        'total_ms': total * 1000,
+        'api_server_ms': api_server[0] * 1000,
+        'dictionary_ms': dictionary * 1000,
+        'loaded': loaded,
+        'modules': sorted([[name, profiler.total[name] * 1000,
+                            profiler.own[name] * 1000]
+                           for name in profiler.total],
+                          key=lambda module: -module[2]),
+    }
+
+
+def run_child(sdk, module):
+    """Profiles an entry point in a fresh interpreter"""
+    output = subprocess.check_output([sys.executable, __file__,
+                                      '--sdk', sdk, '--child', module])
+    return json.loads(output)
+
+
+def report(module, runs, top):
+    """Prints the timings of the median run of an entry point.
+    Returns:
+        the median total import time"""
+    runs = sorted(runs, key=lambda run: run['total_ms'])
+    median = runs[len(runs) // 2]
+    print '{}: import {:.1f} ms (min {:.1f}, max {:.1f}), ' \
+          'endpoints.api_server {:.1f} ms, dictionary load {:.1f} ms'.format(
+              module, median['total_ms'], runs[0]['total_ms'],
+              runs[-1]['total_ms'], median['api_server_ms'],
+              median['dictionary_ms'])
+    print '  {:<48} {:>9} {:>9}'.format('module', 'total ms', 'own ms')
+    for name, total, own in median['modules'][:top]:
+        print '  {:<48} {:>9.1f} {:>9.1f}'.format(name, total, own)
+    return median['total_ms']
+
+
+def eager_modules(module, run):
+    """Returns the deferred modules that a run of an entry point loaded"""
+    return [name for name in DEFERRED_MODULES.get(module, [])
+            if name in run['loaded']]
+
+
+def parse_budgets(values):
+    """Returns the budgets given as module=milliseconds"""
+    budgets = dict(DEFAULT_BUDGETS_MS)
+    for value in values:
+        module, _, budget = value.partition('=')
+        budgets[module] = float(budget)
+    return budgets
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', required=True,
+                        help='path of the App Engine python SDK')
+    parser.add_argument('--modules', nargs='+', default=['main', 'api'])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='fresh processes per entry point')
+    parser.add_argument('--top', type=int, default=20,
+                        help='modules listed by own import time')
+    parser.add_argument('--budget', nargs='*', default=[],
+                        help='import time budgets as module=milliseconds')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        setup_sdk(args.sdk)
+        print json.dumps(profile(args.child))
+        return 0
+    budgets = parse_budgets(args.budget)
+    over = []
+    for module in args.modules:
+        runs = [run_child(args.sdk, module) for _ in range(args.repeat)]
+        total = report(module, runs, args.top)
+        if module in budgets and total > budgets[module]:
+            over.append('{} import {:.1f} ms > budget {:.1f} ms'.format(
+                module, total, budgets[module]))
+        eager = sorted(set(name for run in runs
+                           for name in eager_modules(module, run)))
+        if eager:
+            over.append('{} imports {}'.format(module, ', '.join(eager)))
+    for message in over:
+        print 'OVER BUDGET', message
+    return 1 if over else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
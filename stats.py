@@ -0,0 +1,97 @@
+"""stats.py - Live game statistics served from the sharded counters
+maintained by the game endpoints, and the aggregations that reconcile
+them."""
+from dictionary import get_dictionary
+from models.stats_class import (
+    StatShard,
+    CategoryStatsForm,
+    CategoryStatsForms,
+    HistogramBucketForm,
+    HistogramForm,
+    ACTIVE_GAMES,
+    ACTIVE_ATTEMPTS,
+    won_counter,
+    lost_counter,
+    guesses_counter,
+)
+
+MAX_GUESSES = 10
+RECONCILE_BATCH_SIZE = 500
+RECONCILE_SHARDS = 8
+# The aggregations of migrations.py that recompute the counters
+RECONCILE_RUNS = ['active_game_stats', 'score_stats']
+
+
+def average_attempts_message():
+    """Returns the message with the average attempts remaining of the
+    active games, or an empty string if there are no active games"""
+    totals = StatShard.get_totals([ACTIVE_GAMES, ACTIVE_ATTEMPTS])
+    if totals[ACTIVE_GAMES] <= 0:
+        return ''
+    average = float(totals[ACTIVE_ATTEMPTS]) / totals[ACTIVE_GAMES]
+    return 'The average moves remaining is {:.2f}'.format(average)
+
+
+def category_stats_forms():
+    """Returns the CategoryStatsForms with the win rate of every category"""
+    categories = [category.id for category in get_dictionary().categories]
+    names = []
+    for category in categories:
+        names.extend([won_counter(category), lost_counter(category)])
+    totals = StatShard.get_totals(names)
+    items = []
+    for category in categories:
+        won = totals[won_counter(category)]
+        lost = totals[lost_counter(category)]
+        played = won + lost
+        items.append(CategoryStatsForm(
+            word_category=category,
+            won=won,
+            lost=lost,
+            win_rate=float(won) / played if played else 0.0))
+    return CategoryStatsForms(items=items)
+
+
+def histogram_form():
+    """Returns the HistogramForm with the number of games won for each
+    number of guesses"""
+    buckets = range(MAX_GUESSES + 1)
+    totals = StatShard.get_totals([guesses_counter(n) for n in buckets])
+    return HistogramForm(items=[
+        HistogramBucketForm(guesses=n, games=totals[guesses_counter(n)])
+        for n in buckets])
+
+
+def reconcile(shards=RECONCILE_SHARDS):
+    """Starts the runs of the aggregations that recompute every counter
+    from the Game and Score entities, walking them in batches over key
+    ranges, and overwrite the shards once they are done, correcting any
+    drift. Updates committed while the runs are in progress can be lost,
+    and are corrected by the next run.
+    Returns:
+        the ids of the runs"""
+    import migrations
+    # The deltas queued before the runs are counted by the recomputed
+    # totals, so they are applied first rather than on top of them
+    StatShard.update_from_queue()
+    return [migrations.start(name, shards) for name in RECONCILE_RUNS]
+
+
+def reset_active_games(totals):
+    """Overwrites the counters of the active games with the totals of a
+    run"""
+    StatShard.reset_multi({ACTIVE_GAMES: totals.get(ACTIVE_GAMES, 0),
+                           ACTIVE_ATTEMPTS: totals.get(ACTIVE_ATTEMPTS, 0)})
+
+
+def reset_scores(totals):
+    """Overwrites the counters of the won and lost games with the totals
+    of a run, zeroing the counters without a Score"""
+    counters = {}
+    for category in get_dictionary().categories:
+        counters[won_counter(category.id)] = 0
+        counters[lost_counter(category.id)] = 0
+    for n in range(MAX_GUESSES + 1):
+        counters[guesses_counter(n)] = 0
+    counters.update(totals)
+    StatShard.reset_multi(counters)
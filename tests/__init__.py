@@ -0,0 +1,3 @@
+"""The tests of the Hangman API, run against the App Engine testbed:
+    APPENGINE_SDK=PATH_TO_APPENGINE_SDK python -m unittest discover tests
+They are skipped when APPENGINE_SDK is not set."""
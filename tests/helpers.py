@@ -0,0 +1,61 @@
+"""helpers.py - The base class of the tests run against the testbed stubs
+of the benchmark, with the players and games they share."""
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from benchmark import Benchmark, setup_sdk
+
+SDK = os.environ.get('APPENGINE_SDK')
+
+
+@unittest.skipUnless(SDK, 'APPENGINE_SDK is not set')
+class TestbedCase(unittest.TestCase):
+    """Activates the testbed stubs of a Benchmark around each test, with
+    the API module and an instance of its service"""
+
+    @classmethod
+    def setUpClass(cls):
+        setup_sdk(SDK)
+
+    def setUp(self):
+        self.benchmark = Benchmark(0, 0, 0, 1)
+        self.benchmark.activate()
+        self.api = self.benchmark.api
+        self.service = self.benchmark.service
+        self.request = self.benchmark.request
+
+    def tearDown(self):
+        self.benchmark.deactivate()
+
+    def player(self, name='player'):
+        """Returns the name of a player of this test. The name is prefixed
+        with the test, as the instance caches of the Users outlive the
+        testbed"""
+        return '{}-{}'.format(self._testMethodName, name)
+
+    def create_player(self, name='player', games=1):
+        """Creates the User of a player of this test and its games of the
+        first category, returning the keys of the games"""
+        self.service.create_user(self.request(self.api.USER_REQUEST,
+                                              user_name=self.player(name)))
+        return [self.new_game(name) for _ in range(games)]
+
+    def new_game(self, name='player'):
+        """Creates a game of a player of this test and returns its key"""
+        from google.appengine.ext import ndb
+        return ndb.Key(urlsafe=self.service.new_game(self.request(
+            self.api.NEW_GAME_REQUEST, user_name=self.player(name),
+            category='1')).urlsafe_key)
+
+    def make_move(self, key, guess):
+        """Makes a move in a game and returns the GameForm"""
+        return self.service.make_move(self.request(
+            self.api.MAKE_MOVE_REQUEST, urlsafe_game_key=key.urlsafe(),
+            guess=guess))
+
+    def win(self, key):
+        """Guesses the secret word of a game"""
+        return self.make_move(key, key.get().secretWord)
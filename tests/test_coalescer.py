@@ -0,0 +1,61 @@
+"""test_coalescer.py - A write of the coalesced moves of a game interrupted
+by the request deadline fails the moves waiting for it and leaves the game
+free for the next move."""
+import threading
+import unittest
+
+import helpers
+
+
+class DeadlineTest(helpers.TestbedCase):
+
+    def setUp(self):
+        super(DeadlineTest, self).setUp()
+        self.key, = self.create_player()
+
+    def test_deadline_fails_waiting_moves(self):
+        import coalescer
+        from google.appengine.runtime import DeadlineExceededError
+        from models.game_class import Game
+        writing = threading.Event()
+        queued = threading.Event()
+        add_moves = Game.add_moves
+
+        def interrupted(game, results):
+            writing.set()
+            queued.wait(5)
+            raise DeadlineExceededError()
+        outcomes = {}
+
+        def move(name, guess):
+            """Makes a move in a thread, which the test does not wait for
+            if the move hangs"""
+            try:
+                outcomes[name] = coalescer.make_move(self.key, guess)
+            except BaseException, e:
+                outcomes[name] = e
+
+        Game.add_moves = interrupted
+        try:
+            writer = threading.Thread(target=move, args=('writer', 'q'))
+            writer.daemon = True
+            writer.start()
+            writing.wait(5)
+            waiter = threading.Thread(target=move, args=('waiter', 'x'))
+            waiter.daemon = True
+            waiter.start()
+            while not coalescer._pending.get(self.key):
+                waiter.join(0.01)
+            queued.set()
+            writer.join(5)
+            waiter.join(5)
+        finally:
+            Game.add_moves = add_moves
+        self.assertIsInstance(outcomes['writer'], DeadlineExceededError)
+        self.assertIsInstance(outcomes['waiter'], coalescer.GameBusy)
+        self.assertNotIn(self.key, coalescer._pending)
+        self.assertIsNotNone(coalescer.make_move(self.key, 'z'))
+
+
+if __name__ == '__main__':
+    unittest.main()
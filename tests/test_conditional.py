@@ -0,0 +1,62 @@
+"""test_conditional.py - A conditional get_game or get_game_history of an
+unchanged game answers, through the Cloud Endpoints server, a normal
+response flagged unchanged."""
+import json
+import unittest
+
+import helpers
+
+
+class ConditionalTest(helpers.TestbedCase):
+
+    def setUp(self):
+        super(ConditionalTest, self).setUp()
+        self.key = self.create_player()[0].urlsafe()
+
+    def call(self, method, headers=None, **fields):
+        """Calls a method through the endpoints server of the API.
+        Returns:
+            the HTTP status code and the decoded JSON body"""
+        import webob
+        fields['urlsafe_game_key'] = self.key
+        request = webob.Request.blank(
+            '/_ah/spi/Hangman.' + method, method='POST',
+            body=json.dumps(fields), content_type='application/json',
+            headers=headers or {},
+            environ={'SERVER_SOFTWARE': 'Development/2.0'})
+        response = request.get_response(self.api.api)
+        return response.status_int, json.loads(response.body)
+
+    def test_get_game(self):
+        status, game = self.call('get_game')
+        self.assertEqual(status, 200)
+        self.assertIn('message', game)
+        status, unchanged = self.call('get_game', if_none_match=game['etag'])
+        self.assertEqual(status, 200)
+        self.assertEqual(unchanged, {'urlsafe_key': self.key,
+                                     'etag': game['etag'],
+                                     'unchanged': True})
+        status, unchanged = self.call(
+            'get_game', headers={'If-None-Match': '"{}"'.format(
+                game['etag'])})
+        self.assertTrue(unchanged.get('unchanged'))
+        self.call('make_move', guess='e')
+        status, moved = self.call('get_game', if_none_match=game['etag'])
+        self.assertEqual(status, 200)
+        self.assertNotIn('unchanged', moved)
+        self.assertNotEqual(moved['etag'], game['etag'])
+
+    def test_get_game_history(self):
+        self.call('make_move', guess='e')
+        status, page = self.call('get_game_history')
+        self.assertEqual(status, 200)
+        self.assertEqual(len(page['items']), 1)
+        status, unchanged = self.call('get_game_history',
+                                      if_none_match=page['etag'])
+        self.assertEqual(status, 200)
+        self.assertEqual(unchanged, {'etag': page['etag'],
+                                     'unchanged': True})
+
+
+if __name__ == '__main__':
+    unittest.main()
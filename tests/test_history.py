@@ -0,0 +1,136 @@
+"""test_history.py - The pickled history of the Games created before the
+Moves is read without being written, and converted to Moves by the
+compare-and-set transaction of the next move."""
+import string
+import unittest
+
+import helpers
+
+LEGACY_MOVES = 3
+
+
+class LegacyHistoryTest(helpers.TestbedCase):
+
+    def setUp(self):
+        super(LegacyHistoryTest, self).setUp()
+        self.key = self.legacy_game()
+
+    def legacy_game(self):
+        """Creates a Game with a pickled history of LEGACY_MOVES moves and
+        no Moves, as the Games created before the Moves"""
+        import pickle
+        from google.appengine.api import memcache
+        key, = self.create_player()
+        game = key.get()
+        history = []
+        for letter in self.unguessed(game)[:LEGACY_MOVES]:
+            history.append({'guess': letter,
+                            'answer': game.play(letter).message})
+        game.game_history = pickle.dumps(history)
+        game.put()
+        # The old Games have no state in memcache
+        memcache.flush_all()
+        return key
+
+    def unguessed(self, game):
+        """Returns the letters missing from the secret word and not guessed
+        yet, so the moves of a test never end the game"""
+        return [letter for letter in string.ascii_lowercase
+                if letter not in game.secretWord.lower() and
+                not game.is_guessed(letter)]
+
+    def stored(self):
+        """Returns the stored Game and the number of its Moves"""
+        from models.move_class import Move
+        game = self.key.get(use_cache=False, use_memcache=False)
+        return game, Move.query_game(self.key).count()
+
+    def test_reads_do_not_write(self):
+        request = self.request
+        urlsafe = self.key.urlsafe()
+        before, _ = self.stored()
+        first = self.service.get_game_history(request(
+            self.api.GAME_PAGE_REQUEST, urlsafe_game_key=urlsafe,
+            page_size=2))
+        second = self.service.get_game_history(request(
+            self.api.GAME_PAGE_REQUEST, urlsafe_game_key=urlsafe,
+            page_size=2, page_token=first.next_page_token))
+        self.assertEqual([move.sequence for move in first.items], [1, 2])
+        self.assertEqual([move.sequence for move in second.items], [3])
+        self.assertIsNone(second.next_page_token)
+        changes = self.service.get_game_changes(request(
+            self.api.GAME_CHANGES_REQUEST, urlsafe_game_key=urlsafe,
+            after=1, timeout=0))
+        self.assertEqual([move.sequence for move in changes.items], [2, 3])
+        self.assertEqual(changes.sequence, LEGACY_MOVES)
+        game, moves = self.stored()
+        self.assertEqual(moves, 0)
+        self.assertEqual(game.game_history, before.game_history)
+        self.assertEqual(game.version, before.version)
+
+    def test_move_converts_history(self):
+        before, _ = self.stored()
+        self.make_move(self.key, self.unguessed(before)[0])
+        game, moves = self.stored()
+        self.assertIsNone(game.game_history)
+        self.assertEqual(game.moves, LEGACY_MOVES + 1)
+        self.assertEqual(moves, LEGACY_MOVES + 1)
+        self.assertEqual(game.version, before.version + 1)
+
+    def test_stale_copy_does_not_convert_again(self):
+        from models.game_class import StaleGame
+        stale, _ = self.stored()
+        letters = self.unguessed(stale)
+        self.make_move(self.key, letters[0])
+        result = stale.play(letters[1])
+        with self.assertRaises(StaleGame):
+            stale.add_moves([result])
+        game, moves = self.stored()
+        self.assertEqual(game.moves, LEGACY_MOVES + 1)
+        self.assertEqual(moves, LEGACY_MOVES + 1)
+
+    def empty_history(self):
+        """Stores a pickled empty history on the Game, as the Games created
+        with an empty PickleProperty before the Moves"""
+        import pickle
+        from google.appengine.api import memcache
+        game = self.key.get(use_cache=False, use_memcache=False)
+        game.game_history = pickle.dumps([], 2)
+        game.put()
+        memcache.flush_all()
+        return game
+
+    def history(self):
+        """Returns the sequence numbers of the history of the Game"""
+        return [move.sequence for move in self.service.get_game_history(
+            self.request(self.api.GAME_PAGE_REQUEST,
+                                   urlsafe_game_key=self.key.urlsafe())
+        ).items]
+
+    def test_move_clears_empty_history(self):
+        game = self.empty_history()
+        game.moves = 0
+        game.put()
+        self.make_move(self.key, self.unguessed(game)[0])
+        self.assertEqual(self.history(), [1])
+        stored, moves = self.stored()
+        self.assertIsNone(stored.game_history)
+        self.assertEqual(stored.moves, 1)
+        self.assertEqual(moves, 1)
+        self.assertEqual(stored.version, game.version + 1)
+
+    def test_migration_clears_empty_history(self):
+        import migrations
+        self.make_move(self.key, self.unguessed(self.stored()[0])[0])
+        before = self.empty_history()
+        self.assertEqual(self.history(), range(1, LEGACY_MOVES + 2))
+        migrations._migrations['game_histories'].apply([self.key])
+        game, moves = self.stored()
+        self.assertIsNone(game.game_history)
+        self.assertEqual(game.moves, LEGACY_MOVES + 1)
+        self.assertEqual(moves, LEGACY_MOVES + 1)
+        self.assertEqual(game.version, before.version + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+"""test_make_moves.py - A batch of moves whose write fails for one game
+reports the error on the moves of that game and writes the others."""
+import unittest
+
+import helpers
+
+
+class FailedWriteTest(helpers.TestbedCase):
+
+    def setUp(self):
+        super(FailedWriteTest, self).setUp()
+        self.keys = self.create_player(games=2)
+
+    def test_failed_game_reports_errors(self):
+        from google.appengine.ext import ndb
+        from models.game_class import BatchMoveForm, Game, MakeMovesForm
+        broken, written = self.keys
+        write_moves_async = Game.write_moves_async
+
+        def failing(game, results):
+            if game.key != broken:
+                return write_moves_async(game, results)
+            future = ndb.Future()
+            future.set_exception(RuntimeError('commit failed'))
+            return future
+
+        Game.write_moves_async = failing
+        try:
+            response = self.service.make_moves(MakeMovesForm(moves=[
+                BatchMoveForm(urlsafe_game_key=key.urlsafe(), guess=guess)
+                for key in (broken, written) for guess in 'ae']))
+        finally:
+            Game.write_moves_async = write_moves_async
+        for item in response.items[:2]:
+            self.assertIsNone(item.game)
+            self.assertTrue(item.error)
+        for item in response.items[2:]:
+            self.assertIsNotNone(item.game)
+            self.assertIsNone(item.error)
+        self.assertEqual(broken.get(use_cache=False,
+                                    use_memcache=False).moves, 0)
+        self.assertEqual(written.get(use_cache=False,
+                                     use_memcache=False).moves, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
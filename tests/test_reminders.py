@@ -0,0 +1,31 @@
+"""test_reminders.py - Overlapping reminder runs claim every User once."""
+import threading
+import unittest
+
+import helpers
+
+USERS = 30
+RUNS = 4
+
+
+class ClaimTest(helpers.TestbedCase):
+
+    def test_overlapping_claims(self):
+        from google.appengine.ext import ndb
+        from models.reminder_class import Reminder
+        keys = [ndb.Key('User', 'player{}'.format(index))
+                for index in range(USERS)]
+        claimed = []
+        threads = [threading.Thread(
+            target=lambda: claimed.extend(Reminder.claim(keys)))
+            for _ in range(RUNS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(claimed), sorted(keys))
+        self.assertEqual(Reminder.claim(keys), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+"""test_rpc_counts.py - The forms of the Games and Scores are rendered with
+the same datastore RPCs whatever the number of rows, through the testbed
+and the RPC counter of the benchmark."""
+import unittest
+
+import helpers
+
+ROWS = 10
+
+
+class RenderRpcCountTest(helpers.TestbedCase):
+
+    def datastore_rpcs(self, call, cold=False):
+        """Returns the datastore RPCs of a call, by call name. With cold,
+        the ndb caches and memcache are emptied first"""
+        from google.appengine.api import memcache
+        from google.appengine.ext import ndb
+        if cold:
+            memcache.flush_all()
+            ndb.get_context().clear_cache()
+        self.benchmark.counter.start()
+        call()
+        return dict((name, count) for name, count
+                    in self.benchmark.counter.stop().items()
+                    if name.startswith('datastore_v3.'))
+
+    def unnamed(self, entities):
+        """Removes the stored user names of some entities, as the entities
+        written before the names were stored, and returns them"""
+        from google.appengine.ext import ndb
+        for entity in entities:
+            entity.user_name = None
+        ndb.put_multi(entities)
+        return entities
+
+    def test_game_forms(self):
+        from google.appengine.ext import ndb
+        from models.game_class import Game
+        keys = [self.create_player('player{}'.format(index), 1)[0]
+                for index in range(ROWS)]
+        games = self.unnamed(ndb.get_multi(keys))
+        one = self.datastore_rpcs(
+            lambda: Game.to_forms(games[:1], 'message'), cold=True)
+        many = self.datastore_rpcs(
+            lambda: Game.to_forms(games, 'message'), cold=True)
+        self.assertEqual(one, {'datastore_v3.Get': 1})
+        self.assertEqual(one, many)
+
+    def test_active_games(self):
+        self.create_player('one', 1)
+        self.create_player('many', ROWS)
+
+        def active_games(name):
+            request = self.request(self.api.USER_PAGE_REQUEST,
+                                             user_name=self.player(name))
+            return lambda: self.service.get_user_active_games(request)
+        for name in ('one', 'many'):
+            active_games(name)()
+        self.assertEqual(self.datastore_rpcs(active_games('one')),
+                         self.datastore_rpcs(active_games('many')))
+        self.assertEqual(len(active_games('many')().items), ROWS)
+
+    def test_score_forms(self):
+        from google.appengine.ext import ndb
+        from models.score_class import Score
+        keys = [self.create_player('player{}'.format(index), 1)[0]
+                for index in range(ROWS)]
+        for key in keys:
+            self.win(key)
+        scores = self.unnamed(ndb.get_multi(
+            [Score.key_for(key) for key in keys]))
+        one = self.datastore_rpcs(lambda: Score.to_forms(scores[:1]),
+                                  cold=True)
+        many = self.datastore_rpcs(lambda: Score.to_forms(scores),
+                                   cold=True)
+        self.assertEqual(one, {'datastore_v3.Get': 1})
+        self.assertEqual(one, many)
+
+    def test_user_scores(self):
+        for name, games in (('one', 1), ('many', ROWS)):
+            for key in self.create_player(name, games):
+                self.win(key)
+
+        def user_scores(name):
+            request = self.request(self.api.USER_PAGE_REQUEST,
+                                             user_name=self.player(name))
+            return lambda: self.service.get_user_scores(request)
+        for name in ('one', 'many'):
+            user_scores(name)()
+        self.assertEqual(self.datastore_rpcs(user_scores('one')),
+                         self.datastore_rpcs(user_scores('many')))
+        self.assertEqual(len(user_scores('many')().items), ROWS)
+
+
+if __name__ == '__main__':
+    unittest.main()
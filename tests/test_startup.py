@@ -0,0 +1,35 @@
+"""test_startup.py - The entry points are imported in a fresh interpreter,
+as a new instance does, within their import time budget and without the
+modules that only some handlers use, through the profiler of startup."""
+import unittest
+
+from helpers import SDK
+import startup
+
+RUNS = 3
+
+
+@unittest.skipUnless(SDK, 'APPENGINE_SDK is not set')
+class StartupTest(unittest.TestCase):
+
+    def check(self, module):
+        """Imports an entry point in fresh interpreters and checks the
+        median run against its budget and its deferred modules"""
+        runs = sorted([startup.run_child(SDK, module) for _ in range(RUNS)],
+                      key=lambda run: run['total_ms'])
+        median = runs[len(runs) // 2]
+        self.assertIn(module, median['loaded'])
+        self.assertLessEqual(median['total_ms'],
+                             startup.DEFAULT_BUDGETS_MS[module])
+        for run in runs:
+            self.assertEqual(startup.eager_modules(module, run), [])
+
+    def test_main(self):
+        self.check('main')
+
+    def test_api(self):
+        self.check('api')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+"""test_stats.py - The moves queue the deltas of the live statistics
+counters in their transaction instead of writing the shared shards, and
+the cron job adds them to the counters. The reconciliation recomputes
+the counters in batched runs."""
+import unittest
+
+import helpers
+
+
+class QueuedStatsTest(helpers.TestbedCase):
+
+    def setUp(self):
+        super(QueuedStatsTest, self).setUp()
+        self.key, = self.create_player()
+
+    def shards(self):
+        """Returns the counts of the stored StatShards, by key"""
+        from models.stats_class import StatShard
+        return dict((shard.key, shard.count)
+                    for shard in StatShard.query().fetch())
+
+    def test_move_queues_deltas(self):
+        from models.stats_class import ACTIVE_ATTEMPTS, StatShard
+        game = self.key.get()
+        missed = [letter for letter in 'zqxjkvbwy'
+                  if letter not in game.secretWord.lower()][0]
+        before = self.shards()
+        total = StatShard.get_totals([ACTIVE_ATTEMPTS])[ACTIVE_ATTEMPTS]
+        self.make_move(self.key, missed)
+        self.assertEqual(self.shards(), before)
+        StatShard.update_from_queue()
+        self.assertEqual(
+            StatShard.get_totals([ACTIVE_ATTEMPTS])[ACTIVE_ATTEMPTS],
+            total - 1)
+        self.assertEqual(sum(self.shards().values()),
+                         sum(before.values()) - 1)
+
+    def run_migrations(self):
+        """Runs the queued migration batches until none is left"""
+        import migrations
+        stub = self.benchmark.testbed.get_stub('taskqueue')
+        while True:
+            tasks = stub.get_filtered_tasks(queue_names=['migrations'])
+            if not tasks:
+                return
+            stub.FlushQueue('migrations')
+            for task in tasks:
+                params = task.extract_params()
+                migrations.run_batch(params['shard'],
+                                     int(params['generation']),
+                                     int(params['batch']))
+
+    def test_reconcile_rewrites_drifted_counters(self):
+        import migrations
+        import stats
+        from models.stats_class import (ACTIVE_GAMES, ACTIVE_ATTEMPTS,
+                                        StatShard, won_counter)
+        self.win(self.key)
+        self.new_game()
+        names = [ACTIVE_GAMES, ACTIVE_ATTEMPTS, won_counter(1)]
+        drifted = dict((name, 7) for name in names)
+        StatShard.update_from_queue()
+        StatShard.reset_multi(drifted)
+        # Batches of one entity
+        for name in stats.RECONCILE_RUNS:
+            migrations._migrations[name].batch_size = 1
+        try:
+            runs = stats.reconcile(shards=2)
+            self.assertEqual(StatShard.get_totals(names), drifted)
+            self.run_migrations()
+        finally:
+            for name in stats.RECONCILE_RUNS:
+                migrations._migrations[name].batch_size = \
+                    stats.RECONCILE_BATCH_SIZE
+        self.assertEqual(StatShard.get_totals(names),
+                         {ACTIVE_GAMES: 1, ACTIVE_ATTEMPTS: 10,
+                          won_counter(1): 1})
+        for run in runs:
+            self.assertTrue(all(shard['done']
+                                for shard in migrations.status(run)))
+
+
+if __name__ == '__main__':
+    unittest.main()
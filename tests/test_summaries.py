@@ -0,0 +1,67 @@
+"""test_summaries.py - The user_summaries migration rebuilds the recent
+games and words of a UserSummary, and keeps the results recorded while it
+runs."""
+import string
+import unittest
+
+import helpers
+
+GAMES = 3
+
+
+class RebuildSummaryTest(helpers.TestbedCase):
+
+    def setUp(self):
+        super(RebuildSummaryTest, self).setUp()
+        self.keys = self.create_player(games=GAMES)
+
+    def miss(self, key):
+        """Makes a move missing the secret word of a Game"""
+        game = key.get()
+        self.make_move(key, next(letter for letter in string.ascii_lowercase
+                                 if letter not in game.secretWord.lower()))
+
+    def rebuild(self):
+        """Deletes the UserSummary and rebuilds it"""
+        import migrations
+        from models.summary_class import UserSummary
+        user_key = self.keys[0].get().user
+        UserSummary.key_for(user_key).delete()
+        migrations.rebuild_user_summary(user_key)
+        return UserSummary.key_for(user_key).get(use_cache=False,
+                                                 use_memcache=False)
+
+    def test_recent_games_and_words(self):
+        first, second, third = self.keys
+        self.win(second)
+        self.miss(first)
+        summary = self.rebuild()
+        self.assertEqual(summary.active, 2)
+        self.assertEqual(summary.won, 1)
+        self.assertEqual(summary.recent_active, [first, third])
+        words = [key.get().secretWord for key in (first, second, third)]
+        self.assertEqual(sorted(summary.recent_words), sorted(set(words)))
+        self.assertEqual(summary.recent_words[0], words[0])
+
+    def test_keeps_results_recorded_during_rebuild(self):
+        import migrations
+        build = migrations.build_user_summary
+        won = []
+
+        def build_then_win(user_key):
+            summary = build(user_key)
+            if not won:
+                # The game ends after the rebuild read the Games
+                won.append(self.keys[0])
+                self.win(self.keys[0])
+            return summary
+
+        migrations.build_user_summary = build_then_win
+        try:
+            summary = self.rebuild()
+        finally:
+            migrations.build_user_summary = build
+        self.assertEqual(won, [self.keys[0]])
+        self.assertEqual(summary.won, 1)
+        self.assertEqual(summary.active, GAMES - 1)
+        self.assertNotIn(self.keys[0], summary.recent_active)
@@ -0,0 +1,40 @@
+"""test_user_results.py - The totals of the UserResultShards cached while a
+rollup commits expire instead of staying stale."""
+import time
+import unittest
+
+import helpers
+
+
+class PendingCacheTest(helpers.TestbedCase):
+
+    def setUp(self):
+        super(PendingCacheTest, self).setUp()
+        # The clock of the memcache stub, moved forward by the tests
+        self.clock = [time.time()]
+        self.benchmark.testbed.get_stub('memcache')._gettime = \
+            lambda: self.clock[0]
+
+    def test_stale_total_expires(self):
+        from google.appengine.ext import ndb
+        from models.user_class import RESULTS_CACHE_SECONDS, UserResultShard
+        user_key = ndb.Key('User', 'player')
+        UserResultShard.increment_multi({user_key: (1, 0)})
+        shards = [shard for shard in ndb.get_multi(
+            UserResultShard.shard_keys(user_key)) if shard]
+        self.assertEqual(UserResultShard.pending([user_key]),
+                         {user_key: (1, 0)})
+        # A rollup that moved the results after the totals were read,
+        # before they were cached
+        for shard in shards:
+            shard.victories = shard.losses = 0
+        ndb.put_multi(shards)
+        self.assertEqual(UserResultShard.pending([user_key]),
+                         {user_key: (1, 0)})
+        self.clock[0] += RESULTS_CACHE_SECONDS + 1
+        self.assertEqual(UserResultShard.pending([user_key]),
+                         {user_key: (0, 0)})
+
+
+if __name__ == '__main__':
+    unittest.main()
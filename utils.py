@@ -1,6 +1,14 @@
-"""utils.py - File for collecting general utility functions."""
+"""utils.py - File for collecting general utility functions. The models
+import it, so endpoints is only imported by the functions raising its
+exceptions, keeping it out of the cold start of the handlers."""
+import threading
+from collections import OrderedDict
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
-import endpoints
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
 
 
 def get_by_urlsafe(urlsafe, model):
@@ -15,6 +23,7 @@ def get_by_urlsafe(urlsafe, model):
         exists.
     Raises:
         ValueError:"""
+    import endpoints
     try:
         key = ndb.Key(urlsafe=urlsafe)
     except TypeError:
@@ -31,3 +40,120 @@ def get_by_urlsafe(urlsafe, model):
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
     return entity
+
+
+def key_from_urlsafe(urlsafe, model):
+    """Returns the ndb.Key a urlsafe key string encodes, without reading
+    the entity, so many keys can be read with one batched get.
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        The Key, or None if the string is malformed or the Key is not of
+        the expected kind."""
+    try:
+        key = ndb.Key(urlsafe=urlsafe)
+    except Exception, e:
+        if isinstance(e, TypeError) or \
+                e.__class__.__name__ == 'ProtocolBufferDecodeError':
+            return None
+        raise
+    if key.kind() != model._get_kind():
+        return None
+    return key
+
+
+def fetch_page(query, page_size=None, page_token=None, **options):
+    """Fetches one page of a query, starting where the previous page
+    ended.
+    Args:
+        query: the ndb.Query to run
+        page_size: the maximum number of results, defaults to
+        DEFAULT_PAGE_SIZE and is capped at MAX_PAGE_SIZE
+        page_token: the opaque token returned with the previous page, or
+        None for the first page
+        options: further query options, such as projection
+    Returns:
+        A (results, next_page_token) tuple; next_page_token is None on the
+        last page.
+    Raises:
+        endpoints.BadRequestException: If the page size is not positive or
+        the page token is malformed or belongs to another query."""
+    import endpoints
+    if page_size is None:
+        page_size = DEFAULT_PAGE_SIZE
+    if page_size < 1:
+        raise endpoints.BadRequestException('Invalid page size')
+    try:
+        cursor = Cursor(urlsafe=page_token) if page_token else None
+        results, next_cursor, more = query.fetch_page(
+            min(page_size, MAX_PAGE_SIZE), start_cursor=cursor, **options)
+    except (datastore_errors.BadValueError,
+            datastore_errors.BadRequestError):
+        raise endpoints.BadRequestException('Invalid page token')
+    if more and next_cursor:
+        return results, next_cursor.urlsafe()
+    return results, None
+
+
+def fetch_list_page(items, page_size=None, page_token=None):
+    """Returns one page of a list, like fetch_page returns one page of a
+    query; the page token is the position of the next page.
+    Args:
+        items: the list
+        page_size: the maximum number of items, defaults to
+        DEFAULT_PAGE_SIZE and is capped at MAX_PAGE_SIZE
+        page_token: the token returned with the previous page, or None for
+        the first page
+    Returns:
+        A (items, next_page_token) tuple; next_page_token is None on the
+        last page.
+    Raises:
+        endpoints.BadRequestException: If the page size is not positive or
+        the page token is malformed."""
+    import endpoints
+    if page_size is None:
+        page_size = DEFAULT_PAGE_SIZE
+    if page_size < 1:
+        raise endpoints.BadRequestException('Invalid page size')
+    start = 0
+    if page_token:
+        if not page_token.isdigit():
+            raise endpoints.BadRequestException('Invalid page token')
+        start = int(page_token)
+    end = start + min(page_size, MAX_PAGE_SIZE)
+    if end < len(items):
+        return items[start:end], str(end)
+    return items[start:end], None
+
+
+class LRUCache(object):
+    """A thread safe, in-process cache that keeps the most recently used
+    values, up to a maximum number"""
+
+    def __init__(self, size):
+        self.size = size
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the value cached for a key, or None"""
+        with self._lock:
+            value = self._values.pop(key, None)
+            if value is not None:
+                self._values[key] = value
+            return value
+
+    def set(self, key, value):
+        """Caches a value, evicting the least recently used one if the
+        cache is full"""
+        with self._lock:
+            self._values.pop(key, None)
+            self._values[key] = value
+            if len(self._values) > self.size:
+                self._values.popitem(last=False)
+
+    def delete(self, key):
+        """Removes a key from the cache"""
+        with self._lock:
+            self._values.pop(key, None)